@@ -6,30 +6,58 @@
 # The server communicates with ComfyUI via HTTP and WebSocket for efficient, real-time execution tracking.
 #
 # Key features:
-# - Dynamic workflow loading and node identification
+# - Dynamic workflow loading and node identification (compiled once, see workflow_templates.py)
 # - Robust error handling and logging
 # - WebSocket-based event-driven execution (no polling)
-# - Endpoints for /dream, /img2img, /img2vid
+# - Fully async ComfyUI access via comfy_client.py (pooled connections, no blocking calls)
+# - Multiple ComfyUI backends (COMFYUI_HOSTS): jobs go to the least-loaded healthy one
+# - Endpoints for /dream, /dream/batch, /img2img, /img2vid (plus multipart /img2img/upload, /img2vid/upload, /jobs/upload)
+# - Async job API: POST /jobs returns a job id, GET /jobs/{id} reports status and outputs
+# - Live progress stream per job: GET /jobs/{id}/events (Server-Sent Events)
+# - Cancellation: DELETE /jobs/{id}, or a blocking endpoint's client disconnecting, stops the ComfyUI prompt
+# - Durable jobs: a restart re-attaches unfinished jobs to their ComfyUI prompts (see job_store.py)
+# - Output streaming via GET /outputs/{prompt_id}/{node_id}/{filename} (clients never talk to ComfyUI)
+# - On-disk LRU output cache: repeat fetches (Range and conditional requests too) skip ComfyUI (see output_cache.py)
+# - Input images oriented, resized to the workflow's input size and re-encoded before upload (see input_images.py)
+# - Delivery variants (?variant=telegram): JPEG/WebP images, size-capped faststart H.264 videos (see delivery.py)
+# - Priority + fair-share scheduler feeding each backend a shallow queue (see scheduler.py)
+# - Admission control: per-type job limits, 429 + Retry-After when full (see jobs.py)
+# - Optional result cache: identical workflows (same prompt, seed, image) run once (see result_cache.py)
 # - Utility functions for workflow manipulation and output retrieval
 
-from fastapi import FastAPI
+from contextlib import asynccontextmanager
+from typing import Optional
+from fastapi import FastAPI, File, Form, HTTPException, Request, Response, UploadFile
+from fastapi.responses import JSONResponse, StreamingResponse
+from starlette.background import BackgroundTask
 from pydantic import BaseModel
-import requests
 import os
 import json
 import time
-import copy
+import mimetypes
 import base64
-import uuid
+import hashlib
+import asyncio
 import logging
-import websocket
+import re
+from urllib.parse import quote
 from dotenv import load_dotenv
+from comfy_client import ComfyBackendPool, ComfyUIError, PromptRejectedError, list_outputs
+from workflow_templates import WorkflowRegistry, WorkflowTemplate, model_signature
+from jobs import Job, JobManager, JobRejected, JOB_KINDS
+from job_store import JobStore, JOB_STORE_PATH
+from result_cache import ResultCache, workflow_cache_key
+from delivery import DeliveryTranscoder, DELIVERY_WAIT, VARIANTS
+from input_images import InputNormalizer
+from output_cache import (OutputCache, RangeNotSatisfiable, http_date, is_not_modified, iter_file, output_etag,
+                          output_ref, parse_range)
+from scheduler import Scheduler, DEFAULT_PRIORITY, PRIORITY_CLASSES
+from profiler import NodeProfiler
+import metrics
 
 # Load environment variables from .env file
 load_dotenv()
 
-app = FastAPI()
-
 # Logging setup for API server
 logging.basicConfig(
   format="%(asctime)s - %(levelname)s - %(message)s",
@@ -42,209 +70,582 @@ WORKFLOWS_DIR = os.path.join(os.path.dirname(__file__), "workflows")
 DEFAULT_WORKFLOW_PATH = os.path.join(WORKFLOWS_DIR, "t2i - SDXL.json")
 IMG2IMG_WORKFLOW_PATH = os.path.join(WORKFLOWS_DIR, "i2i - CyberRealistic Pony 14.1.json")
 IMG2VID_WORKFLOW_PATH = os.path.join(WORKFLOWS_DIR, "i2v - WAN 2.2 Smooth Workflow v2.0.json")
+IMAGE_WORKFLOW_PATHS = {"i2i": IMG2IMG_WORKFLOW_PATH, "i2v": IMG2VID_WORKFLOW_PATH}
+
+# Durable record of every job, so a restart can re-attach running prompts (JOB_STORE_PATH="" disables it)
+job_store = JobStore(JOB_STORE_PATH) if JOB_STORE_PATH else None
+
+# Background generation jobs (POST /jobs, GET /jobs/{id}); jobs run in parallel on healthy backends
+jobs = JobManager(workers=lambda: sum(1 for backend in comfy_pool.backends if backend.healthy), store=job_store)
+
+# Compiled workflow templates, parsed once and reloaded when a file changes on disk
+workflow_registry = WorkflowRegistry(WORKFLOWS_DIR)
+
+# Results of finished generations, keyed by the hash of the submitted workflow
+result_cache = ResultCache()
+# Background tasks copying cached outputs to disk (kept referenced until done)
+cache_tasks = set()
+
+# Generated files kept on local disk after their first fetch (GET /outputs)
+output_cache = OutputCache()
+# Worker threads normalizing input images before they are uploaded to ComfyUI
+input_normalizer = InputNormalizer()
+# Worker processes making delivery variants of cached outputs (GET /outputs?variant=telegram)
+delivery = DeliveryTranscoder()
+# Delivery variants being made: (prompt_id, ref, variant) -> task
+variant_tasks = {}
 
 # ComfyUI connection settings (configurable for remote/local)
+# COMFYUI_HOSTS is a comma-separated list of backends; COMFYUI_HOST is the single-backend fallback
 COMFYUI_HOST = os.getenv("COMFYUI_HOST", "127.0.0.1:8188")
-COMFYUI_API = f"http://{COMFYUI_HOST}"
-COMFYUI_WS_URL = f"ws://{COMFYUI_HOST}/ws"
+COMFYUI_HOSTS = [host.strip() for host in os.getenv("COMFYUI_HOSTS", COMFYUI_HOST).split(",") if host.strip()]
+
+# Shared async ComfyUI backends (pooled keep-alive connections, async WebSocket waits, health checks)
+comfy_pool = ComfyBackendPool(COMFYUI_HOSTS)
+
+# Decides which waiting job runs next; fair-share cost is the job type's average GPU time
+scheduler = Scheduler(comfy_pool, cost=lambda job: jobs.durations.get(job.kind, 1.0))
+
+# Per-node execution timings of every submitted prompt (GET /profile)
+profiler = NodeProfiler()
+
+# Scrape-time metrics read from the job manager, scheduler, backends and result cache
+metrics.registry.callback(
+  "comfynaut_active_jobs", "Unfinished jobs", ("kind",),
+  lambda: {(kind,): len(jobs.active(kind)) for kind in JOB_KINDS})
+metrics.registry.callback(
+  "comfynaut_scheduler_waiting_jobs", "Jobs waiting for a backend slot", ("priority",),
+  lambda: {(name,): count for name, count in scheduler.status()["waiting"].items()})
+metrics.registry.callback(
+  "comfynaut_scheduler_model_swaps_total", "Jobs that made a backend load different models", (),
+  lambda: scheduler.model_swaps, "counter")
+metrics.registry.callback(
+  "comfynaut_backend_healthy", "Whether a ComfyUI backend passed its last health check", ("backend",),
+  lambda: {(backend.host,): int(backend.healthy) for backend in comfy_pool.backends})
+metrics.registry.callback(
+  "comfynaut_backend_queue_depth", "Prompts queued or running on a ComfyUI backend", ("backend",),
+  lambda: {(backend.host,): backend.load for backend in comfy_pool.backends})
+metrics.registry.callback(
+  "comfynaut_result_cache_requests_total", "Result cache lookups by outcome", ("outcome",),
+  lambda: {(outcome,): result_cache.stats()[outcome] for outcome in ("hits", "misses", "coalesced", "stale")}, "counter")
+metrics.registry.callback(
+  "comfynaut_output_cache_requests_total", "Output cache lookups by GET /outputs, by outcome", ("outcome",),
+  lambda: {(outcome,): output_cache.stats()[outcome] for outcome in ("hits", "misses")}, "counter")
+metrics.registry.callback(
+  "comfynaut_output_cache_bytes", "Bytes of generated files in the output cache", (),
+  lambda: output_cache.total_bytes)
+metrics.registry.callback(
+  "comfynaut_delivery_transcodes_total", "Delivery variants made, by output kind and outcome", ("kind", "outcome"),
+  lambda: dict(delivery.counts), "counter")
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+  """Open shared resources on startup and release them on shutdown."""
+  workflow_registry.preload()
+  input_normalizer.start()
+  await asyncio.get_running_loop().run_in_executor(None, output_cache.open)
+  await asyncio.get_running_loop().run_in_executor(None, result_cache.open)
+  if output_cache.enabled:
+    delivery.start()  # Variants live in the output cache
+  if job_store is not None:
+    await job_store.open()
+    # ComfyUI sends a prompt's events to the client id it was queued under; keep ours across restarts
+    for backend in comfy_pool.backends:
+      backend.events.client_id = await job_store.client_id(backend.host, backend.events.client_id)
+  await comfy_pool.start()
+  scheduler.start()
+  if job_store is not None:
+    await restore_jobs()
+  yield
+  await jobs.close()
+  await scheduler.stop()
+  await comfy_pool.close()
+  for task in list(variant_tasks.values()):
+    task.cancel()  # Running transcodes still finish: delivery.close() waits for them
+  await delivery.close()
+  input_normalizer.close()
+  if job_store is not None:
+    await job_store.close()
+
+app = FastAPI(lifespan=lifespan)
+
+# Admission control: a job type at its limit answers 429 with a Retry-After estimate
+@app.exception_handler(JobRejected)
+async def job_rejected_handler(request: Request, exc: JobRejected):
+  return JSONResponse(
+    status_code=429,
+    content={"status": "error", "message": f"🚧 The castle is full! {exc}", "retry_after": exc.retry_after},
+    headers={"Retry-After": str(exc.retry_after)},
+  )
 
 PROMPT_HELPERS = ", high quality, masterpiece, best quality, 8k"
 
 # WebSocket settings for real-time communication
-WS_CONNECT_TIMEOUT = 10  # WebSocket connection timeout in seconds
-WS_RECV_TIMEOUT = 5      # WebSocket receive timeout per message
-WS_IMAGE_TIMEOUT = 60    # Total timeout for image generation
-WS_VIDEO_TIMEOUT = 900   # Total timeout for video generation (15 min)
+# Timeouts start when ComfyUI begins executing; queue time is bounded by COMFYUI_MAX_QUEUE_WAIT
+WS_IMAGE_TIMEOUT = 60    # Execution timeout for image generation
+WS_VIDEO_TIMEOUT = 900   # Execution timeout for video generation (15 min)
+
+# Live progress stream: how often to report queue position while a job waits (in seconds)
+SSE_QUEUE_POLL_INTERVAL = 5
+
+# Most images one /dream/batch request may ask for (one latent batch, one GPU pass)
+DREAM_BATCH_MAX = int(os.getenv("DREAM_BATCH_MAX", "8"))
+
+# Chunk size for hashing multipart image uploads (in bytes)
+UPLOAD_CHUNK_SIZE = 1024 * 1024
 
-# Video encoder flush delay (in seconds)
-# Workaround for VHS_VideoCombine encoder flush issue where last frame is sometimes dropped
-ENCODER_FLUSH_DELAY = 2  # Delay in seconds after video generation to ensure encoder flushes last frame
+# Node ids and file names made only of these characters go into /outputs URLs as they are
+URL_SAFE_SEGMENT = re.compile(r"[\w.~-]+", re.ASCII).fullmatch
 
 # Request models for API endpoints
+# A fixed seed makes a request reproducible (and cacheable); None picks a time-based seed.
+# user_id and priority feed the scheduler (priority: "interactive", "marathon" or "video").
 class DreamRequest(BaseModel):
   prompt: str
-  workflow: str = None
+  workflow: Optional[str] = None
+  seed: Optional[int] = None
+  user_id: Optional[str] = None
+  priority: Optional[str] = None
+
+class DreamBatchRequest(DreamRequest):
+  count: int = 4  # Images generated together in one latent batch
 
 class Img2ImgRequest(BaseModel):
   prompt: str
   image_data: str  # Base64 encoded image
+  seed: Optional[int] = None
+  user_id: Optional[str] = None
+  priority: Optional[str] = None
 
 class Img2VidRequest(BaseModel):
   image_data: str  # Base64 encoded image
   prompt: str = ""  # Optional positive prompt for video generation
+  seed: Optional[int] = None
+  user_id: Optional[str] = None
+  priority: Optional[str] = None
 
-# Utility: Load a workflow JSON file with robust decoding and error handling
-def load_workflow(path=DEFAULT_WORKFLOW_PATH):
-  """Load a ComfyUI workflow JSON with robust decoding & logging."""
-  if not os.path.isfile(path):
-    raise FileNotFoundError(f"Workflow file not found: {path}")
-  encodings = ("utf-8", "utf-8-sig", "latin-1")
-  last_error = None
-  for enc in encodings:
-    try:
-      with open(path, "r", encoding=enc) as f:
-        return json.load(f)
-    except UnicodeDecodeError as e:
-      logger.warning("Unicode decode error using %s for %s: %s", enc, path, e)
-      last_error = e
-      continue
-    except json.JSONDecodeError as e:
-      raise ValueError(f"Invalid JSON in workflow file {path}: {e}") from e
-  raise UnicodeDecodeError("<multi>", b"", 0, 0, f"Failed to decode workflow file {path} with tried encodings: {encodings}. Last error: {last_error}")
-
-# Utility: Find the 'Positive Prompt' CLIPTextEncode node dynamically
-def find_positive_prompt_node(workflow):
-  """Find the 'Positive Prompt' CLIPTextEncode node dynamically."""
-  clip_text_encode_nodes = []
-  for node_id, node_data in workflow.items():
-    if isinstance(node_data, dict) and node_data.get("class_type") == "CLIPTextEncode":
-      title = node_data.get("_meta", {}).get("title", "").lower()
-      clip_text_encode_nodes.append((node_id, title))
-  if not clip_text_encode_nodes:
-    raise ValueError("No CLIPTextEncode nodes found in workflow!")
-  for node_id, title in clip_text_encode_nodes:
-    if "positive" in title:
-      return node_id
-  return clip_text_encode_nodes[0][0]
-
-# Utility: Find the node for loading the input image
-def find_image_load_node(workflow):
-  """Find the node for loading the input image (usually `LoadImage`)."""
-  for node_id, node_data in workflow.items():
-    if node_data.get("class_type") == "LoadImage":
-      return node_id
-  raise ValueError("Could not find LoadImage node in workflow!")
-
-# Utility: Find the KSampler node dynamically
-def find_ksampler_node(workflow):
-  """Find the KSampler node dynamically."""
-  for node_id, node_data in workflow.items():
-    if node_data.get("class_type") == "KSampler":
-      return node_id
-  raise ValueError("Could not find KSampler node in workflow!")
-
-# Utility: Find the Seed (rgthree) node for video generation workflows
-def find_seed_node(workflow):
-  """Find the Seed (rgthree) node for video generation workflows."""
-  for node_id, node_data in workflow.items():
-    if node_data.get("class_type") == "Seed (rgthree)":
-      return node_id
-  raise ValueError("Could not find Seed (rgthree) node in workflow!")
-
-# Utility: Find the PrimitiveStringMultiline node for positive prompt in video workflows
-def find_primitive_prompt_node(workflow):
-  """Find the PrimitiveStringMultiline node used for positive prompt input.
-  This is used in video generation workflows where the prompt is stored in a
-  PrimitiveStringMultiline node with title 'Positive'.
-  """
-  for node_id, node_data in workflow.items():
-    if isinstance(node_data, dict) and node_data.get("class_type") == "PrimitiveStringMultiline":
-      title = node_data.get("_meta", {}).get("title", "").lower()
-      if "positive" in title:
-        return node_id
-  return None
+# Form fields of the multipart image endpoints (the image itself is a file part)
+class ImageJobForm(BaseModel):
+  prompt: str = ""
+  seed: Optional[int] = None
+  user_id: Optional[str] = None
+  priority: Optional[str] = None
 
-# Utility: Find the VHS_VideoCombine node for video output
-def find_video_combine_node(workflow, require_save_output=False):
-  """Find the VHS_VideoCombine node for video output.
-  If require_save_output is True, only return nodes with save_output=True.
-  """
-  for node_id, node_data in workflow.items():
-    if node_data.get("class_type") == "VHS_VideoCombine":
-      if require_save_output:
-        if node_data.get("inputs", {}).get("save_output", False):
-          return node_id
-      else:
-        return node_id
-  raise ValueError("Could not find VHS_VideoCombine node in workflow!")
+# Request models by name, to rebuild the requests of jobs restored from the job store
+REQUEST_MODELS = {model.__name__: model for model in (DreamRequest, DreamBatchRequest, Img2ImgRequest, Img2VidRequest, ImageJobForm)}
+
+class JobRequest(BaseModel):
+  type: str  # One of JOB_KINDS: "t2i", "i2i" or "i2v"
+  prompt: str = ""
+  workflow: Optional[str] = None  # t2i only
+  image_data: Optional[str] = None  # Base64 encoded image (i2i / i2v)
+  seed: Optional[int] = None
+  count: int = 1  # t2i only: images generated in one latent batch
+  user_id: Optional[str] = None
+  priority: Optional[str] = None
 
 # Build a text-to-image workflow with the given prompt
-def build_workflow(prompt: str, base_workflow=None):
-  """Build a text-to-image workflow with the given prompt."""
+def build_workflow(prompt: str, base_workflow=None, seed: Optional[int] = None, batch_size: int = 1):
+  """Build a text-to-image workflow with the given prompt.
+  base_workflow may be a WorkflowTemplate or a raw workflow dict; only the
+  prompt and seed nodes are copied, the rest of the graph is shared.
+  A None seed is replaced by a time-based one. A batch_size above 1 is set on
+  the empty latent node so every image comes out of the same sampler pass.
+  """
   if base_workflow is None:
-    base_workflow = load_workflow()
-  workflow = copy.deepcopy(base_workflow)
-  # Dynamically find the positive prompt node
-  positive_prompt_node_id = find_positive_prompt_node(workflow)
-  workflow[positive_prompt_node_id]["inputs"]["text"] = prompt + PROMPT_HELPERS
-  # Find and update KSampler seed dynamically
-  try:
-    ksampler_node_id = find_ksampler_node(workflow)
-    workflow[ksampler_node_id]["inputs"]["seed"] = int(time.time()) % 999999999
-  except ValueError:
-    # Fallback to node "3" if KSampler not found
-    if "3" in workflow:
-      workflow["3"]["inputs"]["seed"] = int(time.time()) % 999999999
-  return {"prompt": workflow}
+    base_workflow = workflow_registry.get(DEFAULT_WORKFLOW_PATH)
+  template = WorkflowTemplate.coerce(base_workflow)
+  if template.prompt_node is None:
+    raise ValueError("No CLIPTextEncode nodes found in workflow!")
+  changes = {template.prompt_node: {"text": prompt + PROMPT_HELPERS}}
+  if batch_size > 1:
+    if template.latent_node is None:
+      raise ValueError("Could not find EmptyLatentImage node in workflow, cannot batch!")
+    changes[template.latent_node] = {"batch_size": batch_size}
+  # Update KSampler seed (fallback to node "3" if KSampler not found)
+  seed_node_id = template.ksampler_node or ("3" if "3" in template.graph else None)
+  if seed_node_id:
+    changes[seed_node_id] = {"seed": int(time.time()) % 999999999 if seed is None else seed}
+  return {"prompt": template.patch(changes)}
 
 # Build an image-to-image workflow with the given prompt and input image
-def build_img2img_workflow(prompt: str, image_filename: str, base_workflow=None):
+def build_img2img_workflow(prompt: str, image_filename: str, base_workflow=None, seed: Optional[int] = None):
   """Build an image-to-image workflow with the given prompt and input image."""
   if base_workflow is None:
-    base_workflow = load_workflow(IMG2IMG_WORKFLOW_PATH)
-  workflow = copy.deepcopy(base_workflow)
-  # Find positive prompt node dynamically
-  positive_prompt_node_id = find_positive_prompt_node(workflow)
-  workflow[positive_prompt_node_id]["inputs"]["text"] = prompt + PROMPT_HELPERS
-  # Find image load node dynamically
-  image_load_node_id = find_image_load_node(workflow)
-  workflow[image_load_node_id]["inputs"]["image"] = image_filename
-  # Find and update KSampler seed dynamically
-  try:
-    ksampler_node_id = find_ksampler_node(workflow)
-    workflow[ksampler_node_id]["inputs"]["seed"] = int(time.time()) % 999999999
-  except ValueError:
-    # Fallback to node "3" if KSampler not found
-    if "3" in workflow:
-      workflow["3"]["inputs"]["seed"] = int(time.time()) % 999999999
-  return {"prompt": workflow}
+    base_workflow = workflow_registry.get(IMG2IMG_WORKFLOW_PATH)
+  template = WorkflowTemplate.coerce(base_workflow)
+  if template.prompt_node is None:
+    raise ValueError("No CLIPTextEncode nodes found in workflow!")
+  if template.image_node is None:
+    raise ValueError("Could not find LoadImage node in workflow!")
+  changes = {
+    template.prompt_node: {"text": prompt + PROMPT_HELPERS},
+    template.image_node: {"image": image_filename},
+  }
+  # Update KSampler seed (fallback to node "3" if KSampler not found)
+  seed_node_id = template.ksampler_node or ("3" if "3" in template.graph else None)
+  if seed_node_id:
+    changes[seed_node_id] = {"seed": int(time.time()) % 999999999 if seed is None else seed}
+  return {"prompt": template.patch(changes)}
 
 # Build an image-to-video workflow for WAN i2v
-def build_img2vid_workflow(image_filename: str, prompt: str = "", base_workflow=None):
+def build_img2vid_workflow(image_filename: str, prompt: str = "", base_workflow=None, seed: Optional[int] = None):
   """Build the image-to-video workflow for WAN i2v."""
   if base_workflow is None:
-    base_workflow = load_workflow(IMG2VID_WORKFLOW_PATH)
-  workflow = copy.deepcopy(base_workflow)
-  # Find and update LoadImage node
-  image_load_node_id = find_image_load_node(workflow)
-  workflow[image_load_node_id]["inputs"]["image"] = image_filename
-  # Find and update the positive prompt node (PrimitiveStringMultiline)
-  prompt_node_id = find_primitive_prompt_node(workflow)
+    base_workflow = workflow_registry.get(IMG2VID_WORKFLOW_PATH)
+  template = WorkflowTemplate.coerce(base_workflow)
+  if template.image_node is None:
+    raise ValueError("Could not find LoadImage node in workflow!")
+  changes = {template.image_node: {"image": image_filename}}
+  # Update the positive prompt node (PrimitiveStringMultiline)
+  prompt_node_id = template.primitive_prompt_node
   if prompt_node_id:
     if prompt:
-      workflow[prompt_node_id]["inputs"]["value"] = prompt
+      changes[prompt_node_id] = {"value": prompt}
       logger.info("Set positive prompt in node %s: '%s'", prompt_node_id, prompt)
     else:
       logger.info("Prompt node %s found but no prompt provided, using workflow default", prompt_node_id)
   else:
     logger.warning("No PrimitiveStringMultiline 'Positive' node found in workflow")
-  # Find and update Seed (rgthree) node for randomization
+  # Update Seed (rgthree) node for randomization, falling back to KSampler
+  if template.seed_node:
+    changes[template.seed_node] = {"seed": int(time.time() * 1000) % 999999999999999 if seed is None else seed}
+  elif template.ksampler_node:
+    changes[template.ksampler_node] = {"seed": int(time.time()) % 999999999 if seed is None else seed}
+  else:
+    logger.warning("⚠️ No seed node found, using workflow defaults")
+  return {"prompt": template.patch(changes)}
+
+# Utility: Queue a job's workflow on ComfyUI and remember its prompt_id
+async def queue_job_prompt(job: Job, payload: dict) -> str:
+  """Queue a workflow for a job and attach the ComfyUI prompt_id/state to it.
+  The prompt goes to the job's backend (picked earlier if the job uploaded an
+  image there), otherwise to the least-loaded healthy backend.
+  """
+  if job.backend is None:
+    job.backend = comfy_pool.pick()
+  job.workflow = payload["prompt"]
+  submit = asyncio.ensure_future(job.backend.queue_prompt(payload))
   try:
-    seed_node_id = find_seed_node(workflow)
-    workflow[seed_node_id]["inputs"]["seed"] = int(time.time() * 1000) % 999999999999999
-  except ValueError:
-    # Fallback: try KSampler if Seed node not found
+    with metrics.stage("submit"):
+      prompt_id = await asyncio.shield(submit)
+  except asyncio.CancelledError:
+    # Cancelled mid-POST: the prompt may still get queued, so keep its id for stop_job_prompt()
     try:
-      ksampler_node_id = find_ksampler_node(workflow)
-      workflow[ksampler_node_id]["inputs"]["seed"] = int(time.time()) % 999999999
-    except ValueError:
-      print("⚠️ No seed node found, using workflow defaults")
-  return {"prompt": workflow}
+      job.prompt_id = await submit
+      jobs.save(job)
+    except Exception:
+      pass
+    raise
+  comfy_pool.remember(prompt_id, job.backend)
+  job.prompt_id = prompt_id
+  jobs.save(job)
+  job.prompt_state = job.backend.events.track(prompt_id)
+  job.prompt_state.subscribe(job.on_prompt_event)
+  profiler.track(job.prompt_state, job.workflow_file, job.workflow)
+  job.publish("status", {"status": "submitted", "prompt_id": prompt_id})
+  if job.prompt_state.status != "pending":
+    # ComfyUI may have started before /prompt returned; those events went unrelayed
+    job.publish("status", {"status": "running"})
+  return prompt_id
 
-# Endpoint: /dream - text-to-image generation
-@app.post("/dream")
-async def receive_dream(req: DreamRequest):
-  logger.info("Prompt received: '%s'", req.prompt)
+# Utility: Name an input image after its content
+def input_image_filename(digest: str, extension: str = ".png") -> str:
+  """Return the content-addressed upload name for an image's SHA-256 digest.
+  Identical images get identical names, so they yield identical workflows
+  (result cache keys) and are only uploaded once per backend.
+  """
+  return f"input_{digest[:32]}{extension}"
+
+# Utility: Normalize an input image for a workflow and name it
+async def prepare_input_image(source, template: WorkflowTemplate, digest: Optional[str] = None) -> tuple:
+  """Orient, resize (to the workflow's input size) and re-encode an input image, see input_images.py.
+  Args:
+    source: The image as bytes, or as a seekable binary file (an upload's spooled temp file)
+    template: The workflow the image is for
+    digest: SHA-256 hex digest of `source`, if already known (required for a file)
+  Returns:
+    (image bytes or the `source` file, content_type, digest, image_filename) ready to upload
+  Raises:
+    ValueError: if the data is not a readable image
+  """
+  try:
+    with metrics.stage("normalize"):
+      image_data, content_type, extension = await input_normalizer.normalize(source, template.input_resize)
+  except Exception as e:
+    raise ValueError(f"Unreadable image: {e}") from e
+  if image_data is not source:
+    logger.info("Input image normalized for %s: %d bytes", template.name, len(image_data))
+    digest = None
+  if digest is None:
+    digest = hashlib.sha256(image_data).hexdigest()
+  return image_data, content_type, digest, input_image_filename(digest, extension)
+
+# Utility: Upload a job's input image to the backend the job will run on
+async def upload_job_image(job: Job, digest: str, image_filename: str, image_data: bytes, content_type: str):
+  """Make sure a job's input image is on its backend (picking one if the job has none yet).
+  Raises:
+    ComfyUIError: if the upload fails
+  """
+  # Uploads are per backend, so the prompt must later run where the image landed
+  if job.backend is None:
+    job.backend = comfy_pool.pick()
+  try:
+    with metrics.stage("upload"):
+      uploaded = await job.backend.ensure_input_image(digest, image_filename, image_data, content_type)
+  except Exception as e:
+    raise ComfyUIError(f"Error uploading image to ComfyUI: {e}") from e
+  if uploaded:
+    logger.info("Image uploaded for %s job %s (%s): %s", job.kind, job.id, job.backend.host, image_filename)
+  else:
+    logger.info("Image %s already on %s, skipping upload", image_filename, job.backend.host)
+
+# Utility: Queue a workflow that loads an input image, re-uploading the image once if ComfyUI lost it
+async def queue_image_job_prompt(job: Job, payload: dict, image_filename: str, upload: Optional[tuple] = None) -> str:
+  """Queue an i2i/i2v workflow, uploading its input image first when `upload` is given.
+  If /prompt rejects the workflow over the image (ComfyUI's input folder was
+  cleaned, or the backend restarted), the image is dropped from the backend's
+  upload index and, when its bytes are at hand, uploaded and queued again once.
+  Args:
+    job: The job being run
+    payload: The built workflow payload
+    image_filename: The input image's name on ComfyUI
+    upload: (digest, image_data, content_type) for base64 images; None for multipart uploads already on job.backend
+  Raises:
+    ComfyUIError: if the upload fails or ComfyUI rejects the workflow
+  """
+  if upload is not None:
+    await upload_job_image(job, upload[0], image_filename, upload[1], upload[2])
+  try:
+    return await queue_job_prompt(job, payload)
+  except PromptRejectedError as e:
+    if image_filename not in e.body:
+      raise
+    job.backend.forget_input(image_filename)
+    if upload is None:
+      raise
+    logger.warning("Input image %s is gone from %s, uploading it again", image_filename, job.backend.host)
+  await upload_job_image(job, upload[0], image_filename, upload[1], upload[2])
+  return await queue_job_prompt(job, payload)
+
+# Utility: Run a job's workflow through the result cache and the scheduler
+async def run_workflow(job: Job, payload: dict, execute):
+  """Return execute()'s result, reusing an earlier or in-flight run of the same workflow.
+  Only real runs wait for a scheduler slot; the slot (and job.backend) is held
+  until execute() returns.
+  Args:
+    job: The job being run (job.cache records "hit", "coalesced" or "miss")
+    payload: The built workflow payload; its graph is the cache key
+    execute: Coroutine function that uploads/queues the workflow and returns its outputs (falsy on failure)
+  """
+  async def scheduled():
+    waiting = time.perf_counter()
+    async with scheduler.slot(job):
+      metrics.observe_stage("schedule", time.perf_counter() - waiting)
+      try:
+        result = await execute()
+      except asyncio.CancelledError:
+        await asyncio.shield(stop_job_prompt(job))
+        raise
+      finally:
+        observe_prompt_stages(job)
+    if result and delivery.enabled and job.prompt_id:
+      # Variants are made while the response travels to the client, which fetches them next
+      task = asyncio.get_running_loop().create_task(prepare_delivery_variants(job.prompt_id))
+      cache_tasks.add(task)
+      task.add_done_callback(cache_tasks.discard)
+    return result
+
+  job.model = model_signature(payload["prompt"])
+  if not result_cache.enabled:
+    return await scheduled()
+  key = workflow_cache_key(payload["prompt"])
+  result, job.cache = await result_cache.get_or_run(key, scheduled, validate=prompt_outputs_available)
+  if job.cache != "miss":
+    logger.info("Result cache %s for job %s (%s)", job.cache, job.id, key[:12])
+  elif result:
+    result_cache.link(key, job.prompt_id)
+    if result_cache.directory:
+      task = asyncio.get_running_loop().create_task(cache_output_files(key, job.prompt_id))
+      cache_tasks.add(task)
+      task.add_done_callback(cache_tasks.discard)
+  return result
+
+# Utility: Check that ComfyUI can still serve a finished prompt's outputs
+async def prompt_outputs_available(prompt_id: str) -> bool:
+  """Return True if ComfyUI still has the prompt's history entry and every output file.
+  Cached results point at /outputs URLs of an earlier prompt; after a ComfyUI
+  restart or a history trim those URLs would 404, so the result must not be reused.
+  """
+  outputs = await get_history_outputs(prompt_id)
+  backend = await comfy_pool.find(prompt_id)
+  if not outputs or backend is None:
+    return False
+  found = await asyncio.gather(*(backend.has_output(output) for output in outputs))
+  return all(found)
+
+# Utility: Stop a cancelled job's prompt on ComfyUI
+async def stop_job_prompt(job: Job):
+  """Delete the job's prompt from ComfyUI's queue, or interrupt it if it is running."""
+  if job.prompt_id is None or job.backend is None:
+    return
+  if job.cancel_reason is None:
+    return  # Server shutdown: the prompt keeps running and the next start re-attaches it
+  if job.prompt_state is not None and job.prompt_state.done:
+    return
+  try:
+    outcome = await job.backend.cancel_prompt(job.prompt_id)
+  except Exception as e:
+    logger.warning("Could not cancel prompt %s of job %s: %s", job.prompt_id, job.id, e)
+    return
+  if outcome:
+    logger.info("Prompt %s of job %s %s on %s", job.prompt_id, job.id, outcome, job.backend.host)
+
+# Utility: Record a job's ComfyUI queue wait and execution time
+def observe_prompt_stages(job: Job):
+  """Record queue_wait (submitted to execution start) and execution (start to finish) stages."""
+  state = job.prompt_state
+  if state is None or state.started is None:
+    return
+  metrics.observe_stage("queue_wait", state.started - state.created)
+  if state.finished is not None:
+    metrics.observe_stage("execution", state.finished - state.started)
+
+# Utility: Label a job's stage metrics with its endpoint and workflow file
+def label_job_metrics(job: Job, template: WorkflowTemplate):
+  """Set the endpoint/workflow labels for every stage the job's task records."""
+  job.workflow_file = template.name
+  metrics.set_job_labels(job.endpoint, template.name)
+
+# Utility: Download one output file from a ComfyUI backend
+async def fetch_output(backend, output: dict):
+  """Yield the bytes of an output entry from the backend's /view."""
+  upstream = await backend.open_view(output)
+  try:
+    upstream.raise_for_status()
+    async for chunk in upstream.aiter_bytes():
+      yield chunk
+  finally:
+    await upstream.aclose()
+
+# Utility: Copy a prompt's outputs into the result cache directory
+async def cache_output_files(key: str, prompt_id: str):
+  """Download every output of a finished prompt into the on-disk result cache."""
+  backend = await comfy_pool.find(prompt_id)
+  outputs = await get_prompt_outputs(prompt_id)
+  if backend is None or not outputs:
+    return
+  await result_cache.store_files(key, outputs, lambda output: fetch_output(backend, output))
+
+# Utility: Download a whole output into the output cache in the background
+def schedule_output_fill(prompt_id: str, ref: str, output: dict, backend):
+  """Cache an output whose client only asked for a byte range, so the next fetch is local."""
+  task = asyncio.get_running_loop().create_task(
+    output_cache.fill(prompt_id, ref, output["filename"], fetch_output(backend, output)))
+  cache_tasks.add(task)
+  task.add_done_callback(cache_tasks.discard)
+
+# Job runner: make one delivery variant (runs as a background task, see schedule_delivery_variant)
+async def make_delivery_variant(prompt_id: str, node_id: str, filename: str, variant: str,
+                                output: Optional[dict] = None) -> Optional[str]:
+  """Return the path of an output's delivery variant, making it first if needed (None if it can't be made).
+  The original is downloaded into the output cache first if needed; the
+  variant is then made once by the delivery workers and cached next to it.
+  """
+  ref = output_ref(node_id, filename)
+  entry = output_cache.get(prompt_id, ref, variant)
+  if entry is not None:
+    return entry["path"]
+  key = (prompt_id, ref, variant)
+  plan = delivery.plan(filename)
+  if plan is None:
+    return None
+  kind, extension = plan
+  original = output_cache.get(prompt_id, ref)
+  if original is None:
+    output = output or await find_output(prompt_id, node_id, filename)
+    backend = await comfy_pool.find(prompt_id)
+    if output is None or backend is None:
+      return None
+    await output_cache.fill(prompt_id, ref, filename, fetch_output(backend, output))
+    original = output_cache.get(prompt_id, ref)
+    if original is None:
+      return None
+  name = os.path.splitext(filename)[0] + extension
+  try:
+    entry = await output_cache.derive(prompt_id, ref, variant, name,
+                                      lambda target: delivery.transcode(kind, original["path"], target))
+  except Exception as e:
+    logger.warning("No %s variant of output %s/%s/%s, delivering the original: %s", variant, prompt_id, node_id, filename, e)
+    delivery.remember_failure(key)
+    return None
+  return entry["path"] if entry else None
+
+# Utility: Start making an output's delivery variant in the background
+def schedule_delivery_variant(prompt_id: str, node_id: str, filename: str, variant: str,
+                              output: Optional[dict] = None) -> Optional[asyncio.Task]:
+  """Return the task making a delivery variant, starting it unless one is running.
+  Returns:
+    The task (its result is the variant's path, or None), or None if the variant can't be made
+  """
+  key = (prompt_id, output_ref(node_id, filename), variant)
+  task = variant_tasks.get(key)
+  if task is not None:
+    return task
+  if not delivery.enabled or key in delivery.failed or delivery.plan(filename) is None:
+    return None
+  task = asyncio.get_running_loop().create_task(make_delivery_variant(prompt_id, node_id, filename, variant, output))
+  variant_tasks[key] = task
+
+  def done(finished):
+    variant_tasks.pop(key, None)
+    if not finished.cancelled() and finished.exception() is not None:
+      logger.warning("Could not make %s variant of %s/%s/%s: %s", variant, prompt_id, node_id, filename, finished.exception())
+
+  task.add_done_callback(done)
+  return task
+
+# Utility: Start the delivery variants of a finished prompt's saved outputs
+async def prepare_delivery_variants(prompt_id: str):
+  """Make delivery variants ahead of the client's download (temp previews are skipped)."""
+  for output in await get_prompt_outputs(prompt_id) or []:
+    if output["type"] == "output":
+      for variant in VARIANTS:
+        schedule_delivery_variant(prompt_id, output["node_id"], output["filename"], variant, output)
+
+# Utility: Local path of an output's delivery variant, if it is ready (soon enough)
+async def delivery_variant_path(prompt_id: str, node_id: str, filename: str, variant: str,
+                                output: Optional[dict] = None) -> Optional[str]:
+  """Return the cached delivery variant of an output, or None to deliver the original instead.
+  A variant still being made (or not started yet) is waited for at most
+  DELIVERY_WAIT seconds, so a long video transcode never holds a request;
+  it carries on in the background and later fetches get the variant.
+  """
+  entry = output_cache.get(prompt_id, output_ref(node_id, filename), variant)
+  if entry is not None:
+    return entry["path"]
+  task = schedule_delivery_variant(prompt_id, node_id, filename, variant, output)
+  if task is None:
+    return None
+  try:
+    return await asyncio.wait_for(asyncio.shield(task), DELIVERY_WAIT)
+  except asyncio.TimeoutError:
+    logger.info("%s variant of %s/%s/%s not ready yet, delivering the original", variant, prompt_id, node_id, filename)
+    return None
+
+# Utility: Resolve a requested text-to-image workflow file inside WORKFLOWS_DIR
+def resolve_t2i_workflow_path(workflow: Optional[str]) -> str:
+  """Return the path of the requested workflow, or the default one if it is missing or unsafe."""
   workflow_path = DEFAULT_WORKFLOW_PATH
-  if req.workflow:
-    candidate_path = os.path.join(WORKFLOWS_DIR, req.workflow)
+  if workflow:
+    candidate_path = os.path.join(WORKFLOWS_DIR, workflow)
     # Normalize and ensure the candidate path stays within WORKFLOWS_DIR
     base_dir = os.path.abspath(os.path.normpath(WORKFLOWS_DIR))
     safe_candidate_path = os.path.abspath(os.path.normpath(candidate_path))
     if safe_candidate_path == base_dir or safe_candidate_path.startswith(base_dir + os.sep):
       if os.path.isfile(safe_candidate_path):
         workflow_path = safe_candidate_path
-        logger.info("Using workflow: %s", req.workflow)
+        logger.info("Using workflow: %s", workflow)
       else:
         logger.warning("Workflow file not found: %s, using default.", safe_candidate_path)
     else:
@@ -255,138 +656,218 @@ async def receive_dream(req: DreamRequest):
       )
   else:
     logger.info("No workflow specified, using default.")
-  base_workflow = load_workflow(workflow_path)
-  payload = build_workflow(req.prompt, base_workflow)
-  # Generate client_id to track this request via WebSocket
-  client_id = str(uuid.uuid4())
-  payload["client_id"] = client_id
+  return workflow_path
+
+# Job runner: text-to-image generation
+async def run_dream_job(job: Job):
+  """Run a text-to-image job and return the /dream response dict."""
+  req = job.params["request"]
+  logger.info("Prompt received: '%s'", req.prompt)
+  base_workflow = workflow_registry.get(resolve_t2i_workflow_path(req.workflow))
+  label_job_metrics(job, base_workflow)
+  if job.prompt_id is not None:
+    return dream_response(req.prompt, await resume_job(job, wait_for_image_generation))
+  payload = build_workflow(req.prompt, base_workflow, req.seed)
+
+  async def execute():
+    prompt_id = await queue_job_prompt(job, payload)
+    return await wait_for_image_generation(prompt_id)
+
   try:
-    resp = requests.post(f"{COMFYUI_API}/prompt", json=payload, timeout=10)
-    resp.raise_for_status()
-    result = resp.json()
-    prompt_id = result.get("prompt_id")
-    if not prompt_id:
-      logger.warning("No prompt_id from ComfyUI!")
-      return {"status": "error", "message": "No prompt_id from ComfyUI!", "echo": req.prompt}
+    image_url = await run_workflow(job, payload, execute)
+  except ComfyUIError as e:
+    logger.warning("%s", e)
+    return {"status": "error", "message": str(e), "echo": req.prompt}
   except Exception as e:
     logger.error("Error reaching ComfyUI: %s", e)
     return {"status": "error", "message": f"Error reaching ComfyUI: {e}", "echo": req.prompt}
-  image_url = wait_for_image_generation(prompt_id, client_id)
+  return dream_response(req.prompt, image_url)
+
+# Utility: Build the /dream response for a finished text-to-image job
+def dream_response(prompt: str, image_url: Optional[str]) -> dict:
   if image_url:
     return {
       "status": "success",
-      "echo": req.prompt,
+      "echo": prompt,
       "image_url": image_url,
       "message": "✨ Art conjured! A dragon (or maybe a truck) awaits ye at the image URL."
     }
   else:
     return {
       "status": "error",
-      "echo": req.prompt,
+      "echo": prompt,
       "message": "Arrr, no image from ComfyUI—checked the queue and the mists of history. Only goblins. Try again?"
     }
 
-# Endpoint: /img2img - image-to-image generation
-@app.post("/img2img")
-async def receive_img2img(req: Img2ImgRequest):
-  logger.info("img2img request received with prompt: '%s'", req.prompt)
+# Job runner: batched text-to-image generation
+async def run_dream_batch_job(job: Job):
+  """Run a batched text-to-image job and return the /dream/batch response dict.
+  All images share one latent batch, so the prompt is encoded and the model
+  dispatched once for the whole batch.
+  """
+  req = job.params["request"]
+  logger.info("Batch prompt received (%d images): '%s'", req.count, req.prompt)
+  base_workflow = workflow_registry.get(resolve_t2i_workflow_path(req.workflow))
+  label_job_metrics(job, base_workflow)
+
+  async def wait(prompt_id: str):
+    return await wait_for_all_images(prompt_id, timeout=WS_IMAGE_TIMEOUT * req.count)
+
+  if job.prompt_id is not None:
+    return dream_batch_response(req.prompt, await resume_job(job, wait))
   try:
-    image_data = base64.b64decode(req.image_data)
-  except Exception as e:
-    logger.error("Error decoding img2img image: %s", e)
-    return {"status": "error", "message": f"Error decoding image: {e}", "echo": req.prompt}
-  image_filename = f"input_img2img_{uuid.uuid4().hex}.png"
+    payload = build_workflow(req.prompt, base_workflow, req.seed, batch_size=req.count)
+  except ValueError as e:
+    logger.error("Error building batch workflow: %s", e)
+    return {"status": "error", "message": f"Error building workflow: {e}", "echo": req.prompt}
+
+  async def execute():
+    return await wait(await queue_job_prompt(job, payload))
+
   try:
-    files = {
-      'image': (image_filename, image_data, 'image/png'),
-      'overwrite': (None, 'true')
-    }
-    upload_resp = requests.post(f"{COMFYUI_API}/upload/image", files=files, timeout=30)
-    upload_resp.raise_for_status()
-    upload_result = upload_resp.json()
-    logger.info("Image uploaded to ComfyUI: %s", upload_result)
+    image_urls = await run_workflow(job, payload, execute)
+  except ComfyUIError as e:
+    logger.warning("%s (for batch)", e)
+    return {"status": "error", "message": str(e), "echo": req.prompt}
   except Exception as e:
-    logger.error("Error uploading img2img image to ComfyUI: %s", e)
-    return {"status": "error", "message": f"Error uploading image to ComfyUI: {e}", "echo": req.prompt}
-  base_workflow = load_workflow(IMG2IMG_WORKFLOW_PATH)
+    logger.error("Error reaching ComfyUI for batch: %s", e)
+    return {"status": "error", "message": f"Error reaching ComfyUI: {e}", "echo": req.prompt}
+  return dream_batch_response(req.prompt, image_urls)
+
+# Utility: Build the /dream/batch response for a finished batched text-to-image job
+def dream_batch_response(prompt: str, image_urls: list) -> dict:
+  if image_urls:
+    return {
+      "status": "success",
+      "echo": prompt,
+      "image_url": image_urls[0],
+      "image_urls": image_urls,
+      "message": f"✨ {len(image_urls)} visions conjured in one spell! Pick yer favourite from the image URLs."
+    }
+  else:
+    return {
+      "status": "error",
+      "echo": prompt,
+      "message": "Arrr, no images from ComfyUI—checked the queue and the mists of history. Only goblins. Try again?"
+    }
+
+# Job runner: image-to-image generation
+async def run_img2img_job(job: Job):
+  """Run an image-to-image job and return the /img2img response dict."""
+  req = job.params["request"]
+  logger.info("img2img request received with prompt: '%s'", req.prompt)
+  base_workflow = workflow_registry.get(IMG2IMG_WORKFLOW_PATH)
+  label_job_metrics(job, base_workflow)
+  if job.prompt_id is not None:
+    return img2img_response(req.prompt, await resume_job(job, wait_for_image_generation))
+  # Multipart uploads arrive already on a backend; base64 images are uploaded when the job runs
+  image_data = digest = content_type = None
+  image_filename = job.params.get("image_filename")
+  if image_filename is not None:
+    job.backend = job.params["backend"]
+  else:
+    try:
+      with metrics.stage("decode"):
+        image_data = base64.b64decode(req.image_data)
+    except Exception as e:
+      logger.error("Error decoding img2img image: %s", e)
+      return {"status": "error", "message": f"Error decoding image: {e}", "echo": req.prompt}
+    try:
+      image_data, content_type, digest, image_filename = await prepare_input_image(image_data, base_workflow)
+    except ValueError as e:
+      logger.error("Error decoding img2img image: %s", e)
+      return {"status": "error", "message": f"Error decoding image: {e}", "echo": req.prompt}
   try:
-    payload = build_img2img_workflow(req.prompt, image_filename, base_workflow)
+    payload = build_img2img_workflow(req.prompt, image_filename, base_workflow, req.seed)
   except Exception as e:
     logger.error("Error building img2img workflow: %s", e)
     return {"status": "error", "message": f"Error building workflow: {e}", "echo": req.prompt}
-  # Generate client_id to track this request via WebSocket
-  client_id = str(uuid.uuid4())
-  payload["client_id"] = client_id
+
+  async def execute():
+    upload = (digest, image_data, content_type) if image_data is not None else None
+    prompt_id = await queue_image_job_prompt(job, payload, image_filename, upload)
+    return await wait_for_image_generation(prompt_id)
+
   try:
-    resp = requests.post(f"{COMFYUI_API}/prompt", json=payload, timeout=10)
-    resp.raise_for_status()
-    result = resp.json()
-    prompt_id = result.get("prompt_id")
-    if not prompt_id:
-      logger.warning("No prompt_id from ComfyUI for img2img!")
-      return {"status": "error", "message": "No prompt_id from ComfyUI!", "echo": req.prompt}
+    image_url = await run_workflow(job, payload, execute)
+  except ComfyUIError as e:
+    logger.warning("%s (for img2img)", e)
+    return {"status": "error", "message": str(e), "echo": req.prompt}
   except Exception as e:
     logger.error("Error reaching ComfyUI for img2img: %s", e)
     return {"status": "error", "message": f"Error reaching ComfyUI: {e}", "echo": req.prompt}
-  image_url = wait_for_image_generation(prompt_id, client_id)
+  return img2img_response(req.prompt, image_url)
+
+# Utility: Build the /img2img response for a finished image-to-image job
+def img2img_response(prompt: str, image_url: Optional[str]) -> dict:
   if image_url:
     return {
       "status": "success",
-      "echo": req.prompt,
+      "echo": prompt,
       "image_url": image_url,
       "message": "✨ Image transformed! Your modified masterpiece awaits at the image URL."
     }
   else:
     return {
       "status": "error",
-      "echo": req.prompt,
+      "echo": prompt,
       "message": "Arrr, no image from ComfyUI—checked the queue and the mists of history. Only goblins. Try again?"
     }
 
-# Endpoint: /img2vid - image-to-video generation
-@app.post("/img2vid")
-async def receive_img2vid(req: Img2VidRequest):
+# Job runner: image-to-video generation
+async def run_img2vid_job(job: Job):
+  """Run an image-to-video job and return the /img2vid response dict."""
+  req = job.params["request"]
   logger.info("img2vid request received with prompt: '%s'", req.prompt)
+  base_workflow = workflow_registry.get(IMG2VID_WORKFLOW_PATH)
+  label_job_metrics(job, base_workflow)
+
+  async def wait(prompt_id: str):
+    # Wait for video generation with extended timeout and get both video and last frame
+    outputs = await wait_for_video_generation(prompt_id, include_last_frame=True)
+    return outputs if outputs.get("video_url") else None
+
+  if job.prompt_id is not None:
+    return img2vid_response(await resume_job(job, wait) or {})
+  # Multipart uploads arrive already on a backend; base64 images are uploaded when the job runs
+  image_data = digest = content_type = None
+  image_filename = job.params.get("image_filename")
+  if image_filename is not None:
+    job.backend = job.params["backend"]
+  else:
+    try:
+      with metrics.stage("decode"):
+        image_data = base64.b64decode(req.image_data)
+    except Exception as e:
+      logger.error("Error decoding img2vid image: %s", e)
+      return {"status": "error", "message": f"Error decoding image: {e}"}
+    try:
+      image_data, content_type, digest, image_filename = await prepare_input_image(image_data, base_workflow)
+    except ValueError as e:
+      logger.error("Error decoding img2vid image: %s", e)
+      return {"status": "error", "message": f"Error decoding image: {e}"}
   try:
-    image_data = base64.b64decode(req.image_data)
-  except Exception as e:
-    logger.error("Error decoding img2vid image: %s", e)
-    return {"status": "error", "message": f"Error decoding image: {e}"}
-  image_filename = f"input_img2vid_{uuid.uuid4().hex}.png"
-  try:
-    files = {
-      'image': (image_filename, image_data, 'image/png'),
-      'overwrite': (None, 'true')
-    }
-    upload_resp = requests.post(f"{COMFYUI_API}/upload/image", files=files, timeout=30)
-    upload_resp.raise_for_status()
-    upload_result = upload_resp.json()
-    logger.info("Image uploaded for img2vid: %s", upload_result)
-  except Exception as e:
-    logger.error("Error uploading img2vid image to ComfyUI: %s", e)
-    return {"status": "error", "message": f"Error uploading image to ComfyUI: {e}"}
-  base_workflow = load_workflow(IMG2VID_WORKFLOW_PATH)
-  try:
-    payload = build_img2vid_workflow(image_filename, req.prompt, base_workflow)
+    payload = build_img2vid_workflow(image_filename, req.prompt, base_workflow, req.seed)
   except Exception as e:
     logger.error("Error building img2vid workflow: %s", e)
     return {"status": "error", "message": f"Error building workflow: {e}"}
-  # Generate client_id to track this request via WebSocket
-  client_id = str(uuid.uuid4())
-  payload["client_id"] = client_id
+
+  async def execute():
+    upload = (digest, image_data, content_type) if image_data is not None else None
+    return await wait(await queue_image_job_prompt(job, payload, image_filename, upload))
+
   try:
-    resp = requests.post(f"{COMFYUI_API}/prompt", json=payload, timeout=10)
-    resp.raise_for_status()
-    result = resp.json()
-    prompt_id = result.get("prompt_id")
-    if not prompt_id:
-      logger.warning("No prompt_id from ComfyUI for img2vid!")
-      return {"status": "error", "message": "No prompt_id from ComfyUI!"}
+    outputs = await run_workflow(job, payload, execute) or {}
+  except ComfyUIError as e:
+    logger.warning("%s (for img2vid)", e)
+    return {"status": "error", "message": str(e)}
   except Exception as e:
     logger.error("Error reaching ComfyUI for img2vid: %s", e)
     return {"status": "error", "message": f"Error reaching ComfyUI: {e}"}
-  # Wait for video generation with extended timeout and get both video and last frame
-  outputs = wait_for_video_generation(prompt_id, client_id, include_last_frame=True)
+  return img2vid_response(outputs)
+
+# Utility: Build the /img2vid response for a finished image-to-video job
+def img2vid_response(outputs: dict) -> dict:
   video_url = outputs.get("video_url")
   last_frame_url = outputs.get("last_frame_url")
   if video_url:
@@ -405,178 +886,660 @@ async def receive_img2vid(req: Img2VidRequest):
       "message": "Arrr, no video from ComfyUI—the animation eluded us. Try again, brave wizard?"
     }
 
+# Job runners by job type, used by POST /jobs and the blocking endpoints
+JOB_RUNNERS = {
+  "t2i": run_dream_job,
+  "i2i": run_img2img_job,
+  "i2v": run_img2vid_job,
+}
+
+# Job runners by function name, to resume jobs restored from the job store
+JOB_RUNNERS_BY_NAME = {runner.__name__: runner for runner in (run_dream_job, run_dream_batch_job, run_img2img_job, run_img2vid_job)}
+
+# Utility: Collect the outputs of a job restored after a restart
+async def resume_job(job: Job, wait):
+  """Re-attach a restored job to its ComfyUI prompt and return `await wait(prompt_id)`.
+  The prompt was queued by an earlier server process, so the job takes no
+  scheduler slot and skips the result cache.
+  Args:
+    job: Job restored by restore_jobs(), with prompt_id and backend set
+    wait: Coroutine function waiting for the prompt and collecting its outputs
+  """
+  try:
+    if job.prompt_state is None:
+      try:
+        job.prompt_state = await job.backend.events.reattach(job.prompt_id)
+      except Exception as e:
+        # The listener re-checks /history once it connects
+        logger.warning("Could not check prompt %s on %s: %s", job.prompt_id, job.backend.host, e)
+        job.prompt_state = job.backend.events.track(job.prompt_id)
+        job.prompt_state.events_missed = True
+      job.prompt_state.subscribe(job.on_prompt_event)
+      logger.info("Job %s re-attached to prompt %s on %s (%s)", job.id, job.prompt_id, job.backend.host,
+                  job.prompt_state.status)
+    return await wait(job.prompt_id)
+  except asyncio.CancelledError:
+    await asyncio.shield(stop_job_prompt(job))
+    raise
+
+# Utility: Restore the stored jobs of earlier server processes
+async def restore_jobs():
+  """Load the job store into the job manager.
+  Finished jobs stay available at GET /jobs/{id}. Unfinished jobs whose prompt
+  reached ComfyUI are re-attached to it; the rest are failed, since inputs
+  such as base64 images are not stored and cannot be resubmitted.
+  """
+  resumed = failed = 0
+  for job in await job_store.load(jobs.max_finished, comfy_pool.get):
+    if job.prompt_id is not None and job.backend is not None:
+      comfy_pool.remember(job.prompt_id, job.backend)
+    if job.done:
+      jobs.adopt(job)
+      continue
+    runner = JOB_RUNNERS_BY_NAME.get(job.runner)
+    model = REQUEST_MODELS.get((job.stored_params or {}).get("model"))
+    if job.prompt_id is None:
+      reason = "The API server restarted before this job reached ComfyUI, please submit it again"
+    elif job.backend is None:
+      reason = "The ComfyUI backend of this job is no longer configured"
+    elif runner is None or model is None:
+      reason = f"Cannot resume job runner '{job.runner}'"
+    else:
+      # Only the request's text fields are stored; the image is already on ComfyUI
+      job.params = {"request": model(**{"image_data": "", **job.stored_params["fields"]})}
+      jobs.adopt(job, runner)
+      resumed += 1
+      continue
+    job.status = "error"
+    job.result = {"status": "error", "message": reason}
+    job.finished = time.time()
+    jobs.adopt(job)
+    jobs.save(job)
+    failed += 1
+  if resumed or failed:
+    logger.info("Restored jobs: %d re-attached to their ComfyUI prompts, %d failed", resumed, failed)
+
+# Utility: Find how many prompts are ahead of ours in the ComfyUI queue
+async def get_queue_position(prompt_id: str):
+  """Return the number of prompts ahead of `prompt_id` in ComfyUI's queue.
+  Returns:
+    0 if the prompt is running, N if N prompts run before it, None if it is not queued
+  """
+  backend = await comfy_pool.find(prompt_id)
+  if backend is None:
+    return None
+  try:
+    queue = await backend.get_queue()
+  except Exception as e:
+    logger.warning("Could not fetch ComfyUI queue: %s", e)
+    return None
+  running = queue.get("queue_running", [])
+  if any(item[1] == prompt_id for item in running):
+    return 0
+  # Pending items are [number, prompt_id, ...]; lower numbers run first
+  pending = sorted(queue.get("queue_pending", []), key=lambda item: item[0])
+  for index, item in enumerate(pending):
+    if item[1] == prompt_id:
+      return len(running) + index
+  return None
+
+# Utility: Find how many prompts are ahead of a job, including scheduler waits
+async def job_queue_position(job: Job):
+  """Return the number of prompts ahead of an unfinished job.
+  Jobs still waiting for a scheduler slot count every granted slot plus the
+  waiting jobs that go before them; submitted jobs ask ComfyUI.
+  """
+  if job.prompt_id:
+    return await get_queue_position(job.prompt_id)
+  position = scheduler.position(job)
+  if position is None:
+    return None
+  return scheduler.inflight() + position
+
+# Utility: Resolve and validate a request's scheduler priority class
+def job_priority(kind: str, req) -> str:
+  """Return the request's priority class (or the default for `kind`).
+  Raises:
+    HTTPException: 400 for an unknown priority class
+  """
+  priority = req.priority or DEFAULT_PRIORITY[kind]
+  if priority not in PRIORITY_CLASSES:
+    raise HTTPException(status_code=400, detail=f"Unknown priority '{priority}', expected one of {', '.join(PRIORITY_CLASSES)}")
+  return priority
+
+# Utility: Submit a request model as a job, with its scheduling options
+def submit_request(kind: str, runner, req, endpoint: str, **params) -> Job:
+  """Submit `req`, received on `endpoint`, as a job of `kind`.
+  Raises:
+    HTTPException: 400 for an unknown priority class
+    JobRejected: if the job type is at its admission limit
+  """
+  # Stored for resuming after a restart: the text fields only (images are on ComfyUI by then)
+  fields = {name: value for name, value in vars(req).items() if name != "image_data"}
+  return jobs.submit(kind, runner, user_id=req.user_id, priority=job_priority(kind, req), endpoint=endpoint,
+                     stored_params={"model": type(req).__name__, "fields": fields}, request=req, **params)
+
+# Utility: Wait until the client of a request disconnects
+async def wait_for_disconnect(request: Request):
+  """Return once the client goes away (the request body must already have been read)."""
+  while True:
+    message = await request.receive()
+    if message["type"] == "http.disconnect":
+      return
+
+# Utility: Wait for a job on behalf of a blocking request, cancelling it if the client leaves
+async def wait_for_client(job: Job, request: Request) -> dict:
+  """Return the job's result, or cancel the job if the client disconnects first.
+  Only the blocking endpoints do this: nobody is left to collect their result,
+  while POST /jobs callers may come back for theirs.
+  """
+  disconnected = asyncio.ensure_future(wait_for_disconnect(request))
+  try:
+    await asyncio.wait({job.task, disconnected}, return_when=asyncio.FIRST_COMPLETED)
+  finally:
+    disconnected.cancel()
+  if not job.done and disconnected.done() and not disconnected.cancelled():
+    jobs.cancel(job, "client disconnected")
+  return await jobs.wait(job)
+
+# Endpoint: /dream - text-to-image generation (waits for the job to finish)
+@app.post("/dream")
+async def receive_dream(req: DreamRequest, request: Request):
+  return await wait_for_client(submit_request("t2i", run_dream_job, req, "/dream"), request)
+
+# Utility: Reject batch sizes outside 1..DREAM_BATCH_MAX
+def check_batch_count(count: int):
+  """Raise a 400 error unless 1 <= count <= DREAM_BATCH_MAX."""
+  if not 1 <= count <= DREAM_BATCH_MAX:
+    raise HTTPException(status_code=400, detail=f"count must be between 1 and {DREAM_BATCH_MAX}")
+
+# Endpoint: /dream/batch - several text-to-image results from one latent batch (waits for the job)
+@app.post("/dream/batch")
+async def receive_dream_batch(req: DreamBatchRequest, request: Request):
+  check_batch_count(req.count)
+  return await wait_for_client(submit_request("t2i", run_dream_batch_job, req, "/dream/batch"), request)
+
+# Endpoint: /img2img - image-to-image generation (waits for the job to finish)
+@app.post("/img2img")
+async def receive_img2img(req: Img2ImgRequest, request: Request):
+  return await wait_for_client(submit_request("i2i", run_img2img_job, req, "/img2img"), request)
+
+# Endpoint: /img2vid - image-to-video generation (waits for the job to finish)
+@app.post("/img2vid")
+async def receive_img2vid(req: Img2VidRequest, request: Request):
+  return await wait_for_client(submit_request("i2v", run_img2vid_job, req, "/img2vid"), request)
+
+# Utility: Hash a multipart image upload and stream it to a ComfyUI backend
+async def upload_form_image(image: UploadFile, kind: str, endpoint: str):
+  """Place a multipart image upload on the least-loaded backend.
+  The file is hashed in chunks, then normalized for the workflow from
+  FastAPI's spooled temp file (see prepare_input_image); an image left as
+  it is gets streamed to ComfyUI from that file, never read whole into
+  memory. Images the backend already has (same content hash) are not sent again.
+  Args:
+    image: The uploaded file
+    kind: Job type the image is for ("i2i" or "i2v")
+    endpoint: Endpoint receiving the upload (metrics label)
+  Returns:
+    (backend, image_filename) for the job's params
+  Raises:
+    HTTPException: 400 for an empty or unreadable upload, 502 if ComfyUI rejects it
+  """
+  hasher = hashlib.sha256()
+  size = 0
+  while True:
+    chunk = await image.read(UPLOAD_CHUNK_SIZE)
+    if not chunk:
+      break
+    hasher.update(chunk)
+    size += len(chunk)
+  if not size:
+    raise HTTPException(status_code=400, detail="Empty image upload")
+  metrics.set_job_labels(endpoint, os.path.basename(IMAGE_WORKFLOW_PATHS[kind]))
+  await image.seek(0)
+  try:
+    image_data, content_type, digest, image_filename = await prepare_input_image(
+      image.file, workflow_registry.get(IMAGE_WORKFLOW_PATHS[kind]), hasher.hexdigest())
+  except ValueError as e:
+    raise HTTPException(status_code=400, detail=str(e)) from e
+  if isinstance(image_data, bytes):
+    size = len(image_data)
+  backend = comfy_pool.pick()
+  try:
+    with metrics.stage("upload"):
+      uploaded = await backend.ensure_input_image(digest, image_filename, image_data, content_type)
+  except Exception as e:
+    logger.error("Error uploading image to ComfyUI (%s): %s", backend.host, e)
+    raise HTTPException(status_code=502, detail=f"Error uploading image to ComfyUI: {e}") from e
+  logger.info("Image %s (%d bytes) %s %s", image_filename, size, "uploaded to" if uploaded else "already on", backend.host)
+  return backend, image_filename
+
+# Endpoint: /img2img/upload - image-to-image generation from a multipart upload (waits for the job)
+@app.post("/img2img/upload")
+async def receive_img2img_upload(request: Request, image: UploadFile = File(...), prompt: str = Form(...),
+                                 seed: Optional[int] = Form(None), user_id: Optional[str] = Form(None),
+                                 priority: Optional[str] = Form(None)):
+  form = ImageJobForm(prompt=prompt, seed=seed, user_id=user_id, priority=priority)
+  # Reject before uploading to ComfyUI (FastAPI has already received and spooled the body by now)
+  job_priority("i2i", form)
+  jobs.admit("i2i")
+  backend, image_filename = await upload_form_image(image, "i2i", "/img2img/upload")
+  return await wait_for_client(submit_request("i2i", run_img2img_job, form, "/img2img/upload",
+                                             image_filename=image_filename, backend=backend), request)
+
+# Endpoint: /img2vid/upload - image-to-video generation from a multipart upload (waits for the job)
+@app.post("/img2vid/upload")
+async def receive_img2vid_upload(request: Request, image: UploadFile = File(...), prompt: str = Form(""),
+                                 seed: Optional[int] = Form(None), user_id: Optional[str] = Form(None),
+                                 priority: Optional[str] = Form(None)):
+  form = ImageJobForm(prompt=prompt, seed=seed, user_id=user_id, priority=priority)
+  # Reject before uploading to ComfyUI (FastAPI has already received and spooled the body by now)
+  job_priority("i2v", form)
+  jobs.admit("i2v")
+  backend, image_filename = await upload_form_image(image, "i2v", "/img2vid/upload")
+  return await wait_for_client(submit_request("i2v", run_img2vid_job, form, "/img2vid/upload",
+                                             image_filename=image_filename, backend=backend), request)
+
+# Endpoint: POST /jobs - submit a generation job and return its id immediately
+@app.post("/jobs")
+async def submit_job(req: JobRequest):
+  if req.type not in JOB_RUNNERS:
+    raise HTTPException(status_code=400, detail=f"Unknown job type '{req.type}', expected one of {', '.join(JOB_KINDS)}")
+  runner = JOB_RUNNERS.get(req.type)
+  options = {"seed": req.seed, "user_id": req.user_id, "priority": req.priority}
+  if req.type == "t2i" and req.count != 1:
+    check_batch_count(req.count)
+    request = DreamBatchRequest(prompt=req.prompt, workflow=req.workflow, count=req.count, **options)
+    runner = run_dream_batch_job
+  elif req.type == "t2i":
+    request = DreamRequest(prompt=req.prompt, workflow=req.workflow, **options)
+  elif not req.image_data:
+    raise HTTPException(status_code=400, detail=f"Job type '{req.type}' requires image_data")
+  elif req.type == "i2i":
+    request = Img2ImgRequest(prompt=req.prompt, image_data=req.image_data, **options)
+  else:
+    request = Img2VidRequest(prompt=req.prompt, image_data=req.image_data, **options)
+  job = submit_request(req.type, runner, request, "/jobs")
+  return {"status": "queued", "job_id": job.id, "message": f"🗺️ Quest accepted! Check back at /jobs/{job.id}."}
+
+# Endpoint: POST /jobs/upload - submit an i2i/i2v job with a multipart image upload
+@app.post("/jobs/upload")
+async def submit_upload_job(type: str = Form(...), image: UploadFile = File(...), prompt: str = Form(""),
+                            seed: Optional[int] = Form(None), user_id: Optional[str] = Form(None),
+                            priority: Optional[str] = Form(None)):
+  if type not in ("i2i", "i2v"):
+    raise HTTPException(status_code=400, detail=f"Job type '{type}' does not take an image upload, expected i2i or i2v")
+  form = ImageJobForm(prompt=prompt, seed=seed, user_id=user_id, priority=priority)
+  # Reject before uploading to ComfyUI (FastAPI has already received and spooled the body by now)
+  job_priority(type, form)
+  jobs.admit(type)
+  backend, image_filename = await upload_form_image(image, type, "/jobs/upload")
+  job = submit_request(type, JOB_RUNNERS[type], form, "/jobs/upload", image_filename=image_filename, backend=backend)
+  return {"status": "queued", "job_id": job.id, "message": f"🗺️ Quest accepted! Check back at /jobs/{job.id}."}
+
+# Endpoint: GET /jobs/{job_id} - job status, queue position and outputs
+@app.get("/jobs/{job_id}")
+async def get_job(job_id: str):
+  job = jobs.get(job_id)
+  if job is None:
+    raise HTTPException(status_code=404, detail="Job not found")
+  info = job.to_dict()
+  if not job.done:
+    info["queue_position"] = await job_queue_position(job)
+  return info
+
+# Endpoint: DELETE /jobs/{job_id} - cancel a job and stop its ComfyUI prompt
+@app.delete("/jobs/{job_id}")
+async def cancel_job(job_id: str):
+  job = jobs.get(job_id)
+  if job is None:
+    raise HTTPException(status_code=404, detail="Job not found")
+  if jobs.cancel(job, "cancelled by request"):
+    # Returns once the prompt has been deleted from ComfyUI's queue or interrupted
+    await jobs.wait(job)
+  return job.to_dict()
+
+# Utility: Format one Server-Sent Events message
+def format_sse(event: str, data: dict) -> str:
+  """Format an event as a text/event-stream message."""
+  return f"event: {event}\ndata: {json.dumps(data)}\n\n"
+
+# Endpoint: GET /jobs/{job_id}/events - live progress stream (Server-Sent Events)
+@app.get("/jobs/{job_id}/events")
+async def stream_job_events(job_id: str):
+  job = jobs.get(job_id)
+  if job is None:
+    raise HTTPException(status_code=404, detail="Job not found")
+
+  async def event_stream():
+    queue = job.subscribe()
+    try:
+      # Start with a snapshot so late subscribers know where the job stands
+      snapshot = job.to_dict()
+      if job.done:
+        yield format_sse("done", snapshot)
+        return
+      snapshot["queue_position"] = await job_queue_position(job)
+      yield format_sse("status", snapshot)
+      while True:
+        try:
+          event, data = await asyncio.wait_for(queue.get(), SSE_QUEUE_POLL_INTERVAL)
+        except asyncio.TimeoutError:
+          # No events for a while: report queue position if still waiting, else keep the stream alive
+          if job.prompt_state is None or job.prompt_state.status == "pending":
+            yield format_sse("queue", {"queue_position": await job_queue_position(job)})
+          else:
+            yield ": keep-alive\n\n"
+          continue
+        yield format_sse(event, data)
+        if event == "done":
+          return
+    finally:
+      job.unsubscribe(queue)
+
+  return StreamingResponse(
+    event_stream(),
+    media_type="text/event-stream",
+    headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"},
+  )
+
+# Utility: Serve a local output file with Range and conditional request support
+def serve_local_file(request: Request, path: str, etag: str):
+  """Answer a GET for a file on local disk: 200, 206 (single range), 304 or 416.
+  Returns:
+    The response, or None if the file has disappeared (e.g. evicted meanwhile)
+  """
+  try:
+    f = open(path, "rb")
+    stat = os.fstat(f.fileno())
+  except OSError:
+    return None
+  headers = {"Accept-Ranges": "bytes", "ETag": etag, "Last-Modified": http_date(stat.st_mtime)}
+  if is_not_modified(request.headers, etag, stat.st_mtime):
+    f.close()
+    return Response(status_code=304, headers=headers)
+  try:
+    byte_range = parse_range(request.headers, stat.st_size, etag, stat.st_mtime)
+  except RangeNotSatisfiable:
+    f.close()
+    return Response(status_code=416, headers={**headers, "Content-Range": f"bytes */{stat.st_size}"})
+  status_code = 200
+  start, end = 0, stat.st_size - 1
+  if byte_range is not None:
+    status_code = 206
+    start, end = byte_range
+    headers["Content-Range"] = f"bytes {start}-{end}/{stat.st_size}"
+  headers["Content-Length"] = str(end - start + 1)
+  return StreamingResponse(
+    iter_file(f, start, end),
+    status_code=status_code,
+    media_type=mimetypes.guess_type(path)[0] or "application/octet-stream",
+    headers=headers,
+    background=BackgroundTask(f.close),
+  )
+
+# Utility: Serve one output of a prompt (local cache first, then ComfyUI)
+async def serve_output(request: Request, prompt_id: str, node_id: str, filename: str, variant: Optional[str] = None,
+                       output: Optional[dict] = None):
+  """Answer GET /outputs for the output `filename` of node `node_id`.
+  Args:
+    output: The output entry, if the caller already looked it up (saves a lookup on cache misses)
+  Raises:
+    HTTPException: 400 for an unknown variant, 404 if the prompt has no such output, 502 if ComfyUI is unreachable
+  """
+  ref = output_ref(node_id, filename)
+  if variant:
+    if variant not in VARIANTS:
+      raise HTTPException(status_code=400, detail=f"Unknown variant (use one of: {', '.join(VARIANTS)})")
+    # Delivery variant if one can be made, the original otherwise
+    path = await delivery_variant_path(prompt_id, node_id, filename, variant, output)
+    response = serve_local_file(request, path, output_etag(prompt_id, ref, variant)) if path else None
+    if response is not None:
+      return response
+  etag = output_etag(prompt_id, ref)
+  # Outputs fetched before (or kept by the result cache) are served from local disk
+  entry = output_cache.get(prompt_id, ref)
+  for path in (entry["path"] if entry else None, result_cache.file_for(prompt_id, ref)):
+    response = serve_local_file(request, path, etag) if path else None
+    if response is not None:
+      return response
+  output = output or await find_output(prompt_id, node_id, filename)
+  if output is None:
+    raise HTTPException(status_code=404, detail="Output not found")
+  if is_not_modified(request.headers, etag):
+    return Response(status_code=304, headers={"ETag": etag})
+  backend = await comfy_pool.find(prompt_id)
+  # Forward Range so large videos can be fetched in pieces and resumed (unless If-Range no longer matches)
+  headers = {}
+  if "range" in request.headers and request.headers.get("if-range", etag) == etag:
+    headers["Range"] = request.headers["range"]
+  try:
+    upstream = await backend.open_view(output, headers=headers)
+  except Exception as e:
+    logger.error("Error opening output %s/%s/%s from ComfyUI: %s", prompt_id, node_id, filename, e)
+    raise HTTPException(status_code=502, detail=f"Error reaching ComfyUI: {e}") from e
+  if upstream.status_code not in (200, 206):
+    await upstream.aclose()
+    raise HTTPException(status_code=upstream.status_code, detail="ComfyUI could not serve this output")
+  response_headers = {"Accept-Ranges": "bytes", "ETag": etag}
+  for name in ("Content-Length", "Content-Range", "Content-Encoding", "Last-Modified"):
+    if name in upstream.headers:
+      response_headers[name] = upstream.headers[name]
+  media_type = mimetypes.guess_type(output["filename"])[0] or upstream.headers.get("Content-Type", "application/octet-stream")
+  body = upstream.aiter_raw()
+  if output_cache.enabled and "Content-Encoding" not in upstream.headers:
+    if upstream.status_code == 200:
+      # One download feeds the client and the cache
+      length = upstream.headers.get("Content-Length")
+      body = output_cache.tee(prompt_id, ref, filename, body, int(length) if length else None)
+    elif output_cache.wants(prompt_id, ref):
+      schedule_output_fill(prompt_id, ref, output, backend)
+  return StreamingResponse(
+    body,
+    status_code=upstream.status_code,
+    media_type=media_type,
+    headers=response_headers,
+    background=BackgroundTask(upstream.aclose),
+  )
+
+# Endpoint: GET /outputs/{prompt_id}/{node_id}/{filename} - stream a generated file (local cache first, then ComfyUI)
+@app.get("/outputs/{prompt_id}/{node_id}/{filename}")
+async def stream_output(prompt_id: str, node_id: str, filename: str, request: Request, variant: Optional[str] = None):
+  return await serve_output(request, prompt_id, node_id, filename, variant)
+
+# Endpoint: GET /outputs/{prompt_id}/{index} - the same, by position in the prompt's output list (older URLs)
+@app.get("/outputs/{prompt_id}/{index}")
+async def stream_output_by_index(prompt_id: str, index: int, request: Request, variant: Optional[str] = None):
+  outputs = await get_prompt_outputs(prompt_id)
+  if not outputs or not 0 <= index < len(outputs):
+    raise HTTPException(status_code=404, detail="Output not found")
+  output = outputs[index]
+  return await serve_output(request, prompt_id, output["node_id"], output["filename"], variant, output)
+
+# Endpoint: GET /metrics - Prometheus metrics (stage latencies, queues, backends, cache)
+@app.get("/metrics")
+async def get_metrics():
+  return Response(metrics.registry.render(), media_type=metrics.CONTENT_TYPE)
+
+# Endpoint: GET /profile - per-node execution time (p50/p95) by workflow
+@app.get("/profile")
+async def get_profile(workflow: Optional[str] = None):
+  return {"workflows": profiler.summary(workflow)}
+
+# Endpoint: GET /backends - health and load of every ComfyUI backend
+@app.get("/backends")
+async def list_backends():
+  return {"backends": comfy_pool.status(), "scheduler": scheduler.status()}
+
 # Endpoint: / - root endpoint for health check
 @app.get("/")
 async def root():
   return {"message": "Welcome to Comfynaut GPU Wizardry Portal, now speaking true ComfyUI 'prompt' dialect!"}
 
 # Utility: Wait for execution completion using WebSocket (event-driven, no polling)
-def wait_for_execution_via_websocket(prompt_id: str, client_id: str, timeout: int = WS_IMAGE_TIMEOUT):
+async def wait_for_execution_via_websocket(prompt_id: str, timeout: int = WS_IMAGE_TIMEOUT):
   """Wait for ComfyUI execution completion using WebSocket (event-driven, no polling).
   This is more efficient than polling because:
   1. No wasted HTTP requests
   2. Immediate notification when execution completes
   3. Real-time progress tracking possible
+  All prompts share the backend's long-lived WebSocket listener, so there is no
+  per-job connect cost and no completion event is missed during a slow connect.
   Args:
     prompt_id: The prompt ID to wait for
-    client_id: The client ID used when queueing the prompt
     timeout: Maximum time to wait for execution in seconds
   Returns:
     True if execution completed successfully, False otherwise
   """
-  ws = None
   try:
-    ws_url = f"{COMFYUI_WS_URL}?clientId={client_id}"
-    logger.info("Connecting to ComfyUI WebSocket at %s", ws_url)
-    ws = websocket.create_connection(ws_url, timeout=WS_CONNECT_TIMEOUT)
-    ws.settimeout(WS_RECV_TIMEOUT)  # Set recv timeout to avoid blocking
-    start_time = time.time()
-    while True:
-      elapsed = time.time() - start_time
-      if elapsed > timeout:
-        logger.warning("WebSocket timeout after %ss waiting for prompt %s", timeout, prompt_id)
-        return False
-      try:
-        message = ws.recv()
-        if isinstance(message, str):
-          data = json.loads(message)
-          msg_type = data.get("type")
-          msg_data = data.get("data", {})
-          if msg_type == "executing":
-            current_node = msg_data.get("node")
-            current_prompt_id = msg_data.get("prompt_id")
-            # When node is None and prompt_id matches, execution is complete
-            if current_node is None and current_prompt_id == prompt_id:
-              logger.info("Execution completed for prompt %s (took %.1fs)", prompt_id, elapsed)
-              return True
-            elif current_prompt_id == prompt_id:
-              logger.debug("Executing node %s for prompt %s", current_node, prompt_id)
-          elif msg_type == "execution_error":
-            logger.error("Execution error for prompt %s: %s", prompt_id, msg_data)
-            return False
-          elif msg_type == "execution_interrupted":
-            logger.warning("Execution interrupted for prompt %s", prompt_id)
-            return False
-      except websocket.WebSocketTimeoutException:
-        # Timeout on recv - check if total timeout exceeded, then continue waiting
-        continue
-  except websocket.WebSocketException as e:
-    logger.error("WebSocket error while waiting for prompt %s: %s", prompt_id, e)
-    return False
+    backend = await comfy_pool.find(prompt_id)
+    if backend is None:
+      logger.warning("Prompt %s is unknown to every ComfyUI backend", prompt_id)
+      return False
+    return await backend.wait_for_execution(prompt_id, timeout)
   except Exception as e:
     logger.error("Unexpected error in WebSocket wait for prompt %s: %s", prompt_id, e)
     return False
-  finally:
-    if ws:
-      try:
-        ws.close()
-      except Exception:
-        pass
 
-# Utility: Fetch outputs from ComfyUI history after execution completes
-def get_output_from_history(prompt_id: str, output_type: str = "images"):
-  """Fetch outputs from ComfyUI history after execution completes.
+# Utility: Percent-encode one URL path segment (most node ids and file names need nothing)
+def url_segment(text: str) -> str:
+  return text if URL_SAFE_SEGMENT(text) else quote(text, safe="")
+
+# Utility: Build the API server URL that streams one output of a prompt
+def output_url(prompt_id: str, output: dict) -> str:
+  """Return the /outputs path for an output entry (relative to the API server).
+  The path names the node and file, so it resolves to the same file whether
+  the outputs are later read from `executed` events or from /history.
+  """
+  return f"/outputs/{prompt_id}/{url_segment(output['node_id'])}/{url_segment(output['filename'])}"
+
+# Utility: Collect the ordered output list of a finished prompt
+async def get_prompt_outputs(prompt_id: str, require: Optional[str] = None):
+  """Return a finished prompt's outputs from its `executed` events, or from /history.
+  ComfyUI's `executed` events already carry every output node's images/gifs,
+  so /history is only fetched when events may have been missed (WebSocket
+  reconnect, prompt unknown to the listener) or the events hold nothing of the
+  wanted kind (e.g. an older ComfyUI that sends no events for cached nodes).
+  Args:
+    prompt_id: The prompt ID to fetch results for
+    require: Output kind ("images"/"gifs") that must be present to skip /history (None = any output)
+  Returns:
+    List of output entries (see comfy_client.list_outputs), or None if unavailable
+  """
+  backend = await comfy_pool.find(prompt_id)
+  state = backend.events.get(prompt_id) if backend is not None else None
+  if state is not None and state.status == "success" and not state.events_missed:
+    outputs = list_outputs(state.outputs)
+    if any(require is None or output["kind"] == require for output in outputs):
+      return outputs
+    logger.info("No %s in events for prompt %s, checking history", require or "outputs", prompt_id)
+  return await get_history_outputs(prompt_id)
+
+# Utility: Fetch the ordered output list of a finished prompt from ComfyUI history
+async def get_history_outputs(prompt_id: str):
+  """Fetch the outputs of a finished prompt from ComfyUI history.
   Args:
     prompt_id: The prompt ID to fetch results for
-    output_type: Type of output to fetch ("images" or "gifs" for videos)
   Returns:
-    URL to the output file or None if not found
+    List of output entries (see comfy_client.list_outputs), or None if unavailable
   """
   try:
-    hist_resp = requests.get(f"{COMFYUI_API}/history/{prompt_id}", timeout=10)
-    if hist_resp.status_code == 200:
-      hist_json = hist_resp.json()
-      data = hist_json.get(prompt_id)
-      if data and "outputs" in data and data.get("status", {}).get("status_str") == "success":
-        # Collect all outputs of the requested type from all nodes
-        all_outputs = []
-        for node_id, node_output in data["outputs"].items():
-          outputs = node_output.get(output_type, [])
-          if outputs:
-            # Store each output with its node_id for potential debugging
-            for output in outputs:
-              all_outputs.append((node_id, output))
-        
-        # If we found outputs, use the LAST one (final processed output)
-        # This ensures we get the final video from workflows with multiple VHS_VideoCombine nodes
-        if all_outputs:
-          node_id, output_info = all_outputs[-1]
-          if output_type == "images":
-            url = f"{COMFYUI_API}/view?filename={output_info['filename']}&subfolder={output_info.get('subfolder', '')}"
-          else:  # gifs/videos
-            url = f"{COMFYUI_API}/view?filename={output_info['filename']}&subfolder={output_info.get('subfolder', '')}&type={output_info.get('type', 'output')}"
-          logger.info("Found %s in /history from node %s: %s", output_type, node_id, url)
-          return url
-      else:
-        logger.info("No finished outputs found in history for prompt %s", prompt_id)
-    else:
-      logger.warning("Could not fetch /history/%s, status %s", prompt_id, hist_resp.status_code)
+    backend = await comfy_pool.find(prompt_id)
+    data = None
+    if backend is not None:
+      with metrics.stage("history"):
+        data = await backend.get_history(prompt_id)
+    if data and "outputs" in data and data.get("status", {}).get("status_str") == "success":
+      return list_outputs(data["outputs"])
+    logger.info("No finished outputs found in history for prompt %s", prompt_id)
   except Exception as e:
     logger.error("Error fetching history for prompt %s: %s", prompt_id, e)
   return None
 
-# Utility: Fetch all outputs from ComfyUI history after execution completes
-def get_all_outputs_from_history(prompt_id: str):
-  """Fetch all outputs (images and videos) from ComfyUI history after execution completes.
+# Utility: Fetch outputs after execution completes
+async def get_output_from_history(prompt_id: str, output_type: str = "images"):
+  """Fetch outputs after execution completes (from events, /history as fallback).
   Args:
     prompt_id: The prompt ID to fetch results for
+    output_type: Type of output to fetch ("images" or "gifs" for videos)
   Returns:
-    Dictionary with 'images' and 'gifs' keys, each containing a list of URLs
+    /outputs URL of the output file or None if not found
+  """
+  outputs = await get_prompt_outputs(prompt_id, output_type) or []
+  # Use the LAST output of the requested type (final processed output)
+  # This ensures we get the final video from workflows with multiple VHS_VideoCombine nodes
+  for output in reversed(outputs):
+    if output["kind"] == output_type:
+      url = output_url(prompt_id, output)
+      logger.info("Found %s from node %s: %s", output_type, output["node_id"], url)
+      return url
+  return None
+
+# Utility: Find one output of a finished prompt by its node and file name
+async def find_output(prompt_id: str, node_id: str, filename: str) -> Optional[dict]:
+  """Return the output entry `filename` of node `node_id`, or None if the prompt has no such output.
+  /history is checked as well when the events don't list it (e.g. an older
+  ComfyUI that sends no events for cached nodes).
+  """
+  def match(outputs):
+    return next((output for output in outputs or [] if output["node_id"] == node_id and output["filename"] == filename), None)
+
+  return match(await get_prompt_outputs(prompt_id)) or match(await get_history_outputs(prompt_id))
+
+# Utility: Fetch all outputs after execution completes
+async def get_all_outputs_from_history(prompt_id: str, require: Optional[str] = None):
+  """Fetch all outputs (images and videos) after execution completes (from events, /history as fallback).
+  Args:
+    prompt_id: The prompt ID to fetch results for
+    require: Output kind that must be present to skip /history (see get_prompt_outputs)
+  Returns:
+    Dictionary with 'images' and 'gifs' keys, each containing a list of /outputs URLs
   """
   result = {"images": [], "gifs": []}
-  try:
-    hist_resp = requests.get(f"{COMFYUI_API}/history/{prompt_id}", timeout=10)
-    if hist_resp.status_code == 200:
-      hist_json = hist_resp.json()
-      data = hist_json.get(prompt_id)
-      if data and "outputs" in data and data.get("status", {}).get("status_str") == "success":
-        for node_output in data["outputs"].values():
-          # Collect images
-          for img_info in node_output.get("images", []):
-            url = f"{COMFYUI_API}/view?filename={img_info['filename']}&subfolder={img_info.get('subfolder', '')}"
-            result["images"].append(url)
-            logger.info("Found image in /history: %s", url)
-          # Collect videos/gifs
-          for gif_info in node_output.get("gifs", []):
-            url = f"{COMFYUI_API}/view?filename={gif_info['filename']}&subfolder={gif_info.get('subfolder', '')}&type={gif_info.get('type', 'output')}"
-            result["gifs"].append(url)
-            logger.info("Found video/gif in /history: %s", url)
-      else:
-        logger.info("No finished outputs found in history for prompt %s", prompt_id)
-    else:
-      logger.warning("Could not fetch /history/%s, status %s", prompt_id, hist_resp.status_code)
-  except Exception as e:
-    logger.error("Error fetching history for prompt %s: %s", prompt_id, e)
+  for output in await get_prompt_outputs(prompt_id, require) or []:
+    url = output_url(prompt_id, output)
+    result[output["kind"]].append(url)
+    logger.info("Found %s: %s (%s)", output["kind"], url, output["filename"])
   return result
 
 # Utility: Wait for image generation using WebSocket (event-driven)
-def wait_for_image_generation(prompt_id: str, client_id: str = None):
+async def wait_for_image_generation(prompt_id: str):
   """Wait for image generation using WebSocket (event-driven).
   Uses WebSocket to receive real-time execution updates from ComfyUI,
   eliminating the need for polling. Falls back to history check if 
   WebSocket fails.
   Args:
     prompt_id: The prompt ID to wait for
-    client_id: The client ID used when queueing (optional, creates new if not provided)
   """
-  if client_id is None:
-    client_id = str(uuid.uuid4())
   # Try WebSocket-based wait first (more efficient)
-  if wait_for_execution_via_websocket(prompt_id, client_id, timeout=WS_IMAGE_TIMEOUT):
-    return get_output_from_history(prompt_id, "images")
+  if await wait_for_execution_via_websocket(prompt_id, timeout=WS_IMAGE_TIMEOUT):
+    return await get_output_from_history(prompt_id, "images")
   # Fallback: check history directly (execution might have completed before we connected)
   logger.info("WebSocket wait unsuccessful, checking history directly...")
-  return get_output_from_history(prompt_id, "images")
+  return await get_output_from_history(prompt_id, "images")
 
-# Utility: Extract video and last frame URLs from history outputs
-def extract_video_and_frame_urls(prompt_id: str):
-  """Extract video URL and last frame URL from ComfyUI history outputs.
+# Utility: Wait for an image prompt and collect every image it saved
+async def wait_for_all_images(prompt_id: str, timeout: int = WS_IMAGE_TIMEOUT):
+  """Wait for an image prompt and return the URLs of all its images (e.g. a whole batch).
+  Args:
+    prompt_id: The prompt ID to wait for
+    timeout: Maximum time to wait for execution in seconds
+  Returns:
+    List of /outputs URLs, in ComfyUI's output order (empty if none)
+  """
+  if not await wait_for_execution_via_websocket(prompt_id, timeout=timeout):
+    logger.info("WebSocket wait unsuccessful, checking history directly...")
+  return (await get_all_outputs_from_history(prompt_id, "images"))["images"]
+
+# Utility: Extract video and last frame URLs from a finished prompt
+async def extract_video_and_frame_urls(prompt_id: str):
+  """Extract video URL and last frame URL from a finished prompt's outputs.
   Args:
     prompt_id: The prompt ID to fetch results for
   Returns:
     Dictionary with 'video_url' and 'last_frame_url' keys, where values may be None if not found
   """
-  all_outputs = get_all_outputs_from_history(prompt_id)
+  all_outputs = await get_all_outputs_from_history(prompt_id, "gifs")
   result = {}
   
   # Get the last video from gifs list (check for non-empty list)
@@ -589,46 +1552,57 @@ def extract_video_and_frame_urls(prompt_id: str):
   
   return result
 
+# Utility: Wait until a finished prompt's final video file is completely written
+async def wait_for_video_file(prompt_id: str) -> bool:
+  """Probe the prompt's last video output on its backend until the encoder has flushed it.
+  Returns:
+    True if the file was confirmed complete, False if it wasn't (or there is no video)
+  """
+  videos = [output for output in await get_prompt_outputs(prompt_id, "gifs") or [] if output["kind"] == "gifs"]
+  backend = await comfy_pool.find(prompt_id)
+  if not videos or backend is None:
+    return False
+  start = time.perf_counter()
+  ready = await backend.wait_for_output_ready(videos[-1])
+  if ready:
+    logger.info("Video %s complete after %.2fs of probing", videos[-1]["filename"], time.perf_counter() - start)
+  return ready
+
 # Utility: Wait for video generation using WebSocket with extended timeout
-def wait_for_video_generation(prompt_id: str, client_id: str = None, include_last_frame: bool = False):
+async def wait_for_video_generation(prompt_id: str, include_last_frame: bool = False):
   """Wait for video generation using WebSocket with extended timeout.
   Videos take much longer to generate than images (10+ minutes),
   so we use a longer timeout. Uses WebSocket for efficient event-driven
   waiting instead of polling.
   Args:
     prompt_id: The prompt ID to wait for
-    client_id: The client ID used when queueing (optional, creates new if not provided)
     include_last_frame: If True, returns dict with both video_url and last_frame_url
   Returns:
     If include_last_frame is False: URL to video or None
     If include_last_frame is True: dict with 'video_url' and 'last_frame_url' keys
   """
-  if client_id is None:
-    client_id = str(uuid.uuid4())
   logger.info("Waiting for video generation via WebSocket (timeout: %ss)", WS_VIDEO_TIMEOUT)
   # Try WebSocket-based wait (more efficient)
-  if wait_for_execution_via_websocket(prompt_id, client_id, timeout=WS_VIDEO_TIMEOUT):
-    # Add a short delay after video generation completes to ensure the encoder
-    # properly flushes the last frame. This is a workaround for VHS_VideoCombine
-    # encoder flush issues where the last frame is sometimes dropped.
-    # Note: This blocks the calling thread but ensures video file is complete.
-    logger.info("Video generation completed, waiting %ss for encoder to flush...", ENCODER_FLUSH_DELAY)
-    time.sleep(ENCODER_FLUSH_DELAY)
+  if await wait_for_execution_via_websocket(prompt_id, timeout=WS_VIDEO_TIMEOUT):
+    # VHS_VideoCombine may still be flushing the last frame when ComfyUI reports
+    # completion; probe the file until it is complete instead of sleeping blindly.
+    with metrics.stage("encoder_flush"):
+      await wait_for_video_file(prompt_id)
   else:
     # Fallback: check history directly
     logger.info("WebSocket wait unsuccessful, checking history directly...")
   
   # Return results based on include_last_frame parameter
   if include_last_frame:
-    return extract_video_and_frame_urls(prompt_id)
+    return await extract_video_and_frame_urls(prompt_id)
   else:
     # Backward compatibility: return just the video URL string
-    return get_output_from_history(prompt_id, "gifs")
+    return await get_output_from_history(prompt_id, "gifs")
 
 # Entry point for running the API server directly
 if __name__ == "__main__":
   import uvicorn
   logger.info("🏰 Comfynaut API Server starting...")
-  logger.info("📡 ComfyUI connection: %s (WebSocket: %s)", COMFYUI_API, COMFYUI_WS_URL)
+  logger.info("📡 ComfyUI backends: %s", ", ".join(COMFYUI_HOSTS))
   logger.info("🌐 API server listening on http://0.0.0.0:8000/")
   uvicorn.run("api_server:app", host="0.0.0.0", port=8000)
@@ -0,0 +1,413 @@
+# 🧪 benchmarks/fake_comfyui.py - Comfynaut Training Dummy
+# "Every knight practises on a straw dummy before facing the dragon."
+#
+# A stand-in ComfyUI server, so the API server (and its benchmarks) can run on
+# a plain Linux box without a GPU. It implements the endpoints Comfynaut talks
+# to (/prompt, /upload/image, /history/{id}, /view, /queue, /interrupt,
+# /system_stats and /ws) and "executes" queued prompts one at a time, walking
+# their nodes in dependency order with configurable delays and sending the
+# same WebSocket event sequence as ComfyUI.
+#
+# Key features:
+# - Real event sequence: status, execution_start, execution_cached, executing,
+#   progress, executed, execution_success / execution_error / execution_interrupted
+# - Configurable per-node and per-class_type delays, jitter and sampler steps
+# - Failure injection: failing prompts, rejected prompts and failing uploads
+# - LoadImage inputs validated like ComfyUI does (missing files reject the prompt)
+# - Real outputs: small PNGs for SaveImage/PreviewImage, MP4-boxed video for VHS_VideoCombine
+#   (optionally still being written for a while after its `executed` event)
+#
+# Usage:
+#   python benchmarks/fake_comfyui.py --port 8188 --node-delay 0.05 --delay KSamplerAdvanced=2
+
+import argparse
+import asyncio
+import json
+import logging
+import os
+import random
+import struct
+import time
+import uuid
+import zlib
+from contextlib import asynccontextmanager
+from typing import Optional
+
+import uvicorn
+from fastapi import FastAPI, File, Form, HTTPException, Request, UploadFile, WebSocket, WebSocketDisconnect
+from fastapi.responses import JSONResponse, Response
+
+logger = logging.getLogger("comfynaut.fake_comfyui")
+
+# Node types that report per-step progress while "sampling"
+SAMPLER_NODES = ("KSampler", "KSamplerAdvanced", "SamplerCustom", "SamplerCustomAdvanced")
+
+# Node types that produce outputs, and the output key ComfyUI reports them under
+IMAGE_OUTPUT_NODES = {"SaveImage": "output", "PreviewImage": "temp"}
+VIDEO_OUTPUT_NODES = ("VHS_VideoCombine",)
+
+# Utility: Build a small solid-colour PNG
+def make_png(width: int = 8, height: int = 8) -> bytes:
+  """Return a valid RGB PNG of one random colour."""
+  colour = bytes(random.randrange(256) for _ in range(3))
+  raw = b"".join(b"\x00" + colour * width for _ in range(height))
+
+  def chunk(kind: bytes, data: bytes) -> bytes:
+    return struct.pack(">I", len(data)) + kind + data + struct.pack(">I", zlib.crc32(kind + data) & 0xffffffff)
+
+  header = struct.pack(">IIBBBBB", width, height, 8, 2, 0, 0, 0)
+  return b"\x89PNG\r\n\x1a\n" + chunk(b"IHDR", header) + chunk(b"IDAT", zlib.compress(raw)) + chunk(b"IEND", b"")
+
+# Utility: Build an MP4-shaped file of about `size` bytes
+def make_mp4(size: int) -> bytes:
+  """Return ftyp + mdat (random payload) + moov boxes, the layout ffmpeg writes without faststart."""
+  def box(kind: bytes, data: bytes) -> bytes:
+    return struct.pack(">I", len(data) + 8) + kind + data
+
+  ftyp = box(b"ftyp", b"isom\x00\x00\x02\x00isomiso2avc1mp41")
+  moov = box(b"moov", box(b"mvhd", bytes(100)))
+  return ftyp + box(b"mdat", os.urandom(max(0, size - len(ftyp) - len(moov) - 8))) + moov
+
+# Utility: Order a prompt's nodes so every node runs after the nodes it links to
+def execution_order(prompt: dict) -> list:
+  """Return node ids in dependency order (links are [node_id, slot] inputs)."""
+  order, visiting, done = [], set(), set()
+
+  def visit(node_id):
+    if node_id in done or node_id not in prompt:
+      return
+    if node_id in visiting:
+      raise ValueError(f"Cycle in prompt at node {node_id}")
+    visiting.add(node_id)
+    for value in prompt[node_id].get("inputs", {}).values():
+      if isinstance(value, list) and len(value) == 2 and isinstance(value[0], str):
+        visit(value[0])
+    visiting.discard(node_id)
+    done.add(node_id)
+    order.append(node_id)
+
+  for node_id in prompt:
+    visit(node_id)
+  return order
+
+class FakeComfyUI:
+  """State and execution loop of the fake server."""
+
+  def __init__(self, node_delay: float = 0.01, class_delays: dict = None, jitter: float = 0.0, steps: int = 4,
+               fail_rate: float = 0.0, reject_rate: float = 0.0, upload_fail_rate: float = 0.0,
+               video_bytes: int = 200_000, image_size: int = 8, video_flush: float = 0.0):
+    """
+    Args:
+      node_delay: Seconds each node "runs" (unless overridden per class_type)
+      class_delays: class_type -> seconds, e.g. {"KSamplerAdvanced": 2.0}
+      jitter: Random +/- fraction applied to every delay (0.1 = +/-10%)
+      steps: Progress events sent by sampler nodes
+      fail_rate: Probability that a prompt fails with execution_error
+      reject_rate: Probability that POST /prompt is rejected with HTTP 400
+      upload_fail_rate: Probability that POST /upload/image fails with HTTP 500
+      video_bytes: Size of fake video outputs
+      image_size: Width and height of fake PNG outputs
+      video_flush: Seconds a video file stays truncated after its `executed` event (a slow encoder flush)
+    """
+    self.node_delay = node_delay
+    self.class_delays = class_delays or {}
+    self.jitter = jitter
+    self.steps = max(1, steps)
+    self.fail_rate = fail_rate
+    self.reject_rate = reject_rate
+    self.upload_fail_rate = upload_fail_rate
+    self.video_bytes = video_bytes
+    self.image_size = image_size
+    self.video_flush = video_flush
+    self.clients = {}        # client_id -> WebSocket
+    self.pending = []        # [number, prompt_id, prompt, extra_data, outputs_to_execute]
+    self.running = None
+    self.history = {}
+    self.files = {"input": {}, "output": {}, "temp": {}}
+    self.last_signatures = {}  # node_id -> (class_type, inputs) of the previous prompt, for execution_cached
+    self.interrupted = False
+    self.counter = 0
+    self.batch_size = 1        # batch_size of the running prompt's latent node
+    self.wakeup = None         # asyncio.Event set when a prompt is queued (created on startup)
+
+  # Utility: Send one event to a prompt's client (or to everyone)
+  async def send(self, msg_type: str, data: dict, client_id: Optional[str] = None):
+    # Like ComfyUI, events for a client that is not connected are dropped
+    if client_id is None:
+      targets = list(self.clients.values())
+    else:
+      targets = [self.clients[client_id]] if client_id in self.clients else []
+    message = json.dumps({"type": msg_type, "data": data})
+    for websocket in targets:
+      try:
+        await websocket.send_text(message)
+      except Exception:
+        pass
+
+  async def send_status(self):
+    """Broadcast the queue size, as ComfyUI does whenever its queue changes."""
+    await self.send("status", {"status": {"exec_info": {"queue_remaining": len(self.pending) + bool(self.running)}}})
+
+  def delay_for(self, class_type: str) -> float:
+    delay = self.class_delays.get(class_type, self.node_delay)
+    if self.jitter:
+      delay *= 1 + random.uniform(-self.jitter, self.jitter)
+    return max(0.0, delay)
+
+  def cached_nodes(self, prompt: dict, order: list) -> list:
+    """Nodes whose inputs match the previous prompt's (and whose inputs are all cached).
+    Output nodes always run, so every prompt has outputs.
+    """
+    cached = set()
+    for node_id in order:
+      node = prompt[node_id]
+      if node.get("class_type") in IMAGE_OUTPUT_NODES or node.get("class_type") in VIDEO_OUTPUT_NODES:
+        continue
+      signature = json.dumps([node.get("class_type"), node.get("inputs", {})], sort_keys=True)
+      links = [value[0] for value in node.get("inputs", {}).values()
+               if isinstance(value, list) and len(value) == 2 and isinstance(value[0], str)]
+      if self.last_signatures.get(node_id) == signature and all(link in cached for link in links):
+        cached.add(node_id)
+      self.last_signatures[node_id] = signature
+    return [node_id for node_id in order if node_id in cached]
+
+  def make_output(self, class_type: str) -> Optional[dict]:
+    """Create the output files of an output node and return its `executed` output dict."""
+    if class_type in IMAGE_OUTPUT_NODES:
+      folder = IMAGE_OUTPUT_NODES[class_type]
+      images = []
+      for _ in range(self.batch_size):
+        filename = f"ComfyUI_{uuid.uuid4().hex[:12]}.png"
+        self.files[folder][filename] = make_png(self.image_size, self.image_size)
+        images.append({"filename": filename, "subfolder": "", "type": folder})
+      return {"images": images}
+    if class_type in VIDEO_OUTPUT_NODES:
+      filename = f"ComfyUI_{uuid.uuid4().hex[:12]}.mp4"
+      data = make_mp4(self.video_bytes)
+      if self.video_flush > 0:
+        # The encoder is still writing: serve a truncated file (no moov box) until the flush ends
+        self.files["output"][filename] = data[:len(data) // 2]
+        asyncio.get_running_loop().call_later(self.video_flush, self.files["output"].__setitem__, filename, data)
+      else:
+        self.files["output"][filename] = data
+      return {"gifs": [{"filename": filename, "subfolder": "", "type": "output", "format": "video/h264-mp4"}]}
+    return None
+
+  async def execute(self, item: list):
+    """Run one queued prompt, sending ComfyUI's event sequence."""
+    number, prompt_id, prompt, extra, _ = item
+    client_id = extra.get("client_id")
+    order = execution_order(prompt)
+    batch_sizes = [node.get("inputs", {}).get("batch_size") for node in prompt.values()]
+    self.batch_size = max([size for size in batch_sizes if isinstance(size, int)] or [1])
+    messages = [["execution_start", {"prompt_id": prompt_id, "timestamp": int(time.time() * 1000)}]]
+    await self.send("execution_start", messages[0][1], client_id)
+    cached = self.cached_nodes(prompt, order)
+    await self.send("execution_cached", {"nodes": cached, "prompt_id": prompt_id, "timestamp": int(time.time() * 1000)}, client_id)
+    fail_at = random.choice(order) if order and random.random() < self.fail_rate else None
+    outputs, status, executed = {}, "success", list(cached)
+    for node_id in order:
+      if node_id in cached:
+        continue
+      class_type = prompt[node_id].get("class_type")
+      await self.send("executing", {"node": node_id, "display_node": node_id, "prompt_id": prompt_id}, client_id)
+      delay = self.delay_for(class_type)
+      if class_type in SAMPLER_NODES:
+        for step in range(1, self.steps + 1):
+          await asyncio.sleep(delay / self.steps)
+          if self.interrupted:
+            break  # ComfyUI checks for interrupts between sampling steps
+          await self.send("progress", {"value": step, "max": self.steps, "prompt_id": prompt_id, "node": node_id}, client_id)
+      else:
+        await asyncio.sleep(delay)
+      if self.interrupted:
+        status = "interrupted"
+        data = {"prompt_id": prompt_id, "node_id": node_id, "node_type": class_type, "executed": executed}
+        await self.send("execution_interrupted", data, client_id)
+        messages.append(["execution_interrupted", data])
+        break
+      if node_id == fail_at:
+        status = "error"
+        data = {"prompt_id": prompt_id, "node_id": node_id, "node_type": class_type, "executed": executed,
+                "exception_message": "Injected failure", "exception_type": "RuntimeError", "traceback": [],
+                "current_inputs": {}, "current_outputs": {}}
+        await self.send("execution_error", data, client_id)
+        messages.append(["execution_error", data])
+        break
+      output = self.make_output(class_type)
+      if output is not None:
+        outputs[node_id] = output
+        await self.send("executed", {"node": node_id, "display_node": node_id, "output": output, "prompt_id": prompt_id}, client_id)
+      executed.append(node_id)
+    if status == "success":
+      data = {"prompt_id": prompt_id, "timestamp": int(time.time() * 1000)}
+      await self.send("execution_success", data, client_id)
+      messages.append(["execution_success", data])
+    await self.send("executing", {"node": None, "prompt_id": prompt_id}, client_id)
+    self.history[prompt_id] = {
+      "prompt": item,
+      "outputs": outputs,
+      "status": {"status_str": "success" if status == "success" else "error",
+                 "completed": status == "success", "messages": messages},
+    }
+
+  async def worker(self):
+    """Execute queued prompts one at a time, like ComfyUI's single execution thread."""
+    while True:
+      if not self.pending:
+        self.wakeup.clear()
+        await self.wakeup.wait()
+        continue
+      self.running = self.pending.pop(0)
+      self.interrupted = False
+      try:
+        await self.execute(self.running)
+      except Exception as e:
+        logger.error("Fake execution failed: %s", e)
+      finally:
+        self.running = None
+        await self.send_status()
+
+def build_app(fake: FakeComfyUI) -> FastAPI:
+  """Create the FastAPI app serving `fake`."""
+  @asynccontextmanager
+  async def lifespan(app: FastAPI):
+    fake.wakeup = asyncio.Event()
+    worker = asyncio.get_running_loop().create_task(fake.worker())
+    yield
+    worker.cancel()
+
+  app = FastAPI(lifespan=lifespan)
+
+  @app.websocket("/ws")
+  async def websocket_endpoint(websocket: WebSocket, clientId: Optional[str] = None):
+    await websocket.accept()
+    client_id = clientId or uuid.uuid4().hex
+    fake.clients[client_id] = websocket
+    await websocket.send_text(json.dumps({"type": "status", "data": {
+      "status": {"exec_info": {"queue_remaining": len(fake.pending)}}, "sid": client_id}}))
+    try:
+      while True:
+        await websocket.receive_text()
+    except WebSocketDisconnect:
+      fake.clients.pop(client_id, None)
+
+  @app.post("/prompt")
+  async def queue_prompt(request: Request):
+    body = await request.json()
+    prompt = body.get("prompt")
+    if not isinstance(prompt, dict) or not prompt or any("class_type" not in node for node in prompt.values()):
+      return JSONResponse(status_code=400, content={
+        "error": {"type": "invalid_prompt", "message": "Invalid prompt", "details": "", "extra_info": {}},
+        "node_errors": {}})
+    missing = {node_id: node["inputs"]["image"] for node_id, node in prompt.items()
+               if node["class_type"] == "LoadImage" and node.get("inputs", {}).get("image") not in fake.files["input"]}
+    if missing:
+      return JSONResponse(status_code=400, content={
+        "error": {"type": "prompt_outputs_failed_validation", "message": "Prompt outputs failed validation",
+                  "details": "", "extra_info": {}},
+        "node_errors": {node_id: {"errors": [{
+          "type": "custom_validation_failed", "message": "Custom validation failed for node",
+          "details": f"image - Invalid image file: {image}", "extra_info": {"input_name": "image"}}],
+          "dependent_outputs": [], "class_type": "LoadImage"} for node_id, image in missing.items()}})
+    if random.random() < fake.reject_rate:
+      return JSONResponse(status_code=400, content={
+        "error": {"type": "prompt_outputs_failed_validation", "message": "Injected rejection", "details": "",
+                  "extra_info": {}}, "node_errors": {}})
+    fake.counter += 1
+    prompt_id = body.get("prompt_id") or str(uuid.uuid4())
+    fake.pending.append([fake.counter, prompt_id, prompt, {"client_id": body.get("client_id")}, []])
+    fake.wakeup.set()
+    await fake.send_status()
+    return {"prompt_id": prompt_id, "number": fake.counter, "node_errors": {}}
+
+  @app.post("/upload/image")
+  async def upload_image(image: UploadFile = File(...), overwrite: str = Form("false"), type: str = Form("input"),
+                         subfolder: str = Form("")):
+    if random.random() < fake.upload_fail_rate:
+      raise HTTPException(status_code=500, detail="Injected upload failure")
+    fake.files.setdefault(type, {})[image.filename] = await image.read()
+    return {"name": image.filename, "subfolder": subfolder, "type": type}
+
+  @app.get("/history/{prompt_id}")
+  async def get_history(prompt_id: str):
+    return {prompt_id: fake.history[prompt_id]} if prompt_id in fake.history else {}
+
+  @app.api_route("/view", methods=["GET", "HEAD"])
+  async def view(request: Request, filename: str, type: str = "output", subfolder: str = ""):
+    data = fake.files.get(type, {}).get(filename)
+    if data is None:
+      return Response(status_code=404)
+    media_type = "video/mp4" if filename.endswith(".mp4") else "image/png"
+    byte_range = request.headers.get("range")
+    if byte_range and byte_range.startswith("bytes="):
+      start, _, end = byte_range[len("bytes="):].partition("-")
+      start = int(start or 0)
+      end = min(int(end), len(data) - 1) if end else len(data) - 1
+      return Response(data[start:end + 1], status_code=206, media_type=media_type,
+                      headers={"Content-Range": f"bytes {start}-{end}/{len(data)}", "Accept-Ranges": "bytes"})
+    return Response(data, media_type=media_type, headers={"Accept-Ranges": "bytes"})
+
+  @app.get("/queue")
+  async def get_queue():
+    return {"queue_running": [fake.running] if fake.running else [], "queue_pending": list(fake.pending)}
+
+  @app.post("/queue")
+  async def edit_queue(request: Request):
+    body = await request.json()
+    if body.get("clear"):
+      fake.pending.clear()
+    for prompt_id in body.get("delete", []):
+      fake.pending[:] = [item for item in fake.pending if item[1] != prompt_id]
+    await fake.send_status()
+    return {}
+
+  @app.post("/interrupt")
+  async def interrupt(request: Request):
+    # Like ComfyUI, a JSON body with a prompt_id only interrupts that prompt
+    body = await request.body()
+    prompt_id = json.loads(body).get("prompt_id") if body else None
+    if fake.running is not None and prompt_id in (None, fake.running[1]):
+      fake.interrupted = True
+    return {}
+
+  @app.get("/system_stats")
+  async def system_stats():
+    return {
+      "system": {"os": "posix", "python_version": "fake", "comfyui_version": "fake"},
+      "devices": [{"name": "cuda:0 Fake GPU", "type": "cuda", "index": 0,
+                   "vram_total": 24 * 1024 ** 3, "vram_free": 20 * 1024 ** 3}],
+    }
+
+  return app
+
+# Utility: Parse repeated CLASS=SECONDS options
+def parse_class_delays(items: list) -> dict:
+  delays = {}
+  for item in items or []:
+    class_type, _, seconds = item.rpartition("=")
+    delays[class_type] = float(seconds)
+  return delays
+
+def main():
+  parser = argparse.ArgumentParser(description="Fake ComfyUI server for local testing and benchmarks")
+  parser.add_argument("--host", default="127.0.0.1")
+  parser.add_argument("--port", type=int, default=8188)
+  parser.add_argument("--node-delay", type=float, default=0.01, help="Seconds each node runs")
+  parser.add_argument("--delay", action="append", metavar="CLASS=SECONDS", help="Per class_type delay (repeatable)")
+  parser.add_argument("--jitter", type=float, default=0.0, help="Random +/- fraction applied to delays")
+  parser.add_argument("--steps", type=int, default=4, help="Progress events per sampler node")
+  parser.add_argument("--fail-rate", type=float, default=0.0, help="Probability of execution_error per prompt")
+  parser.add_argument("--reject-rate", type=float, default=0.0, help="Probability of HTTP 400 from /prompt")
+  parser.add_argument("--upload-fail-rate", type=float, default=0.0, help="Probability of HTTP 500 from /upload/image")
+  parser.add_argument("--video-bytes", type=int, default=200_000, help="Size of fake video outputs")
+  parser.add_argument("--video-flush", type=float, default=0.0, help="Seconds a video stays truncated after `executed`")
+  args = parser.parse_args()
+  fake = FakeComfyUI(node_delay=args.node_delay, class_delays=parse_class_delays(args.delay), jitter=args.jitter,
+                     steps=args.steps, fail_rate=args.fail_rate, reject_rate=args.reject_rate,
+                     upload_fail_rate=args.upload_fail_rate, video_bytes=args.video_bytes,
+                     video_flush=args.video_flush)
+  uvicorn.run(build_app(fake), host=args.host, port=args.port, log_level="warning")
+
+if __name__ == "__main__":
+  main()
@@ -0,0 +1,357 @@
+# ⏱️ benchmarks/microbench.py - Comfynaut Hourglass
+# "A grain of sand is nothing—until every request in the harbour drops one."
+#
+# Microbenchmarks for the per-request hot path of the API server: building
+# workflows from templates (build_workflow, build_img2img_workflow,
+# build_img2vid_workflow), compiling templates, hashing workflows for the
+# result cache, and parsing ComfyUI history (list_outputs,
+# get_output_from_history, get_all_outputs_from_history, both from `executed`
+# events and from the /history fallback). Cases run against
+# every file in workflows/ and against synthetic graphs padded to thousands of
+# nodes and histories with thousands of outputs.
+#
+# Results can be saved as a baseline (benchmarks/baseline.json) and later runs
+# checked against it. Timings are scaled by a fixed calibration loop, so a
+# baseline taken on one machine stays roughly usable on another. What the
+# calibration misses (a busy or throttled machine slows every case alike) is
+# taken out with the median ratio across cases, so --check flags cases that got
+# slower than the rest of the run, not runs that were slow as a whole.
+#
+# Key features:
+# - Real workflows/ files plus synthetic large graphs and histories
+# - Best-of-N per-call timings (timeit autorange)
+# - --save writes a baseline, --check exits non-zero on regressions
+# - Run-wide drift and microsecond jitter of the tiniest cases are not regressions
+# - Suspects are re-timed until they clear or regress consistently, round after round
+#
+# Usage:
+#   python benchmarks/microbench.py                    # print timings
+#   python benchmarks/microbench.py --check            # compare with benchmarks/baseline.json
+#   python benchmarks/microbench.py --save             # refresh the baseline
+#   python benchmarks/microbench.py --filter history --nodes 10000
+
+import argparse
+import asyncio
+import json
+import logging
+import os
+import platform
+import sys
+import time
+import timeit
+
+REPO_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, REPO_DIR)
+
+import api_server
+from comfy_client import PromptState, list_outputs
+from result_cache import workflow_cache_key
+from workflow_templates import WorkflowTemplate, load_workflow, model_signature
+
+BASELINE_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), "baseline.json")
+
+# Default sizes of the synthetic cases
+DEFAULT_NODES = "1000,5000"
+DEFAULT_OUTPUTS = 2000
+
+# Slowdown (after calibration) tolerated by --check before a case counts as a regression
+DEFAULT_TOLERANCE = 0.3
+
+# Slowdowns smaller than this (in seconds per call) are timer and cache jitter, whatever the ratio
+NOISE_FLOOR = 5e-6
+
+# Cases slower than this (in seconds per call) build large graphs, and swing with the allocator and
+# CPU caches of a busy machine far more than the calibration loop: they get a wider tolerance
+LARGE_CASE = 5e-4
+LARGE_CASE_MARGIN = 0.2
+
+# Timing runs per case (the best one is kept), and per case in every re-timing round
+DEFAULT_REPEAT = 7
+RETIME_REPEAT = 15
+
+# Cases needed before their median ratio is trusted as the run's drift (smaller runs use calibration only)
+MIN_DRIFT_CASES = 5
+
+# A suspected regression is re-timed round after round: one round within tolerance clears it, and it
+# fails the check once CONFIRM_ROUNDS rounds in a row regress and agree within CONSISTENCY of each
+# other (or every one of MAX_RETIME_ROUNDS rounds regressed)
+CONFIRM_ROUNDS = 3
+CONSISTENCY = 0.1
+MAX_RETIME_ROUNDS = 8
+
+# Timing runs of the calibration workload (it is cheap, and its noise scales every comparison)
+CALIBRATION_REPEAT = 15
+
+# Utility: Fixed pure-Python workload used to compare machine speeds
+def calibration_workload():
+  graph = {str(i): {"class_type": "Node", "inputs": {"value": i}} for i in range(2000)}
+  return sum(1 for node in graph.values() if node["class_type"] == "Node" and node["inputs"]["value"] >= 0)
+
+# Utility: Best per-call time of a function, in seconds
+def time_call(func, repeat: int) -> dict:
+  """Time `func` with timeit: autorange picks the loop count, the best of `repeat` runs wins."""
+  timer = timeit.Timer(func)
+  number, _ = timer.autorange()
+  runs = [total / number for total in timer.repeat(repeat=repeat, number=number)]
+  runs.sort()
+  return {"best": runs[0], "median": runs[len(runs) // 2], "loops": number}
+
+# Utility: Pad a workflow with filler nodes to `total` nodes
+def pad_workflow(workflow: dict, total: int) -> dict:
+  """Return a graph of `total` nodes with the real nodes last, so node scans see every filler first."""
+  graph = {}
+  for index in range(max(0, total - len(workflow))):
+    graph[f"pad{index}"] = {
+      "class_type": "ImageScaleBy",
+      "inputs": {"upscale_method": "nearest-exact", "scale_by": 1.0, "image": [f"pad{index - 1}" if index else "0", 0]},
+      "_meta": {"title": f"Filler {index}"},
+    }
+  graph.update(workflow)
+  return graph
+
+# Utility: Synthetic ComfyUI /history entry with `count` outputs
+def synthetic_history(count: int) -> dict:
+  """One history entry spread over count // 4 output nodes, with a video every 8th node."""
+  outputs = {}
+  for node in range(max(1, count // 4)):
+    kind = "gifs" if node % 8 == 7 else "images"
+    outputs[str(1000 + node)] = {kind: [
+      {"filename": f"ComfyUI_{node:05d}_{i}.png", "subfolder": "", "type": "output"} for i in range(4)
+    ]}
+  return {"prompt": [], "outputs": outputs, "status": {"status_str": "success", "completed": True, "messages": []}}
+
+class HistoryBackend:
+  """Stands in for a ComfyUI backend in the history cases (no network).
+  `events` maps prompt ids to finished PromptStates, like a listener's get().
+  """
+
+  def __init__(self, history: dict):
+    self.history = history
+    self.events = {}
+
+  async def get_history(self, prompt_id: str):
+    return self.history
+
+# Utility: Collect the benchmark cases
+def build_cases(node_counts: list, output_count: int) -> list:
+  """Return (name, zero-argument callable) pairs."""
+  cases = []
+  templates = {}
+  for name in sorted(os.listdir(api_server.WORKFLOWS_DIR)):
+    if name.endswith(".json"):
+      path = os.path.join(api_server.WORKFLOWS_DIR, name)
+      templates[name] = (load_workflow(path), api_server.workflow_registry.get(path))
+
+  # Per-request builders, one per workflow kind (the file name prefix)
+  def builders(label: str, graph: dict, template: WorkflowTemplate):
+    kind = label.split(" - ")[0] if " - " in label else None
+    found = []
+    if kind in ("t2i", None) and template.prompt_node is not None:
+      found.append(("build_workflow", lambda: api_server.build_workflow("a lighthouse at dusk", template, seed=42)))
+    if kind in ("i2i", None) and template.prompt_node is not None and template.image_node is not None:
+      found.append(("build_img2img_workflow",
+                    lambda: api_server.build_img2img_workflow("a lighthouse at dusk", "input.png", template, seed=42)))
+    if kind in ("i2v", None) and template.image_node is not None:
+      found.append(("build_img2vid_workflow",
+                    lambda: api_server.build_img2vid_workflow("input.png", "waves roll in", template, seed=42)))
+    built = found[0][1]()["prompt"] if found else graph
+    return found + [
+      ("compile_template", lambda: WorkflowTemplate(graph)),
+      ("model_signature", lambda: model_signature(built)),
+      ("cache_key", lambda: workflow_cache_key(built)),
+    ]
+
+  for name, (graph, template) in templates.items():
+    label = name[:-len(".json")]
+    for case, func in builders(label, graph, template):
+      cases.append((f"{case}[{label}]", func))
+
+  # Synthetic graphs: the real t2i and i2v workflows padded to thousands of nodes
+  for base in ("t2i - SDXL.json", "i2v - WAN 2.2 Smooth Workflow v2.0.json"):
+    if base not in templates:
+      continue
+    kind = base.split(" - ")[0]
+    for count in node_counts:
+      graph = pad_workflow(templates[base][0], count)
+      label = f"{kind} - synthetic {count} nodes"
+      for case, func in builders(label, graph, WorkflowTemplate(graph)):
+        cases.append((f"{case}[{label}]", func))
+
+  # Output parsing, with the backend lookup served from memory: "bench" is only
+  # in /history, "bench-events" finished with its outputs from `executed` events
+  history = synthetic_history(output_count)
+  backend = HistoryBackend(history)
+
+  async def find(prompt_id: str):
+    return backend
+
+  async def finished_state() -> PromptState:
+    state = PromptState("bench-events")
+    state.outputs = dict(history["outputs"])
+    state.finish("success")
+    return state
+
+  api_server.comfy_pool.find = find
+  loop = asyncio.new_event_loop()
+  backend.events["bench-events"] = loop.run_until_complete(finished_state())
+  label = f"{output_count} outputs"
+  cases.append((f"list_outputs[{label}]", lambda: list_outputs(history["outputs"])))
+  for prompt_id, suffix in (("bench", ""), ("bench-events", " from events")):
+    cases.append((f"get_output_from_history[{label}{suffix}]",
+                   lambda prompt_id=prompt_id: loop.run_until_complete(api_server.get_output_from_history(prompt_id, "images"))))
+    cases.append((f"get_all_outputs_from_history[{label}{suffix}]",
+                   lambda prompt_id=prompt_id: loop.run_until_complete(api_server.get_all_outputs_from_history(prompt_id))))
+  return cases
+
+# Utility: How much slower than the calibrated baseline the run was as a whole
+def run_drift(results: dict, calibration: float, baseline: dict) -> float:
+  """Return the median calibrated ratio across cases (at least 1.0; 1.0 for runs with few cases)."""
+  scale = calibration / baseline["calibration"]
+  ratios = sorted(result["best"] / (baseline["results"][case]["best"] * scale)
+                  for case, result in results.items() if case in baseline["results"])
+  if len(ratios) < MIN_DRIFT_CASES:
+    return 1.0
+  return max(1.0, ratios[len(ratios) // 2])
+
+# Utility: How much slower than expected a case was, if that counts as a regression
+def regression_ratio(best: float, expected: float, tolerance: float) -> float:
+  """Return best / expected when it exceeds the case's tolerance and NOISE_FLOOR, else 0.
+  Cases over LARGE_CASE seconds per call are allowed LARGE_CASE_MARGIN more.
+  """
+  if expected >= LARGE_CASE:
+    tolerance += LARGE_CASE_MARGIN
+  ratio = best / expected
+  if ratio > 1 + tolerance and best - expected > NOISE_FLOOR:
+    return ratio
+  return 0.0
+
+# Utility: Compare results with a baseline
+def check_regressions(results: dict, calibration: float, baseline: dict, tolerance: float, drift: float = 1.0) -> list:
+  """Return (case, ratio) for every case slower than the calibrated baseline by more than its tolerance.
+  The baseline is scaled by the calibration and by the run's `drift` (see
+  regression_ratio for the tolerance and noise floor of each case).
+  """
+  scale = calibration / baseline["calibration"] * drift
+  regressions = []
+  for case, result in results.items():
+    previous = baseline["results"].get(case)
+    if previous is None:
+      continue
+    ratio = regression_ratio(result["best"], previous["best"] * scale, tolerance)
+    if ratio:
+      regressions.append((case, ratio))
+  return regressions
+
+# Utility: Re-time suspected regressions until each one is cleared or confirmed
+def confirm_regressions(suspects: list, cases: dict, calibration: float, baseline: dict, tolerance: float,
+                        drift: float = 1.0) -> list:
+  """Return (case, ratio) for the suspects that still regress after re-timing (see CONFIRM_ROUNDS).
+  Every round times the calibration loop again first; when it ran slower than
+  `calibration` by more than the run's `drift`, that slowdown replaces the
+  drift, so a busy moment slows the expectation along with the suspects
+  instead of confirming them.
+  """
+  scale = calibration / baseline["calibration"]
+  history = {case: [] for case, _ in suspects}
+  confirmed = []
+  for round_number in range(MAX_RETIME_ROUNDS):
+    if not history:
+      break
+    busy = max(drift, time_call(calibration_workload, CALIBRATION_REPEAT)["best"] / calibration)
+    for case in list(history):
+      best = time_call(cases[case], RETIME_REPEAT)["best"]
+      ratio = regression_ratio(best, baseline["results"][case]["best"] * scale * busy, tolerance)
+      if not ratio:
+        del history[case]
+        continue
+      ratios = history[case][-(CONFIRM_ROUNDS - 1):] + [ratio]
+      history[case].append(ratio)
+      consistent = len(ratios) == CONFIRM_ROUNDS and max(ratios) <= min(ratios) * (1 + CONSISTENCY)
+      if consistent or round_number == MAX_RETIME_ROUNDS - 1:
+        confirmed.append((case, min(ratios)))
+        del history[case]
+  return confirmed
+
+# Utility: Format a duration in seconds with a readable unit
+def format_seconds(seconds: float) -> str:
+  if seconds < 1e-3:
+    return f"{seconds * 1e6:9.1f} µs"
+  return f"{seconds * 1e3:9.2f} ms"
+
+def main():
+  parser = argparse.ArgumentParser(description="Microbenchmarks for workflow building and history parsing")
+  parser.add_argument("--nodes", default=DEFAULT_NODES, help="Comma-separated node counts of the synthetic graphs")
+  parser.add_argument("--outputs", type=int, default=DEFAULT_OUTPUTS, help="Outputs in the synthetic history")
+  parser.add_argument("--repeat", type=int, default=DEFAULT_REPEAT, help="Timing runs per case (the best one is kept)")
+  parser.add_argument("--filter", help="Only run cases whose name contains this text")
+  parser.add_argument("--baseline", default=BASELINE_PATH, help="Baseline file for --save/--check")
+  parser.add_argument("--save", action="store_true", help="Write the results as the new baseline")
+  parser.add_argument("--check", action="store_true", help="Exit with status 1 if a case regressed against the baseline")
+  parser.add_argument("--tolerance", type=float, default=DEFAULT_TOLERANCE,
+                      help="Allowed slowdown for --check (0.3 = 30%% slower than baseline)")
+  args = parser.parse_args()
+
+  baseline = None
+  if args.check:
+    with open(args.baseline, "r", encoding="utf-8") as f:
+      baseline = json.load(f)
+    # Re-run the baseline's sizes so the synthetic cases are comparable
+    args.nodes = ",".join(str(count) for count in baseline["nodes"])
+    args.outputs = baseline["outputs"]
+  node_counts = [int(count) for count in args.nodes.split(",") if count.strip()]
+
+  # Log records would dominate the per-call times (and flood the terminal)
+  logging.disable(logging.INFO)
+
+  calibration = time_call(calibration_workload, CALIBRATION_REPEAT)["best"]
+  cases = {}
+  results = {}
+  print(f"{'case':<72} {'best':>12} {'median':>12} {'vs base':>8}")
+  for name, func in build_cases(node_counts, args.outputs):
+    if args.filter and args.filter not in name:
+      continue
+    cases[name] = func
+    result = time_call(func, args.repeat)
+    results[name] = {key: result[key] for key in ("best", "median")}
+    versus = ""
+    if baseline is not None and name in baseline["results"]:
+      scale = calibration / baseline["calibration"]
+      versus = f"{result['best'] / (baseline['results'][name]['best'] * scale):7.2f}x"
+    print(f"{name:<72} {format_seconds(result['best'])} {format_seconds(result['median'])} {versus:>8}")
+  # Slower calibration runs only mean the machine was busy; keep the fastest
+  calibration = min(calibration, time_call(calibration_workload, CALIBRATION_REPEAT)["best"])
+
+  if args.save:
+    if args.filter:
+      raise SystemExit("Refusing to save a filtered run as the baseline")
+    with open(args.baseline, "w", encoding="utf-8") as f:
+      json.dump({
+        "created": time.strftime("%Y-%m-%dT%H:%M:%S"),
+        "python": platform.python_version(),
+        "machine": platform.machine(),
+        "calibration": calibration,
+        "nodes": node_counts,
+        "outputs": args.outputs,
+        "results": results,
+      }, f, indent=2)
+      f.write("\n")
+    print(f"Baseline written to {args.baseline}")
+
+  if baseline is not None:
+    drift = run_drift(results, calibration, baseline)
+    if drift > 1:
+      print(f"Run was {drift:.2f}x the calibrated baseline overall; cases are compared after that drift")
+    suspects = check_regressions(results, calibration, baseline, args.tolerance, drift)
+    if suspects:
+      print(f"Re-timing {len(suspects)} suspected regression(s): {', '.join(name for name, _ in suspects)}")
+    regressions = confirm_regressions(suspects, cases, calibration, baseline, args.tolerance, drift)
+    for name, ratio in regressions:
+      print(f"REGRESSION {name}: still {ratio:.2f}x the baseline after re-timing "
+            f"(tolerance {1 + args.tolerance:.2f}x, {1 + args.tolerance + LARGE_CASE_MARGIN:.2f}x above "
+            f"{LARGE_CASE * 1e3:g} ms per call)")
+    if regressions:
+      sys.exit(1)
+    print(f"No regressions beyond {args.tolerance:.0%} against {args.baseline}")
+
+if __name__ == "__main__":
+  main()
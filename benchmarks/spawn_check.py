@@ -0,0 +1,93 @@
+# 🧪 benchmarks/spawn_check.py - Comfynaut Powder Test
+# "Light one fuse in the yard before trusting the whole magazine to it."
+#
+# Checks that starting a delivery worker leaves the server's files alone.
+# DeliveryTranscoder (delivery.py) uses the spawn start method, and spawned
+# workers re-import the main module: with `python api_server.py` that is
+# api_server.py itself, run as __mp_main__. Everything it does at module level
+# therefore runs again in every worker. This script points the caches and the
+# job store at a scratch directory, fills it with files a running server would
+# own, makes a real delivery variant with api_server.py as the main module, and
+# fails if the worker created, changed or removed anything there.
+#
+# Key features:
+# - Real spawned worker re-importing api_server.py (no mocks)
+# - Covers RESULT_CACHE_DIR, OUTPUT_CACHE_DIR and JOB_STORE_PATH
+# - Exits non-zero when a worker touched the scratch files
+#
+# Usage:
+#   python benchmarks/spawn_check.py
+
+import __main__
+import asyncio
+import os
+import sys
+import tempfile
+
+REPO_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, REPO_DIR)
+
+from fake_comfyui import make_png
+
+# Utility: Every file and directory under a path, with file sizes
+def snapshot(root: str) -> dict:
+  found = {}
+  for directory, names, files in os.walk(root):
+    for name in names:
+      found[os.path.relpath(os.path.join(directory, name), root)] = None
+    for name in files:
+      path = os.path.join(directory, name)
+      found[os.path.relpath(path, root)] = os.path.getsize(path)
+  return found
+
+# Utility: Files a running server would own, in a scratch directory
+def populate(root: str) -> dict:
+  """Create cache entries for the settings api_server.py reads; return the environment pointing at them."""
+  result_entry = os.path.join(root, "results", "0" * 64)
+  output_entry = os.path.join(root, "outputs", "00000000-0000-0000-0000-000000000000")
+  for directory in (result_entry, output_entry):
+    os.makedirs(directory)
+  with open(os.path.join(result_entry, "0000000000000000.png"), "wb") as f:
+    f.write(make_png(8, 8))
+  with open(os.path.join(output_entry, "0000000000000000_ComfyUI_00001_.png"), "wb") as f:
+    f.write(make_png(8, 8))
+  return {
+    "RESULT_CACHE_DIR": os.path.join(root, "results"),
+    "OUTPUT_CACHE_DIR": os.path.join(root, "outputs"),
+    "JOB_STORE_PATH": os.path.join(root, "jobs.db"),
+  }
+
+async def make_variant(root: str):
+  """Start a delivery worker (re-importing api_server.py) and have it make one image variant."""
+  from delivery import DeliveryTranscoder
+  transcoder = DeliveryTranscoder(workers=1, image_format="jpeg", ffmpeg="")
+  transcoder.start()
+  if not transcoder.enabled:
+    raise SystemExit("Pillow is not installed: no delivery worker to start")
+  source = os.path.join(root, "source.png")
+  with open(source, "wb") as f:
+    f.write(make_png(64, 48))
+  try:
+    await transcoder.transcode("image", source, os.path.join(root, "variant.jpg"))
+  finally:
+    await transcoder.close()
+
+def main():
+  with tempfile.TemporaryDirectory() as scratch:
+    server_files = os.path.join(scratch, "server")
+    os.environ.update(populate(server_files))
+    before = snapshot(server_files)
+    # Spawned workers import __main__.__file__ as __mp_main__: make that api_server.py, as when it is run directly
+    __main__.__file__ = os.path.join(REPO_DIR, "api_server.py")
+    asyncio.run(make_variant(scratch))
+    after = snapshot(server_files)
+  changed = sorted(path for path in set(before) | set(after) if before.get(path, -1) != after.get(path, -1))
+  for path in changed:
+    state = "removed" if path not in after else "created" if path not in before else "changed"
+    print(f"FAIL {path}: {state} by a delivery worker starting up")
+  if changed:
+    sys.exit(1)
+  print("Delivery workers left the caches and the job store alone")
+
+if __name__ == "__main__":
+  main()
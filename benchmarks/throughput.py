@@ -0,0 +1,203 @@
+# 📊 benchmarks/throughput.py - Comfynaut Regatta
+# "Line the ships up, fire the starting cannon, and time every one to the harbour."
+#
+# End-to-end throughput benchmark for the API server. By default it starts the
+# fake ComfyUI (benchmarks/fake_comfyui.py) and an API server pointed at it,
+# then drives /dream, /img2img and /img2vid at each concurrency level and
+# reports throughput and latency percentiles. With --api it benchmarks an
+# already running API server instead.
+#
+# Key features:
+# - Self-contained: no GPU, ComfyUI or Telegram needed
+# - Fixed concurrency levels with a fixed number of requests per level
+# - Throughput, p50/p95/p99/max latency and error counts per endpoint
+# - Optional JSON report (--json) for comparing runs
+#
+# Usage:
+#   python benchmarks/throughput.py --concurrency 1,4,16 --requests 32
+#   python benchmarks/throughput.py --endpoints dream --node-delay 0 --json results.json
+
+import argparse
+import asyncio
+import base64
+import json
+import math
+import os
+import socket
+import subprocess
+import sys
+import time
+import uuid
+
+import httpx
+
+from fake_comfyui import make_png
+
+REPO_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+# Endpoints the benchmark can drive
+ENDPOINTS = ("dream", "img2img", "img2vid")
+
+# How long to wait for the spawned servers to come up (in seconds)
+STARTUP_TIMEOUT = 30
+
+# Utility: Find a free local TCP port
+def free_port() -> int:
+  with socket.socket() as sock:
+    sock.bind(("127.0.0.1", 0))
+    return sock.getsockname()[1]
+
+# Utility: Nearest-rank percentile
+def percentile(values, q: float) -> float:
+  ordered = sorted(values)
+  return ordered[max(0, math.ceil(q * len(ordered)) - 1)]
+
+# Utility: Build the request body for one benchmark request
+def request_body(endpoint: str, index: int, image_b64: str) -> dict:
+  """Unique prompt per request, so the result cache never short-circuits a run."""
+  prompt = f"benchmark {endpoint} {index} {uuid.uuid4().hex[:8]}"
+  if endpoint == "dream":
+    return {"prompt": prompt}
+  return {"prompt": prompt, "image_data": image_b64}
+
+# Utility: Wait until a URL answers
+async def wait_until_up(url: str, process: subprocess.Popen = None):
+  """Poll `url` until it responds. Raises RuntimeError if the process exits or time runs out."""
+  deadline = time.monotonic() + STARTUP_TIMEOUT
+  async with httpx.AsyncClient(timeout=2) as client:
+    while time.monotonic() < deadline:
+      if process is not None and process.poll() is not None:
+        raise RuntimeError(f"Server for {url} exited with code {process.returncode}")
+      try:
+        await client.get(url)
+        return
+      except httpx.HTTPError:
+        await asyncio.sleep(0.2)
+  raise RuntimeError(f"{url} did not come up within {STARTUP_TIMEOUT}s")
+
+# Utility: Start the fake ComfyUI and an API server pointed at it
+def start_servers(args) -> tuple:
+  """Return (api_url, comfy_url, [processes]) for a fake ComfyUI + API server pair."""
+  comfy_port, api_port = free_port(), free_port()
+  fake_cmd = [sys.executable, os.path.join(REPO_DIR, "benchmarks", "fake_comfyui.py"),
+              "--port", str(comfy_port), "--node-delay", str(args.node_delay)]
+  for item in args.delay or []:
+    fake_cmd += ["--delay", item]
+  env = dict(os.environ)
+  env["COMFYUI_HOST"] = f"127.0.0.1:{comfy_port}"
+  env.pop("COMFYUI_HOSTS", None)
+  # Measure the API layer, not admission control or the cache (override by exporting them)
+  for name in ("MAX_ACTIVE_T2I_JOBS", "MAX_ACTIVE_I2I_JOBS", "MAX_ACTIVE_I2V_JOBS", "RESULT_CACHE_SIZE"):
+    env.setdefault(name, "0")
+  # Keep benchmark jobs out of the real job store (a later start would try to re-attach them)
+  # and their files out of the real output cache
+  env.setdefault("JOB_STORE_PATH", "")
+  env.setdefault("OUTPUT_CACHE_DIR", "")
+  api_cmd = [sys.executable, "-m", "uvicorn", "api_server:app", "--port", str(api_port), "--log-level", "warning"]
+  output = None if args.verbose else subprocess.DEVNULL
+  processes = [
+    subprocess.Popen(fake_cmd, cwd=REPO_DIR, stdout=output, stderr=output),
+    subprocess.Popen(api_cmd, cwd=REPO_DIR, env=env, stdout=output, stderr=output),
+  ]
+  return f"http://127.0.0.1:{api_port}", f"http://127.0.0.1:{comfy_port}", processes
+
+# Utility: Run one endpoint at one concurrency level
+async def run_level(client: httpx.AsyncClient, endpoint: str, concurrency: int, requests: int, image_b64: str) -> dict:
+  """Send `requests` requests, `concurrency` at a time, and summarize the results."""
+  semaphore = asyncio.Semaphore(concurrency)
+  latencies, errors = [], {}
+
+  async def one(index: int):
+    async with semaphore:
+      start = time.perf_counter()
+      try:
+        resp = await client.post(f"/{endpoint}", json=request_body(endpoint, index, image_b64))
+        ok = resp.status_code == 200 and resp.json().get("status") == "success"
+        reason = "ok" if ok else f"HTTP {resp.status_code}" if resp.status_code != 200 else "status error"
+      except httpx.HTTPError as e:
+        reason = type(e).__name__
+      if reason == "ok":
+        latencies.append(time.perf_counter() - start)
+      else:
+        errors[reason] = errors.get(reason, 0) + 1
+
+  started = time.perf_counter()
+  await asyncio.gather(*(one(index) for index in range(requests)))
+  elapsed = time.perf_counter() - started
+  result = {
+    "endpoint": endpoint,
+    "concurrency": concurrency,
+    "requests": requests,
+    "ok": len(latencies),
+    "errors": errors,
+    "seconds": round(elapsed, 3),
+    "throughput": round(len(latencies) / elapsed, 2) if elapsed else 0.0,
+  }
+  if latencies:
+    result.update({
+      "p50": round(percentile(latencies, 0.5), 4),
+      "p95": round(percentile(latencies, 0.95), 4),
+      "p99": round(percentile(latencies, 0.99), 4),
+      "max": round(max(latencies), 4),
+    })
+  return result
+
+# Utility: Print one result row
+def print_row(result: dict):
+  errors = sum(result["errors"].values())
+  print(f"{result['endpoint']:<9} {result['concurrency']:>5} {result['ok']:>5}/{result['requests']:<5} "
+        f"{result['throughput']:>8.2f} {result.get('p50', 0):>8.3f} {result.get('p95', 0):>8.3f} "
+        f"{result.get('p99', 0):>8.3f} {result.get('max', 0):>8.3f} {errors:>6}")
+
+async def run(args) -> list:
+  processes = []
+  api_url = args.api
+  try:
+    if api_url is None:
+      api_url, comfy_url, processes = start_servers(args)
+      await wait_until_up(comfy_url + "/system_stats", processes[0])
+      await wait_until_up(api_url + "/", processes[1])
+    image_b64 = base64.b64encode(make_png(args.image_size, args.image_size)).decode()
+    levels = [int(level) for level in args.concurrency.split(",")]
+    endpoints = [endpoint.strip() for endpoint in args.endpoints.split(",")]
+    results = []
+    print(f"{'endpoint':<9} {'conc':>5} {'ok/total':>11} {'req/s':>8} {'p50 s':>8} {'p95 s':>8} {'p99 s':>8} {'max s':>8} {'errors':>6}")
+    async with httpx.AsyncClient(base_url=api_url, timeout=args.timeout,
+                                 limits=httpx.Limits(max_connections=max(levels))) as client:
+      for endpoint in endpoints:
+        if endpoint not in ENDPOINTS:
+          raise SystemExit(f"Unknown endpoint '{endpoint}', expected one of {', '.join(ENDPOINTS)}")
+        # One warm-up request (template parsing, WebSocket connect, first upload)
+        await run_level(client, endpoint, 1, 1, image_b64)
+        for level in levels:
+          result = await run_level(client, endpoint, level, args.requests, image_b64)
+          results.append(result)
+          print_row(result)
+    return results
+  finally:
+    for process in processes:
+      process.terminate()
+    for process in processes:
+      process.wait(timeout=10)
+
+def main():
+  parser = argparse.ArgumentParser(description="End-to-end API server throughput benchmark")
+  parser.add_argument("--api", help="Benchmark this running API server instead of spawning one with a fake ComfyUI")
+  parser.add_argument("--endpoints", default=",".join(ENDPOINTS), help="Comma-separated: dream,img2img,img2vid")
+  parser.add_argument("--concurrency", default="1,4,16", help="Comma-separated concurrency levels")
+  parser.add_argument("--requests", type=int, default=32, help="Requests per endpoint and concurrency level")
+  parser.add_argument("--node-delay", type=float, default=0.005, help="Fake ComfyUI seconds per node")
+  parser.add_argument("--delay", action="append", metavar="CLASS=SECONDS", help="Fake ComfyUI per class_type delay")
+  parser.add_argument("--image-size", type=int, default=512, help="Width/height of the input PNG for img2img/img2vid")
+  parser.add_argument("--timeout", type=float, default=600, help="Per-request timeout in seconds")
+  parser.add_argument("--json", help="Write the results to this JSON file")
+  parser.add_argument("--verbose", action="store_true", help="Show the spawned servers' output")
+  args = parser.parse_args()
+  results = asyncio.run(run(args))
+  if args.json:
+    with open(args.json, "w", encoding="utf-8") as f:
+      json.dump({"created": time.time(), "args": vars(args), "results": results}, f, indent=2)
+    print(f"Results written to {args.json}")
+
+if __name__ == "__main__":
+  main()
@@ -0,0 +1,838 @@
+# 🛰️ comfy_client.py - Comfynaut ComfyUI Messenger
+# "A wizard's raven never waits at the door—it drops the letter and flies on."
+#
+# This file implements the asynchronous ComfyUI client used by api_server.py.
+# All HTTP traffic goes through one pooled httpx.AsyncClient with keep-alive
+# connections, and execution tracking uses async WebSockets, so a single API
+# process can keep many image and video jobs in flight without ever blocking
+# the event loop.
+#
+# Key features:
+# - Pooled keep-alive HTTP connections (httpx.AsyncClient)
+# - Async helpers for /prompt, /upload/image, /history, /queue and streaming /view
+# - Prompt cancellation (delete from /queue or /interrupt), also when a wait times out
+# - One long-lived, auto-reconnecting WebSocket per backend, routing events
+#   to per-prompt futures by prompt_id
+# - Outputs collected from `executed` events as they arrive (no /history round-trip)
+# - Re-attaching to prompts queued by an earlier process (after an API server restart)
+# - Multi-backend pool with health checks and queue-depth-aware routing
+# - Output readiness probes (MP4 box walk or stable size over Range requests on /view)
+
+import asyncio
+import json
+import logging
+import os
+import struct
+import time
+import uuid
+from collections import OrderedDict
+import httpx
+import websockets
+
+logger = logging.getLogger("comfynaut.comfy")
+
+# HTTP timeouts (in seconds)
+HTTP_TIMEOUT = 10         # Default timeout for small JSON requests (/prompt, /history, ...)
+UPLOAD_TIMEOUT = 30       # Timeout for image uploads
+DOWNLOAD_TIMEOUT = 300    # Timeout for streaming output files from /view
+
+# Connection pool limits, shared by every request to a ComfyUI backend
+HTTP_MAX_CONNECTIONS = int(os.getenv("COMFYUI_MAX_CONNECTIONS", "100"))
+HTTP_MAX_KEEPALIVE = int(os.getenv("COMFYUI_MAX_KEEPALIVE", "20"))
+
+# WebSocket settings for real-time communication
+WS_CONNECT_TIMEOUT = 10    # WebSocket connection timeout in seconds
+WS_RECONNECT_MIN = 1       # First reconnect delay in seconds (doubles on each failure)
+WS_RECONNECT_MAX = 30      # Upper bound for the reconnect delay
+MAX_TRACKED_PROMPTS = 1000 # Finished prompt states kept around for late waiters
+MAX_QUEUE_WAIT = float(os.getenv("COMFYUI_MAX_QUEUE_WAIT", "3600"))  # Longest wait for a queued prompt to start
+
+# Backend pool settings
+HEALTH_CHECK_INTERVAL = float(os.getenv("COMFYUI_HEALTH_CHECK_INTERVAL", "10"))  # Seconds between /queue + /system_stats checks
+MAX_PROMPT_ROUTES = 10000  # prompt_id -> backend mappings remembered for sticky lookups
+
+# Input images known to be on a backend (content hash -> filename), per backend
+MAX_UPLOAD_INDEX = 4096
+INPUT_RECHECK_INTERVAL = 60  # Seconds an indexed input is trusted before HEAD /view checks it again
+
+# Output readiness probes (videos may still be flushing when `executed` arrives)
+OUTPUT_READY_TIMEOUT = float(os.getenv("OUTPUT_READY_TIMEOUT", "10"))  # Longest wait for a complete file
+OUTPUT_READY_INTERVAL = 0.05  # First delay between probes (doubles up to OUTPUT_READY_MAX_INTERVAL)
+OUTPUT_READY_MAX_INTERVAL = 1.0
+MP4_EXTENSIONS = (".mp4", ".m4v", ".mov")
+MP4_MAX_BOXES = 64  # Top-level boxes walked before giving up on a file
+
+class ComfyUIError(Exception):
+  """Raised when ComfyUI rejects a request or returns an unusable response."""
+
+class PromptRejectedError(ComfyUIError):
+  """Raised when /prompt refuses a workflow (validation errors, e.g. a missing input file).
+  `body` holds ComfyUI's response text, with the offending nodes and values.
+  """
+
+  def __init__(self, message: str, body: str = ""):
+    super().__init__(message)
+    self.body = body
+
+class ComfyUIClient:
+  """Async client for a single ComfyUI backend.
+  One instance owns one pooled httpx.AsyncClient; create it once and share it
+  between requests instead of opening a new connection per call.
+  """
+
+  def __init__(self, host: str):
+    self.host = host
+    self.api_url = f"http://{host}"
+    self.ws_url = f"ws://{host}/ws"
+    self._http = None
+    self._events = None
+    # Health, refreshed by ComfyBackendPool
+    self.healthy = True
+    self.queue_depth = 0      # Running + pending prompts reported by /queue
+    self.system_stats = None  # Last /system_stats payload
+    self.last_check = None
+    self.submitting = 0       # Uploads / prompt submissions in progress (counted as load)
+    self._uploads = OrderedDict()  # sha256 -> (input filename already on this backend, time last seen there)
+
+  @property
+  def http(self) -> httpx.AsyncClient:
+    """The pooled HTTP client, created lazily on first use."""
+    if self._http is None or self._http.is_closed:
+      self._http = httpx.AsyncClient(
+        base_url=self.api_url,
+        timeout=HTTP_TIMEOUT,
+        limits=httpx.Limits(
+          max_connections=HTTP_MAX_CONNECTIONS,
+          max_keepalive_connections=HTTP_MAX_KEEPALIVE,
+        ),
+      )
+    return self._http
+
+  @property
+  def events(self) -> "ComfyEventListener":
+    """The shared WebSocket listener, created lazily on first use."""
+    if self._events is None:
+      self._events = ComfyEventListener(self)
+    return self._events
+
+  async def close(self):
+    """Stop the WebSocket listener and close the pooled HTTP client."""
+    if self._events is not None:
+      await self._events.stop()
+    if self._http is not None:
+      await self._http.aclose()
+      self._http = None
+
+  async def queue_prompt(self, payload: dict) -> str:
+    """Submit a workflow to /prompt and return its prompt_id.
+    The prompt is queued under the shared listener's client_id so its events
+    arrive on the already-open WebSocket; tracking starts before we return.
+    """
+    self.submitting += 1
+    try:
+      connected = await self.events.ensure_connected()
+      payload["client_id"] = self.events.client_id
+      resp = await self.http.post("/prompt", json=payload)
+      if resp.status_code == 400:
+        raise PromptRejectedError(f"ComfyUI rejected the workflow: {describe_rejection(resp)}", resp.text)
+      resp.raise_for_status()
+      prompt_id = resp.json().get("prompt_id")
+      if not prompt_id:
+        raise ComfyUIError("No prompt_id from ComfyUI!")
+      state = self.events.track(prompt_id)
+      if not connected:
+        state.events_missed = True
+      return prompt_id
+    finally:
+      self.submitting -= 1
+
+  async def upload_image(self, filename: str, image_data, content_type: str = "image/png") -> dict:
+    """Upload an input image to /upload/image and return ComfyUI's response."""
+    files = {
+      "image": (filename, image_data, content_type),
+      "overwrite": (None, "true"),
+    }
+    self.submitting += 1
+    try:
+      resp = await self.http.post("/upload/image", files=files, timeout=UPLOAD_TIMEOUT)
+      resp.raise_for_status()
+      return resp.json()
+    finally:
+      self.submitting -= 1
+
+  async def has_input(self, filename: str) -> bool:
+    """Check (HEAD /view) whether ComfyUI's input folder has a file."""
+    resp = await self.http.head("/view", params={"filename": filename, "subfolder": "", "type": "input"})
+    return resp.status_code == 200
+
+  async def has_output(self, output_info: dict) -> bool:
+    """Check (HEAD /view) whether ComfyUI still has an output file."""
+    params = {
+      "filename": output_info["filename"],
+      "subfolder": output_info.get("subfolder", ""),
+      "type": output_info.get("type", "output"),
+    }
+    resp = await self.http.head("/view", params=params)
+    return resp.status_code == 200
+
+  async def ensure_input_image(self, digest: str, filename: str, image_data, content_type: str = "image/png") -> bool:
+    """Make sure an input image is on this backend, uploading it only if needed.
+    Filenames are expected to be derived from `digest`, so an existing file of
+    that name already holds these bytes. The index is trusted for
+    INPUT_RECHECK_INTERVAL seconds; older entries are checked with HEAD /view
+    again, as ComfyUI's input folder may have been cleaned in the meantime.
+    Args:
+      digest: SHA-256 hex digest of image_data
+      filename: Name to upload under
+      image_data: Image bytes (or file object)
+    Returns:
+      True if the image was uploaded, False if the backend already had it
+    """
+    known = self._uploads.get(digest)
+    if known is not None and known[0] == filename and time.monotonic() - known[1] < INPUT_RECHECK_INTERVAL:
+      self._uploads.move_to_end(digest)
+      return False
+    try:
+      exists = await self.has_input(filename)
+    except httpx.HTTPError as e:
+      logger.warning("Could not check for input %s on %s: %s", filename, self.host, e)
+      exists = False
+    if not exists:
+      await self.upload_image(filename, image_data, content_type)
+    self._uploads[digest] = (filename, time.monotonic())
+    self._uploads.move_to_end(digest)
+    while len(self._uploads) > MAX_UPLOAD_INDEX:
+      self._uploads.popitem(last=False)
+    return not exists
+
+  def forget_input(self, filename: str):
+    """Drop an input file from the uploaded-input index (e.g. after /prompt reported it missing)."""
+    for digest in [digest for digest, (known, _) in self._uploads.items() if known == filename]:
+      del self._uploads[digest]
+
+  def forget_inputs(self):
+    """Drop the uploaded-input index (files will be re-checked with HEAD /view)."""
+    self._uploads.clear()
+
+  async def get_history(self, prompt_id: str):
+    """Fetch the /history entry for a prompt.
+    Returns:
+      The history entry dict, or None if ComfyUI has no record of the prompt yet
+    """
+    resp = await self.http.get(f"/history/{prompt_id}")
+    if resp.status_code != 200:
+      logger.warning("Could not fetch /history/%s, status %s", prompt_id, resp.status_code)
+      return None
+    return resp.json().get(prompt_id)
+
+  async def get_queue(self) -> dict:
+    """Fetch ComfyUI's /queue (running and pending prompts)."""
+    resp = await self.http.get("/queue")
+    resp.raise_for_status()
+    return resp.json()
+
+  async def cancel_prompt(self, prompt_id: str):
+    """Stop a prompt: delete it from ComfyUI's queue if pending, interrupt it if running.
+    ComfyUI sends no event for a deleted prompt, so its state is finished here
+    as "interrupted"; a running prompt reports execution_interrupted itself.
+    Returns:
+      "deleted", "interrupted", or None if the prompt is no longer queued or running
+    """
+    queue = await self.get_queue()
+    pending = {item[1] for item in queue.get("queue_pending", [])}
+    running = {item[1] for item in queue.get("queue_running", [])}
+    state = self.events.get(prompt_id)
+    if prompt_id in pending:
+      resp = await self.http.post("/queue", json={"delete": [prompt_id]})
+      resp.raise_for_status()
+      if state is None or state.status == "pending":
+        if state is not None:
+          state.finish("interrupted", {"reason": "deleted from queue"})
+        return "deleted"
+      running.add(prompt_id)  # It started while we were deleting it
+    if prompt_id in running:
+      # The prompt_id makes ComfyUI ignore the interrupt if another prompt is running by now
+      resp = await self.http.post("/interrupt", json={"prompt_id": prompt_id})
+      resp.raise_for_status()
+      return "interrupted"
+    return None
+
+  async def open_view(self, output_info: dict, headers: dict = None) -> httpx.Response:
+    """Open a streaming GET /view response for an output entry.
+    The caller must close the response (`await resp.aclose()`) when done.
+    """
+    params = {
+      "filename": output_info["filename"],
+      "subfolder": output_info.get("subfolder", ""),
+      "type": output_info.get("type", "output"),
+    }
+    request = self.http.build_request("GET", "/view", params=params, headers=headers, timeout=DOWNLOAD_TIMEOUT)
+    return await self.http.send(request, stream=True)
+
+  async def read_output_range(self, output_info: dict, start: int, end: int):
+    """Read bytes start..end (inclusive) of an output file with a Range request on /view.
+    Returns:
+      (data, total_size): data is None if ComfyUI ignored the Range header;
+      total_size is None if ComfyUI did not report it
+    Raises:
+      httpx.HTTPError: on transport errors or error statuses (e.g. 404 before the file exists)
+    """
+    resp = await self.open_view(output_info, headers={"Range": f"bytes={start}-{end}"})
+    try:
+      resp.raise_for_status()
+      if resp.status_code == 206:
+        total = resp.headers.get("content-range", "").rpartition("/")[2]
+        return await resp.aread(), int(total) if total.isdigit() else None
+      length = resp.headers.get("content-length", "")
+      return None, int(length) if length.isdigit() else None
+    finally:
+      await resp.aclose()
+
+  async def mp4_complete(self, output_info: dict, size: int) -> bool:
+    """Whether an MP4/MOV file's top-level boxes end exactly at `size` and include `moov`.
+    ffmpeg writes `moov` (the index) last and patches the `mdat` size when it
+    finishes, so a file still being encoded fails this check.
+    """
+    offset, has_moov = 0, False
+    for _ in range(MP4_MAX_BOXES):
+      if offset == size:
+        return has_moov
+      if offset + 8 > size:
+        return False
+      header, _ = await self.read_output_range(output_info, offset, offset + 15)
+      if header is None or len(header) < 8:
+        return False
+      box_size, box_type = struct.unpack(">I4s", header[:8])
+      if box_size == 1 and len(header) >= 16:
+        box_size = struct.unpack(">Q", header[8:16])[0]  # 64-bit size
+      elif box_size == 0:
+        box_size = size - offset  # Box runs to the end of the file
+      if box_size < 8:
+        return False
+      has_moov = has_moov or box_type == b"moov"
+      offset += box_size
+    return False
+
+  async def wait_for_output_ready(self, output_info: dict, timeout: float = OUTPUT_READY_TIMEOUT) -> bool:
+    """Wait until an output file is completely written, probing /view with Range requests.
+    MP4/MOV files are ready once their box structure is complete; other files
+    (or servers ignoring Range) once their size is unchanged between two probes.
+    Returns as soon as the file is ready.
+    Args:
+      output_info: Output entry (see list_outputs)
+      timeout: Longest time to keep probing, in seconds
+    Returns:
+      True if the file was confirmed complete, False on timeout
+    """
+    deadline = time.monotonic() + timeout
+    delay = OUTPUT_READY_INTERVAL
+    previous = None
+    is_mp4 = output_info["filename"].lower().endswith(MP4_EXTENSIONS)
+    while True:
+      try:
+        data, size = await self.read_output_range(output_info, 0, 15)
+        if size:
+          if is_mp4 and data is not None:
+            if await self.mp4_complete(output_info, size):
+              return True
+          elif size == previous:
+            return True
+          previous = size
+      except httpx.HTTPError as e:
+        logger.debug("Readiness probe for %s failed: %s", output_info["filename"], e)
+      if time.monotonic() + delay > deadline:
+        logger.warning("Output %s not confirmed complete after %ss", output_info["filename"], timeout)
+        return False
+      await asyncio.sleep(delay)
+      delay = min(delay * 2, OUTPUT_READY_MAX_INTERVAL)
+
+  async def get_system_stats(self) -> dict:
+    """Fetch ComfyUI's /system_stats (devices, VRAM, versions)."""
+    resp = await self.http.get("/system_stats")
+    resp.raise_for_status()
+    return resp.json()
+
+  @property
+  def inflight(self) -> int:
+    """Prompts this process queued (or is queueing) on the backend that have not finished yet."""
+    return self.events.pending_count() + self.submitting
+
+  @property
+  def load(self) -> int:
+    """Routing load: the larger of the last reported queue depth and our live in-flight count."""
+    return max(self.queue_depth, self.inflight)
+
+  async def check_health(self) -> bool:
+    """Refresh queue depth and system stats; mark the backend unhealthy on failure."""
+    try:
+      queue, stats = await asyncio.gather(self.get_queue(), self.get_system_stats())
+    except Exception as e:
+      if self.healthy:
+        logger.warning("ComfyUI backend %s is unhealthy: %s", self.host, e)
+      self.healthy = False
+    else:
+      if not self.healthy:
+        logger.info("ComfyUI backend %s is healthy again", self.host)
+      self.healthy = True
+      self.queue_depth = len(queue.get("queue_running", [])) + len(queue.get("queue_pending", []))
+      self.system_stats = stats
+    self.last_check = time.time()
+    return self.healthy
+
+  def status(self) -> dict:
+    """JSON-friendly health summary for this backend."""
+    devices = (self.system_stats or {}).get("devices", [])
+    return {
+      "host": self.host,
+      "healthy": self.healthy,
+      "connected": self.events.connected.is_set(),
+      "queue_depth": self.queue_depth,
+      "inflight": self.inflight,
+      "last_check": self.last_check,
+      "devices": [
+        {"name": d.get("name"), "vram_total": d.get("vram_total"), "vram_free": d.get("vram_free")}
+        for d in devices
+      ],
+    }
+
+  async def start(self):
+    """Start the background WebSocket listener for this backend."""
+    self.events.start()
+
+  async def wait_for_execution(self, prompt_id: str, timeout: float) -> bool:
+    """Wait for a prompt to finish executing via the shared WebSocket listener.
+    Args:
+      prompt_id: The prompt ID to wait for
+      timeout: Maximum time to wait for execution in seconds
+    Returns:
+      True if execution completed successfully, False otherwise
+    """
+    state = await self.events.wait(prompt_id, timeout)
+    if state.status == "success":
+      logger.info("Execution completed for prompt %s (took %.1fs)", prompt_id, state.elapsed())
+      return True
+    if state.status == "error":
+      logger.error("Execution error for prompt %s: %s", prompt_id, state.error)
+    elif state.status == "interrupted":
+      logger.warning("Execution interrupted for prompt %s", prompt_id)
+    else:
+      if state.started is None:
+        logger.warning("Prompt %s did not start within %ss of queueing", prompt_id, MAX_QUEUE_WAIT)
+      else:
+        logger.warning("WebSocket timeout after %ss waiting for prompt %s", timeout, prompt_id)
+      # Nobody will collect the result; don't leave it occupying the GPU
+      try:
+        outcome = await self.cancel_prompt(prompt_id)
+        if outcome:
+          logger.info("Prompt %s %s after its wait timed out", prompt_id, outcome)
+      except Exception as e:
+        logger.warning("Could not cancel timed-out prompt %s: %s", prompt_id, e)
+    return False
+
+# Utility: Summarize a /prompt validation error
+def describe_rejection(resp: httpx.Response) -> str:
+  """Return ComfyUI's error message plus the details of each failing node, from a 400 /prompt response."""
+  try:
+    body = resp.json()
+  except ValueError:
+    return resp.text[:200] or "HTTP 400"
+  error = body.get("error") or {}
+  message = error.get("message", "HTTP 400") if isinstance(error, dict) else str(error)
+  details = [
+    f"node {node_id}: {problem.get('details') or problem.get('message')}"
+    for node_id, node in (body.get("node_errors") or {}).items()
+    for problem in node.get("errors", [])
+  ]
+  return "; ".join([message] + details)
+
+# Utility: Sort key putting node ids in numeric order ("9" < "77" < "77:3" < "80")
+def node_order(node_id: str) -> tuple:
+  return tuple((0, int(part), "") if part.isdigit() else (1, 0, part) for part in str(node_id).split(":"))
+
+# Utility: Flatten a history/`executed` outputs mapping into an ordered output list
+def list_outputs(outputs: dict) -> list:
+  """Flatten ComfyUI node outputs into a list of output entries.
+  The order is canonical: by node id, then by position within the node. The
+  `executed` events arrive in execution order and /history in whatever order
+  ComfyUI kept, so both are sorted to pick the same "last video" either way.
+  Args:
+    outputs: Mapping of node_id -> node output ({"images": [...], "gifs": [...]})
+  Returns:
+    List of dicts with kind ("images"/"gifs"), node_id, filename, subfolder and type
+  """
+  result = []
+  # Plain numeric ids (the usual case) sort much faster with int()
+  numeric = all(node_id.isdigit() for node_id in outputs)
+  for node_id in sorted(outputs, key=int if numeric else node_order):
+    node_output = outputs[node_id]
+    for kind in ("images", "gifs"):
+      for info in node_output.get(kind, []):
+        result.append({
+          "kind": kind,
+          "node_id": node_id,
+          "filename": info["filename"],
+          "subfolder": info.get("subfolder", ""),
+          "type": info.get("type", "output"),
+        })
+  return result
+
+class PromptState:
+  """Execution state of a single prompt, as reported by ComfyUI events."""
+
+  FINISHED = ("success", "error", "interrupted")
+
+  def __init__(self, prompt_id: str):
+    self.prompt_id = prompt_id
+    self.status = "pending"       # pending -> running -> success / error / interrupted
+    self.current_node = None
+    self.progress = None          # (value, max) of the node currently sampling
+    self.outputs = {}             # node_id -> output dict from `executed` events
+    self.events_missed = False    # True if some events may have been lost (outputs then come from /history)
+    self.error = None
+    self.created = time.monotonic()
+    self.started = None
+    self.finished = None
+    loop = asyncio.get_running_loop()
+    self._started = loop.create_future()
+    self._done = loop.create_future()
+    self._subscribers = []
+
+  def subscribe(self, callback):
+    """Call `callback(msg_type, data)` for every event routed to this prompt."""
+    self._subscribers.append(callback)
+
+  def unsubscribe(self, callback):
+    """Stop delivering events to `callback`."""
+    if callback in self._subscribers:
+      self._subscribers.remove(callback)
+
+  def notify(self, msg_type: str, data: dict):
+    """Forward an event to subscribers; a failing subscriber never breaks dispatch."""
+    for callback in list(self._subscribers):
+      try:
+        callback(msg_type, data)
+      except Exception as e:
+        logger.warning("Event subscriber failed for prompt %s: %s", self.prompt_id, e)
+
+  @property
+  def done(self) -> bool:
+    return self.status in self.FINISHED
+
+  def elapsed(self) -> float:
+    """Seconds between tracking start and completion (or now)."""
+    return (self.finished or time.monotonic()) - self.created
+
+  def mark_running(self):
+    """Record that ComfyUI started executing the prompt."""
+    if self.status == "pending":
+      self.status = "running"
+    if self.started is None:
+      self.started = time.monotonic()
+    if not self._started.done():
+      self._started.set_result(self)
+
+  def finish(self, status: str, error=None):
+    """Mark the prompt as finished and wake up every waiter."""
+    if self.done:
+      return
+    self.status = status
+    self.error = error
+    self.finished = time.monotonic()
+    if not self._started.done():
+      self._started.set_result(self)
+    if not self._done.done():
+      self._done.set_result(self)
+
+  async def wait_started(self):
+    """Wait until the prompt leaves ComfyUI's queue (starts or finishes)."""
+    return await asyncio.shield(self._started)
+
+  async def wait(self):
+    """Wait until the prompt finishes; safe to call from many waiters."""
+    return await asyncio.shield(self._done)
+
+class ComfyEventListener:
+  """One long-lived WebSocket subscription per ComfyUI backend.
+  Every prompt is queued with this listener's client_id, so ComfyUI sends all
+  execution events to a single connection. Events are routed by prompt_id to
+  PromptState objects that any number of coroutines can await. The listener
+  reconnects with exponential backoff and, after each (re)connect, checks
+  /history for prompts that may have finished while it was disconnected.
+  """
+
+  def __init__(self, client: ComfyUIClient):
+    self.client = client
+    self.client_id = str(uuid.uuid4())
+    self.connected = asyncio.Event()
+    self._states = OrderedDict()
+    self._task = None
+
+  def start(self):
+    """Start the listener task (idempotent)."""
+    if self._task is None or self._task.done():
+      self._task = asyncio.get_running_loop().create_task(self._run())
+
+  async def stop(self):
+    """Stop the listener task."""
+    if self._task is not None:
+      self._task.cancel()
+      try:
+        await self._task
+      except asyncio.CancelledError:
+        pass
+      self._task = None
+    self.connected.clear()
+
+  async def ensure_connected(self, timeout: float = WS_CONNECT_TIMEOUT) -> bool:
+    """Start the listener and give it a moment to connect before we queue work."""
+    self.start()
+    try:
+      await asyncio.wait_for(self.connected.wait(), timeout)
+    except asyncio.TimeoutError:
+      logger.warning("ComfyUI WebSocket not connected after %ss, events may be missed", timeout)
+    return self.connected.is_set()
+
+  def get(self, prompt_id: str):
+    """Return the tracked state for a prompt without creating one."""
+    return self._states.get(prompt_id)
+
+  def pending_count(self) -> int:
+    """Number of tracked prompts that have not finished."""
+    return sum(1 for state in self._states.values() if not state.done)
+
+  def track(self, prompt_id: str) -> PromptState:
+    """Return the state for a prompt, creating it if this is the first we hear of it."""
+    state = self._states.get(prompt_id)
+    if state is None:
+      state = self._states[prompt_id] = PromptState(prompt_id)
+      self._evict()
+    return state
+
+  async def reattach(self, prompt_id: str) -> PromptState:
+    """Resume tracking a prompt queued by an earlier process (e.g. before an API server restart).
+    Events sent while nobody listened are lost, so the state is marked
+    events_missed (outputs then come from /history). A prompt in neither
+    /queue nor /history was lost, e.g. because ComfyUI restarted too.
+    Returns:
+      The prompt's state: finished if ComfyUI completed or lost it, else pending/running
+    Raises:
+      httpx.HTTPError: if the backend cannot be reached
+    """
+    self.start()
+    state = self.track(prompt_id)
+    state.events_missed = True
+    # /queue first: a prompt that finishes in between is then found in /history
+    queue = await self.client.get_queue()
+    if any(item[1] == prompt_id for item in queue.get("queue_running", [])):
+      state.mark_running()
+    elif not any(item[1] == prompt_id for item in queue.get("queue_pending", [])):
+      entry = await self.client.get_history(prompt_id)
+      if entry:
+        self._finish_from_history(state, entry)
+      else:
+        state.finish("error", {"reason": "prompt no longer known to ComfyUI"})
+    return state
+
+  async def wait(self, prompt_id: str, timeout: float, queue_timeout: float = MAX_QUEUE_WAIT) -> PromptState:
+    """Wait for a prompt to finish, returning its state (still unfinished on timeout).
+    `timeout` counts from the moment ComfyUI starts executing the prompt; time
+    spent in ComfyUI's queue is bounded separately by `queue_timeout`, so a
+    busy queue does not time out prompts that simply have not started yet.
+    """
+    self.start()
+    state = self.track(prompt_id)
+    if not self.connected.is_set():
+      # Events sent while we are disconnected are lost; /history tells us if it already finished
+      await self._check_history(state)
+    try:
+      await asyncio.wait_for(state.wait_started(), queue_timeout)
+      await asyncio.wait_for(state.wait(), timeout)
+    except asyncio.TimeoutError:
+      await self._check_history(state)
+    return state
+
+  def _evict(self):
+    """Drop the oldest finished states once we track too many prompts."""
+    if len(self._states) <= MAX_TRACKED_PROMPTS:
+      return
+    for prompt_id in list(self._states):
+      if len(self._states) <= MAX_TRACKED_PROMPTS:
+        break
+      if self._states[prompt_id].done:
+        del self._states[prompt_id]
+
+  async def _run(self):
+    """Connect, dispatch events, and reconnect with backoff until cancelled."""
+    ws_url = f"{self.client.ws_url}?clientId={self.client_id}"
+    delay = WS_RECONNECT_MIN
+    while True:
+      try:
+        logger.info("Connecting to ComfyUI WebSocket at %s", ws_url)
+        async with websockets.connect(ws_url, open_timeout=WS_CONNECT_TIMEOUT, max_size=None) as ws:
+          self.connected.set()
+          delay = WS_RECONNECT_MIN
+          await self._resync()
+          async for message in ws:
+            # Binary frames are latent previews; only JSON text frames carry events
+            if isinstance(message, str):
+              self._dispatch(json.loads(message))
+        logger.warning("ComfyUI WebSocket at %s closed, reconnecting...", ws_url)
+      except asyncio.CancelledError:
+        raise
+      except Exception as e:
+        logger.error("ComfyUI WebSocket error at %s: %s (retrying in %ss)", ws_url, e, delay)
+      self.connected.clear()
+      # Events of running prompts may have been lost with the connection
+      for state in self._states.values():
+        if not state.done:
+          state.events_missed = True
+      # The backend may have restarted with a different input folder; re-check uploads
+      self.client.forget_inputs()
+      await asyncio.sleep(delay)
+      delay = min(delay * 2, WS_RECONNECT_MAX)
+
+  async def _resync(self):
+    """Catch up on prompts that may have finished while we were disconnected."""
+    pending = [state for state in self._states.values() if not state.done]
+    await asyncio.gather(*(self._check_history(state) for state in pending))
+
+  async def _check_history(self, state: PromptState):
+    """Finish a prompt from its /history entry, if ComfyUI already completed it."""
+    try:
+      entry = await self.client.get_history(state.prompt_id)
+    except Exception as e:
+      logger.warning("Could not check history for prompt %s: %s", state.prompt_id, e)
+      return
+    if entry:  # ComfyUI only writes history once a prompt has finished
+      self._finish_from_history(state, entry)
+
+  def _finish_from_history(self, state: PromptState, entry: dict):
+    """Finish a prompt from its /history entry."""
+    status = entry.get("status", {}).get("status_str", "success")
+    if status == "success":
+      # History has every output, including any whose `executed` event we missed
+      state.outputs = dict(entry.get("outputs", {}))
+      state.events_missed = False
+      state.finish("success")
+    else:
+      state.finish("error", entry.get("status"))
+
+  def _dispatch(self, message: dict):
+    """Route one ComfyUI event to the state of the prompt it belongs to."""
+    msg_type = message.get("type")
+    data = message.get("data") or {}
+    prompt_id = data.get("prompt_id")
+    if not prompt_id:
+      return  # Global events such as queue `status` updates
+    state = self.track(prompt_id)
+    if msg_type == "execution_start":
+      state.mark_running()
+    elif msg_type == "executing":
+      node = data.get("node")
+      if node is None:
+        # When node is None and prompt_id matches, execution is complete
+        state.finish("success")
+      else:
+        state.mark_running()
+        state.current_node = node
+        state.progress = None
+        logger.debug("Executing node %s for prompt %s", node, prompt_id)
+    elif msg_type == "progress":
+      state.progress = (data.get("value"), data.get("max"))
+    elif msg_type == "executed":
+      state.outputs[data.get("node")] = data.get("output") or {}
+    elif msg_type == "execution_success":
+      state.finish("success")
+    elif msg_type == "execution_error":
+      state.finish("error", data)
+    elif msg_type == "execution_interrupted":
+      state.finish("interrupted", data)
+    state.notify(msg_type, data)
+
+class ComfyBackendPool:
+  """A pool of ComfyUI backends with health checks and least-loaded routing.
+  New jobs go to the healthy backend with the smallest queue; everything that
+  follows (uploads, history, /view) must stay on that backend, so the pool
+  remembers which backend ran each prompt.
+  """
+
+  def __init__(self, hosts: list):
+    if not hosts:
+      raise ValueError("At least one ComfyUI host is required")
+    self.backends = [ComfyUIClient(host) for host in hosts]
+    self._by_host = {backend.host: backend for backend in self.backends}
+    self._routes = OrderedDict()
+    self._health_task = None
+
+  async def start(self):
+    """Start every backend's listener and the periodic health checks."""
+    for backend in self.backends:
+      await backend.start()
+    await self.check_health()
+    if self._health_task is None or self._health_task.done():
+      self._health_task = asyncio.get_running_loop().create_task(self._health_loop())
+
+  async def close(self):
+    """Stop health checks and close every backend."""
+    if self._health_task is not None:
+      self._health_task.cancel()
+      try:
+        await self._health_task
+      except asyncio.CancelledError:
+        pass
+      self._health_task = None
+    for backend in self.backends:
+      await backend.close()
+
+  def get(self, host: str):
+    """Return the backend for a host, or None."""
+    return self._by_host.get(host)
+
+  def pick(self) -> ComfyUIClient:
+    """Return the least-loaded healthy backend (any backend if none is healthy)."""
+    candidates = [backend for backend in self.backends if backend.healthy] or self.backends
+    return min(candidates, key=lambda backend: backend.load)
+
+  def remember(self, prompt_id: str, backend: ComfyUIClient):
+    """Record which backend runs a prompt, for sticky history and /view lookups."""
+    self._routes[prompt_id] = backend.host
+    self._routes.move_to_end(prompt_id)
+    while len(self._routes) > MAX_PROMPT_ROUTES:
+      self._routes.popitem(last=False)
+
+  async def find(self, prompt_id: str):
+    """Return the backend that ran a prompt, asking each backend's /history if unknown."""
+    host = self._routes.get(prompt_id)
+    if host is not None:
+      return self._by_host[host]
+    for backend in self.backends:
+      if backend.events.get(prompt_id) is not None:
+        self.remember(prompt_id, backend)
+        return backend
+    if len(self.backends) == 1:
+      return self.backends[0]
+    results = await asyncio.gather(
+      *(backend.get_history(prompt_id) for backend in self.backends), return_exceptions=True
+    )
+    for backend, entry in zip(self.backends, results):
+      if isinstance(entry, dict):
+        self.remember(prompt_id, backend)
+        return backend
+    return None
+
+  async def check_health(self):
+    """Refresh health and queue depth for every backend concurrently."""
+    await asyncio.gather(*(backend.check_health() for backend in self.backends))
+
+  def status(self) -> list:
+    """Health summary of every backend."""
+    return [backend.status() for backend in self.backends]
+
+  async def _health_loop(self):
+    """Run health checks every HEALTH_CHECK_INTERVAL seconds until cancelled."""
+    while True:
+      await asyncio.sleep(HEALTH_CHECK_INTERVAL)
+      try:
+        await self.check_health()
+      except Exception as e:
+        logger.error("Backend health check failed: %s", e)
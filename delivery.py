@@ -0,0 +1,235 @@
+# 📦 delivery.py - Comfynaut Parcel Room
+# "No captain sends a whole treasure chest when a well-packed purse will do."
+#
+# This file implements the delivery transcoding stage used by api_server.py.
+# ComfyUI saves full-size PNGs and whatever VHS_VideoCombine produced; Telegram
+# recompresses both anyway, and large files upload slowly or break its limits.
+# GET /outputs/{prompt_id}/{node_id}/{filename}?variant=telegram serves a delivery variant
+# instead: a high-quality JPEG (or WebP) for images and a size-capped H.264 MP4
+# with faststart for videos. Variants are made once, in a process pool so the
+# event loop never waits on an encoder, and kept in the output cache next to
+# their originals (see output_cache.py). api_server.py starts them when a job
+# finishes; a request only waits DELIVERY_WAIT seconds for one and otherwise
+# gets the original.
+#
+# Key features:
+# - Images: Pillow, longest side capped, JPEG (alpha flattened) or WebP
+# - Videos: ffmpeg, H.264 + AAC, capped height and file size, moov atom first
+# - H.264 videos already under the size cap are only remuxed (no quality loss)
+# - Missing tools (Pillow, ffmpeg) or unsupported files fall back to the original
+
+import asyncio
+import importlib.util
+import json
+import logging
+import mimetypes
+import multiprocessing
+import os
+import shutil
+import subprocess
+import time
+from concurrent.futures import ProcessPoolExecutor
+from typing import Optional
+
+logger = logging.getLogger("comfynaut.delivery")
+
+# Worker processes for transcoding (0 disables delivery variants)
+DELIVERY_WORKERS = int(os.getenv("DELIVERY_WORKERS", "2"))
+
+# Image variants: format ("jpeg" or "webp", empty disables), quality and longest side in pixels
+DELIVERY_IMAGE_FORMAT = os.getenv("DELIVERY_IMAGE_FORMAT", "jpeg").lower()
+DELIVERY_IMAGE_QUALITY = int(os.getenv("DELIVERY_IMAGE_QUALITY", "90"))
+DELIVERY_IMAGE_MAX_SIDE = int(os.getenv("DELIVERY_IMAGE_MAX_SIDE", "2560"))
+
+# Video variants: file size cap (under the 50 MB Telegram bots may upload) and height cap
+DELIVERY_VIDEO_MAX_BYTES = int(os.getenv("DELIVERY_VIDEO_MAX_BYTES", str(48 * 1024 ** 2)))
+DELIVERY_VIDEO_MAX_HEIGHT = int(os.getenv("DELIVERY_VIDEO_MAX_HEIGHT", "1080"))
+
+# ffmpeg binary (ffprobe is looked up next to it); empty disables video variants
+FFMPEG_PATH = os.getenv("FFMPEG_PATH", "ffmpeg")
+
+# Longest a GET /outputs?variant= request waits for a variant still being made (in seconds)
+DELIVERY_WAIT = float(os.getenv("DELIVERY_WAIT", "5"))
+
+# Longest a single ffmpeg run may take (in seconds)
+TRANSCODE_TIMEOUT = 600
+
+# Delivery variants served by GET /outputs (the variant name is part of the cached file name)
+VARIANTS = ("telegram",)
+
+# Variants remembered as impossible to make, so they are not retried on every request
+MAX_FAILURES = 4096
+
+# Image extensions per delivery format
+IMAGE_FORMATS = {"jpeg": ".jpg", "webp": ".webp"}
+
+# Audio bitrate of video variants (in kbit/s), and the share of the size cap the encoder aims for
+AUDIO_KBPS = 96
+SIZE_HEADROOM = 0.92
+
+class UnsupportedOutput(Exception):
+  """Raised by a worker for a file it cannot turn into a delivery variant (e.g. an animated image)."""
+
+# Utility: Re-encode an image for delivery (runs in a worker process)
+def transcode_image(source: str, target: str, image_format: str, quality: int, max_side: int):
+  """Write a JPEG or WebP copy of `source` to `target`, its longest side at most `max_side` pixels.
+  Raises:
+    UnsupportedOutput: for animated images (they are delivered as they are)
+  """
+  from PIL import Image
+  with Image.open(source) as image:
+    if getattr(image, "n_frames", 1) > 1:
+      raise UnsupportedOutput("animated image")
+    image.load()
+    if max(image.size) > max_side:
+      image.thumbnail((max_side, max_side), Image.LANCZOS)
+    if image_format == "webp":
+      image.save(target, "WEBP", quality=quality, method=4)
+      return
+    if image.mode in ("RGBA", "LA", "P"):
+      # JPEG has no alpha: flatten transparent pixels onto white
+      image = image.convert("RGBA")
+      background = Image.new("RGB", image.size, (255, 255, 255))
+      background.paste(image, mask=image.getchannel("A"))
+      image = background
+    elif image.mode != "RGB":
+      image = image.convert("RGB")
+    image.save(target, "JPEG", quality=quality, optimize=True, progressive=True)
+
+# Utility: Read a video's duration and codec with ffprobe
+def probe_video(ffprobe: str, source: str) -> dict:
+  """Return {"duration": seconds (0 if unknown), "codec": first video stream's codec or None}."""
+  result = subprocess.run(
+    [ffprobe, "-v", "error", "-select_streams", "v:0", "-show_entries", "stream=codec_name:format=duration",
+     "-of", "json", source],
+    capture_output=True, check=True, timeout=60)
+  info = json.loads(result.stdout or b"{}")
+  streams = info.get("streams") or []
+  try:
+    duration = float(info.get("format", {}).get("duration") or 0)
+  except ValueError:
+    duration = 0.0
+  return {"duration": duration, "codec": streams[0].get("codec_name") if streams else None}
+
+# Utility: Re-encode (or remux) a video for delivery (runs in a worker process)
+def transcode_video(source: str, target: str, ffmpeg: str, ffprobe: Optional[str], max_bytes: int, max_height: int):
+  """Write an H.264/AAC MP4 with faststart to `target`, no larger than `max_bytes`.
+  H.264 sources already small enough are remuxed. Otherwise the encoder runs
+  at constant quality with a bitrate ceiling derived from the size cap, and
+  once more at a lower ceiling if the result still came out too large.
+  Raises:
+    UnsupportedOutput: if the video cannot be brought under `max_bytes`
+    subprocess.CalledProcessError: if ffmpeg fails
+  """
+  probe = probe_video(ffprobe, source) if ffprobe else {"duration": 0.0, "codec": None}
+  base = [ffmpeg, "-y", "-v", "error", "-i", source]
+  if probe["codec"] == "h264" and os.path.getsize(source) <= max_bytes:
+    subprocess.run(base + ["-map", "0", "-c", "copy", "-movflags", "+faststart", "-f", "mp4", target],
+                   check=True, capture_output=True, timeout=TRANSCODE_TIMEOUT)
+    return
+  video_kbps = None
+  if probe["duration"] > 0:
+    video_kbps = max(100, int(max_bytes * 8 * SIZE_HEADROOM / probe["duration"] / 1000) - AUDIO_KBPS)
+  for _ in range(2):
+    command = base + [
+      "-map", "0:v:0", "-map", "0:a?",
+      "-vf", f"scale=-2:'min({max_height},trunc(ih/2)*2)',format=yuv420p",
+      "-c:v", "libx264", "-preset", "medium", "-crf", "20",
+    ]
+    if video_kbps is not None:
+      command += ["-maxrate", f"{video_kbps}k", "-bufsize", f"{video_kbps * 2}k"]
+    command += ["-c:a", "aac", "-b:a", f"{AUDIO_KBPS}k", "-movflags", "+faststart", "-f", "mp4", target]
+    subprocess.run(command, check=True, capture_output=True, timeout=TRANSCODE_TIMEOUT)
+    size = os.path.getsize(target)
+    if size <= max_bytes:
+      return
+    # Overshot (or the duration was unknown): scale the ceiling down by the overshoot
+    current_kbps = video_kbps or int(size * 8 / max(probe["duration"], 1) / 1000)
+    video_kbps = max(100, int(current_kbps * max_bytes * SIZE_HEADROOM / size))
+  raise UnsupportedOutput(f"video still {size} bytes after re-encoding")
+
+class DeliveryTranscoder:
+  """Process pool turning cached outputs into delivery variants."""
+
+  def __init__(self, workers: int = DELIVERY_WORKERS, image_format: str = DELIVERY_IMAGE_FORMAT,
+               ffmpeg: str = FFMPEG_PATH):
+    """
+    Args:
+      workers: Worker processes (0 disables the stage)
+      image_format: "jpeg" or "webp" ("" delivers images as they are)
+      ffmpeg: ffmpeg binary ("" delivers videos as they are)
+    """
+    self.workers = workers
+    self.image_format = image_format if image_format in IMAGE_FORMATS else ""
+    self.ffmpeg = shutil.which(ffmpeg) if ffmpeg else None
+    self.ffprobe = shutil.which("ffprobe", path=os.path.dirname(self.ffmpeg)) if self.ffmpeg else None
+    self.has_pillow = importlib.util.find_spec("PIL") is not None
+    self.counts = {}  # (kind, outcome) -> transcodes
+    self.failed = set()  # (prompt_id, ref, variant) that could not be made; not retried
+    self._pool = None
+
+  @property
+  def enabled(self) -> bool:
+    return self._pool is not None
+
+  def start(self):
+    """Start the worker processes (if there is anything to transcode with)."""
+    if self.workers <= 0:
+      return
+    if self.image_format and not self.has_pillow:
+      logger.warning("Pillow is not installed: images are delivered without a delivery variant")
+    if not self.ffmpeg:
+      logger.warning("ffmpeg not found: videos are delivered without a delivery variant")
+    if not (self.image_format and self.has_pillow) and not self.ffmpeg:
+      return
+    # Spawned workers: forking a process that runs threads and an event loop is unsafe
+    # (they re-import the main module: api_server.py starts uvicorn only under __main__ and does no
+    # I/O at import time, see benchmarks/spawn_check.py)
+    self._pool = ProcessPoolExecutor(max_workers=self.workers, mp_context=multiprocessing.get_context("spawn"))
+    logger.info("Delivery transcoding with %d workers (images: %s, videos: %s)", self.workers,
+                self.image_format if self.has_pillow and self.image_format else "off", "h264" if self.ffmpeg else "off")
+
+  def plan(self, filename: str) -> Optional[tuple]:
+    """Return (kind, variant file extension) for an output, or None if it is delivered as it is."""
+    if not self.enabled:
+      return None
+    media_type = mimetypes.guess_type(filename)[0] or ""
+    if media_type.startswith("video/") or media_type == "image/gif":
+      return ("video", ".mp4") if self.ffmpeg else None
+    if media_type.startswith("image/") and self.image_format and self.has_pillow:
+      return "image", IMAGE_FORMATS[self.image_format]
+    return None
+
+  async def transcode(self, kind: str, source: str, target: str):
+    """Write the delivery variant of `source` to `target` in a worker process.
+    Raises:
+      UnsupportedOutput, subprocess.SubprocessError, OSError: if no variant could be made
+    """
+    if kind == "image":
+      args = (transcode_image, source, target, self.image_format, DELIVERY_IMAGE_QUALITY, DELIVERY_IMAGE_MAX_SIDE)
+    else:
+      args = (transcode_video, source, target, self.ffmpeg, self.ffprobe, DELIVERY_VIDEO_MAX_BYTES, DELIVERY_VIDEO_MAX_HEIGHT)
+    started = time.perf_counter()
+    outcome = "error"
+    try:
+      await asyncio.get_running_loop().run_in_executor(self._pool, *args)
+      outcome = "success"
+      logger.info("Made %s delivery variant of %s in %.2fs (%.1f -> %.1f MB)", kind, os.path.basename(source),
+                  time.perf_counter() - started, os.path.getsize(source) / 1024 ** 2, os.path.getsize(target) / 1024 ** 2)
+    except UnsupportedOutput:
+      outcome = "unsupported"
+      raise
+    finally:
+      self.counts[(kind, outcome)] = self.counts.get((kind, outcome), 0) + 1
+
+  def remember_failure(self, key: tuple):
+    """Don't retry a variant that could not be made (bounded: forgets everything past MAX_FAILURES)."""
+    if len(self.failed) >= MAX_FAILURES:
+      self.failed.clear()
+    self.failed.add(key)
+
+  async def close(self):
+    """Stop the worker processes (waiting for running transcodes)."""
+    if self._pool is not None:
+      pool, self._pool = self._pool, None
+      await asyncio.get_running_loop().run_in_executor(None, pool.shutdown)
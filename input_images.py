@@ -0,0 +1,226 @@
+# 🧭 input_images.py - Comfynaut Chart Room
+# "Trim the sails before leaving port, not in the middle of the storm."
+#
+# This file implements the input image normalization used by api_server.py
+# before an image is uploaded to ComfyUI. Telegram photos arrive at whatever
+# resolution Telegram picked, sometimes sideways (EXIF orientation), and the
+# workflows then resize them on the GPU. Here they are decoded, turned upright,
+# resized on the CPU to exactly the size the workflow's resize node would
+# produce (so that node has nothing left to do) and re-encoded, which also
+# makes the upload smaller. The work runs on a small thread pool: Pillow
+# releases the GIL while decoding, resampling and encoding.
+#
+# The resized image replaces the original everywhere the workflow's LoadImage
+# output goes, not only at the resize node: in the WAN video workflow it also
+# feeds CLIPVisionEncode (scaled to 224x224 there anyway) and ColorMatch's
+# image_ref (colour statistics). Those see a slightly different resampling of
+# the same picture, so videos are near-identical to, but not bit-for-bit the
+# same as, those made from the full-size upload.
+#
+# Key features:
+# - Target size read from the workflow (ImageResizeKJv2 / ImageResizeKJ / ImageScale)
+# - Optional pixel budget (INPUT_IMAGE_MAX_PIXELS) for workflows without a resize node
+# - Sideways images turned upright for every workflow (header-only check for upright ones)
+# - EXIF orientation applied; JPEG inputs decoded at reduced scale when shrinking
+# - JPEG out (PNG for images with transparency), real content type on upload
+# - Images already upright, in size and in JPEG/PNG are uploaded untouched
+# - Uploads are read from their spooled temp file, never whole into memory when untouched
+
+import asyncio
+import importlib.util
+import logging
+import math
+import os
+from concurrent.futures import ThreadPoolExecutor
+from io import BytesIO
+from typing import Optional
+
+logger = logging.getLogger("comfynaut.inputs")
+
+# Threads normalizing input images (0 uploads images as they arrive)
+INPUT_IMAGE_WORKERS = int(os.getenv("INPUT_IMAGE_WORKERS", "2"))
+
+# Largest input (in pixels) for workflows that don't resize their input (0 leaves their input untouched)
+INPUT_IMAGE_MAX_PIXELS = int(os.getenv("INPUT_IMAGE_MAX_PIXELS", "0"))
+
+# JPEG quality of normalized input images
+INPUT_IMAGE_QUALITY = int(os.getenv("INPUT_IMAGE_QUALITY", "95"))
+
+# Image file signatures, for labelling uploads that are not normalized
+IMAGE_SIGNATURES = (
+  (b"\x89PNG\r\n\x1a\n", "image/png", ".png"),
+  (b"\xff\xd8\xff", "image/jpeg", ".jpg"),
+  (b"GIF8", "image/gif", ".gif"),
+  (b"BM", "image/bmp", ".bmp"),
+)
+
+# EXIF orientation tag, and the orientations that swap width and height
+EXIF_ORIENTATION = 0x0112
+TRANSPOSED_ORIENTATIONS = (5, 6, 7, 8)
+
+# Utility: Guess an image's content type and extension from its first bytes
+def sniff_image_type(head: bytes) -> tuple:
+  """Return (content_type, extension) for PNG, JPEG, GIF, BMP or WebP data (PNG if unknown)."""
+  if head[:4] == b"RIFF" and head[8:12] == b"WEBP":
+    return "image/webp", ".webp"
+  for signature, content_type, extension in IMAGE_SIGNATURES:
+    if head.startswith(signature):
+      return content_type, extension
+  return "image/png", ".png"
+
+# Utility: Type of an image given as bytes or as a file, without moving the file
+def sniff_source_type(source) -> tuple:
+  """Return (content_type, extension) for image bytes or a seekable binary file (left at position 0)."""
+  if isinstance(source, bytes):
+    return sniff_image_type(source[:16])
+  source.seek(0)
+  head = source.read(16)
+  source.seek(0)
+  return sniff_image_type(head)
+
+# Utility: Read an image's EXIF orientation from its header (runs on a worker thread)
+def image_orientation(source) -> int:
+  """Return the EXIF orientation (1 = upright) of image bytes or a seekable binary file (left at position 0).
+  Only the header is read: the pixels are not decoded.
+  Raises:
+    OSError: if the data is not an image Pillow can read
+  """
+  from PIL import Image
+  if not isinstance(source, bytes):
+    source.seek(0)
+  try:
+    with Image.open(BytesIO(source) if isinstance(source, bytes) else source) as image:
+      if image.format == "PNG" and "exif" not in image.info:
+        # eXIf precedes the image data, and getexif() would decode the image to look further
+        return 1
+      return image.getexif().get(EXIF_ORIENTATION, 1)
+  finally:
+    if not isinstance(source, bytes):
+      source.seek(0)
+
+# Utility: Work out the size (and crop) a resize target gives an image
+def target_geometry(width: int, height: int, resize: Optional[dict], max_pixels: int) -> tuple:
+  """Return ((new_width, new_height), crop box or None) for an upright width x height image.
+  `resize` is WorkflowTemplate.input_resize; the arithmetic follows the
+  ComfyUI resize nodes, so they find the image already at their output size.
+  Without a resize node, images over `max_pixels` are scaled down to fit it.
+  """
+  if resize is None:
+    if max_pixels <= 0 or width * height <= max_pixels:
+      return (width, height), None
+    scale = math.sqrt(max_pixels / (width * height))
+    return (max(8, int(width * scale) // 8 * 8), max(8, int(height * scale) // 8 * 8)), None
+  box_width, box_height, divisible_by = resize["width"], resize["height"], resize["divisible_by"]
+  crop = None
+  if resize["mode"] == "fit":
+    ratio = min(box_width / width, box_height / height)
+    new_width, new_height = round(width * ratio), round(height * ratio)
+  else:
+    new_width, new_height = box_width, box_height
+  if divisible_by > 1:
+    new_width -= new_width % divisible_by
+    new_height -= new_height % divisible_by
+  if resize["mode"] == "crop":
+    # Largest centered region with the output's aspect ratio
+    ratio = max(new_width / width, new_height / height)
+    crop_width, crop_height = new_width / ratio, new_height / ratio
+    left, top = (width - crop_width) / 2, (height - crop_height) / 2
+    crop = (left, top, left + crop_width, top + crop_height)
+  return (max(1, new_width), max(1, new_height)), crop
+
+# Utility: Decode, orient, resize and re-encode an input image (runs on a worker thread)
+def normalize_image(source, resize: Optional[dict], max_pixels: int, quality: int) -> tuple:
+  """Return (image, content_type, extension) ready for ComfyUI's /upload/image.
+  `source` is the image as bytes or as a seekable binary file (e.g. an
+  upload's spooled temp file); an image left untouched is returned as that
+  same object (a file rewound to its start), a normalized one as bytes.
+  Raises:
+    OSError: if the data is not an image Pillow can read
+  """
+  from PIL import Image, ImageOps
+  if not isinstance(source, bytes):
+    source.seek(0)
+  with Image.open(BytesIO(source) if isinstance(source, bytes) else source) as image:
+    source_format = image.format
+    if getattr(image, "n_frames", 1) > 1:
+      # LoadImage turns frames into a batch; leave animations alone
+      return (source,) + sniff_source_type(source)
+    orientation = image.getexif().get(EXIF_ORIENTATION, 1)
+    width, height = image.size
+    if orientation in TRANSPOSED_ORIENTATIONS:
+      width, height = height, width
+    size, crop = target_geometry(width, height, resize, max_pixels)
+    if size == (width, height) and crop is None and orientation == 1 and source_format in ("JPEG", "PNG"):
+      return (source,) + sniff_source_type(source)
+    if source_format == "JPEG":
+      # Let the JPEG decoder scale down by 1/2, 1/4 or 1/8 (never below the target size)
+      draft_size = (size[1], size[0]) if orientation in TRANSPOSED_ORIENTATIONS else size
+      image.draft("RGB", draft_size)
+    upright = ImageOps.exif_transpose(image)
+    if crop is not None:
+      # Crop box in the (possibly draft-scaled) decoded image's pixels
+      scale_x, scale_y = upright.width / width, upright.height / height
+      crop = (crop[0] * scale_x, crop[1] * scale_y, crop[2] * scale_x, crop[3] * scale_y)
+    if upright.size != size or crop is not None:
+      upright = upright.resize(size, Image.LANCZOS, box=crop)
+    output = BytesIO()
+    if upright.mode in ("RGBA", "LA") or (upright.mode == "P" and "transparency" in upright.info):
+      # LoadImage turns transparency into the mask: keep it
+      upright.save(output, "PNG")
+      return output.getvalue(), "image/png", ".png"
+    if upright.mode != "RGB":
+      upright = upright.convert("RGB")
+    upright.save(output, "JPEG", quality=quality, subsampling=0)
+    return output.getvalue(), "image/jpeg", ".jpg"
+
+class InputNormalizer:
+  """Thread pool normalizing input images before they are uploaded to ComfyUI."""
+
+  def __init__(self, workers: int = INPUT_IMAGE_WORKERS, max_pixels: int = INPUT_IMAGE_MAX_PIXELS,
+               quality: int = INPUT_IMAGE_QUALITY):
+    """
+    Args:
+      workers: Worker threads (0 uploads images as they arrive)
+      max_pixels: Pixel budget for workflows without an input resize node (0 = no limit)
+      quality: JPEG quality of normalized images
+    """
+    self.workers = workers
+    self.max_pixels = max_pixels
+    self.quality = quality
+    self._pool = None
+
+  @property
+  def enabled(self) -> bool:
+    return self._pool is not None
+
+  def start(self):
+    """Start the worker threads (if Pillow is installed)."""
+    if self.workers <= 0:
+      return
+    if importlib.util.find_spec("PIL") is None:
+      logger.warning("Pillow is not installed: input images are uploaded without normalization")
+      return
+    self._pool = ThreadPoolExecutor(max_workers=self.workers, thread_name_prefix="input-images")
+
+  async def normalize(self, source, resize: Optional[dict] = None) -> tuple:
+    """Return (image, content_type, extension) for an input image, see normalize_image.
+    Args:
+      source: The image as received (bytes or a seekable binary file)
+      resize: The workflow's input resize (WorkflowTemplate.input_resize), or None
+    Raises:
+      OSError: if the data is not a readable image (only when normalization is enabled)
+    """
+    if self._pool is None:
+      return (source,) + sniff_source_type(source)
+    loop = asyncio.get_running_loop()
+    if resize is None and self.max_pixels <= 0:
+      # Nothing to resize to: only sideways images are decoded (to turn them upright)
+      if await loop.run_in_executor(self._pool, image_orientation, source) == 1:
+        return (source,) + sniff_source_type(source)
+    return await loop.run_in_executor(self._pool, normalize_image, source, resize, self.max_pixels, self.quality)
+
+  def close(self):
+    """Stop the worker threads."""
+    if self._pool is not None:
+      pool, self._pool = self._pool, None
+      pool.shutdown(wait=False)
@@ -0,0 +1,207 @@
+# 📒 job_store.py - Comfynaut Ship's Log
+# "The captain may change, but the log remembers every voyage still at sea."
+#
+# This file implements the durable job store used by api_server.py.
+# Every job is written to a small SQLite table (WAL mode) when it is submitted,
+# when its prompt reaches ComfyUI and when it finishes. ComfyUI keeps running
+# prompts while the API server restarts, so on startup the server reads the
+# table back and re-attaches unfinished jobs to their prompts instead of
+# throwing the GPU work away. Each backend's WebSocket client_id is stored as
+# well: ComfyUI only sends a prompt's events to the client id it was queued
+# under, so reusing it lets the new process hear the rest of the execution.
+#
+# Key features:
+# - SQLite in WAL mode: cheap appends, readers never block the writer
+# - Writes run on one background thread, in order, off the event loop
+# - Jobs stored with prompt_id, backend, client_id, requester, status and result
+# - Finished jobs pruned after JOB_STORE_RETENTION days
+
+import asyncio
+import json
+import logging
+import os
+import sqlite3
+import time
+from concurrent.futures import ThreadPoolExecutor
+from jobs import Job
+
+logger = logging.getLogger("comfynaut.store")
+
+# SQLite file holding the job table ("" disables persistence)
+JOB_STORE_PATH = os.getenv("JOB_STORE_PATH", os.path.join(os.path.dirname(os.path.abspath(__file__)), "jobs.db"))
+
+# Days finished jobs are kept in the store
+JOB_STORE_RETENTION = float(os.getenv("JOB_STORE_RETENTION", "7"))
+
+# Seconds between prunes of expired jobs
+PRUNE_INTERVAL = 3600
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS jobs (
+  job_id TEXT PRIMARY KEY,
+  kind TEXT NOT NULL,
+  runner TEXT NOT NULL,
+  endpoint TEXT,
+  status TEXT NOT NULL,
+  user_id TEXT,
+  priority TEXT,
+  params TEXT NOT NULL,
+  prompt_id TEXT,
+  backend TEXT,
+  client_id TEXT,
+  workflow_file TEXT,
+  result TEXT,
+  created REAL NOT NULL,
+  started REAL,
+  finished REAL
+);
+CREATE INDEX IF NOT EXISTS jobs_finished ON jobs (finished);
+CREATE TABLE IF NOT EXISTS backends (
+  host TEXT PRIMARY KEY,
+  client_id TEXT NOT NULL
+);
+"""
+
+COLUMNS = ("job_id", "kind", "runner", "endpoint", "status", "user_id", "priority", "params", "prompt_id",
+           "backend", "client_id", "workflow_file", "result", "created", "started", "finished")
+
+# Utility: Snapshot a job as a row of the jobs table
+def job_record(job: Job) -> dict:
+  """Return the job's stored columns (JSON-encoded params and result)."""
+  backend = job.backend
+  return {
+    "job_id": job.id,
+    "kind": job.kind,
+    "runner": job.runner or "",
+    "endpoint": job.endpoint,
+    "status": job.status,
+    "user_id": job.user_id,
+    "priority": job.priority,
+    "params": json.dumps(job.stored_params or {}, ensure_ascii=False),
+    "prompt_id": job.prompt_id,
+    "backend": backend.host if backend is not None else None,
+    "client_id": backend.events.client_id if backend is not None and job.prompt_id else None,
+    "workflow_file": job.workflow_file,
+    "result": json.dumps(job.result, ensure_ascii=False) if job.result is not None else None,
+    "created": job.created,
+    "started": job.started,
+    "finished": job.finished,
+  }
+
+# Utility: Rebuild a job from a row of the jobs table
+def restore_job(record: dict, backend_for) -> Job:
+  """Return a Job with the stored id, status, prompt, backend and result.
+  job.params is left empty: the caller rebuilds the runner inputs from
+  job.stored_params. job.backend is None if its host is no longer configured.
+  Args:
+    record: Row of the jobs table
+    backend_for: Callable returning the backend for a host, or None
+  """
+  job = Job(record["kind"], {}, record["user_id"], record["priority"], record["endpoint"])
+  job.id = record["job_id"]
+  job.runner = record["runner"]
+  job.status = record["status"]
+  job.stored_params = json.loads(record["params"])
+  job.prompt_id = record["prompt_id"]
+  job.backend = backend_for(record["backend"]) if record["backend"] else None
+  job.workflow_file = record["workflow_file"]
+  job.result = json.loads(record["result"]) if record["result"] else None
+  job.created = record["created"]
+  job.started = record["started"]
+  job.finished = record["finished"]
+  return job
+
+class JobStore:
+  """Jobs table in a SQLite file, written from a single background thread."""
+
+  def __init__(self, path: str = JOB_STORE_PATH, retention: float = JOB_STORE_RETENTION):
+    """
+    Args:
+      path: SQLite database file
+      retention: Days finished jobs are kept
+    """
+    self.path = path
+    self.retention = retention
+    self._db = None
+    self._last_prune = 0.0
+    # One worker: writes stay in submission order and the connection stays on one thread
+    self._executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="job-store")
+
+  async def open(self):
+    """Open (or create) the database and prune expired jobs."""
+    await self._call(self._open)
+    logger.info("Job store at %s", self.path)
+
+  async def load(self, max_finished: int, backend_for) -> list:
+    """Return every unfinished job plus the `max_finished` most recent finished ones, oldest first.
+    `backend_for(host)` maps stored backend hosts to backends (see restore_job).
+    """
+    rows = await self._call(self._load, max_finished)
+    return [restore_job(row, backend_for) for row in rows]
+
+  async def client_id(self, host: str, default: str) -> str:
+    """Return the WebSocket client_id stored for a backend, storing `default` if there is none."""
+    return await self._call(self._client_id, host, default)
+
+  def save(self, job: Job):
+    """Queue a write of the job's current state (returns immediately)."""
+    if self._db is None:
+      return
+    self._executor.submit(self._write, job_record(job), job.done)
+
+  async def close(self):
+    """Finish pending writes and close the database."""
+    if self._db is not None:
+      await self._call(self._close)
+    self._executor.shutdown(wait=True)
+
+  async def _call(self, func, *args):
+    return await asyncio.get_running_loop().run_in_executor(self._executor, func, *args)
+
+  def _open(self):
+    directory = os.path.dirname(os.path.abspath(self.path))
+    os.makedirs(directory, exist_ok=True)
+    self._db = sqlite3.connect(self.path, check_same_thread=False)
+    self._db.row_factory = sqlite3.Row
+    # WAL: appends don't rewrite the database; NORMAL sync is durable across process crashes
+    self._db.execute("PRAGMA journal_mode=WAL")
+    self._db.execute("PRAGMA synchronous=NORMAL")
+    self._db.executescript(SCHEMA)
+    self._prune()
+
+  def _load(self, max_finished: int) -> list:
+    unfinished = self._db.execute("SELECT * FROM jobs WHERE finished IS NULL ORDER BY created").fetchall()
+    finished = self._db.execute(
+      "SELECT * FROM jobs WHERE finished IS NOT NULL ORDER BY finished DESC LIMIT ?", (max_finished,)).fetchall()
+    return [dict(row) for row in reversed(finished)] + [dict(row) for row in unfinished]
+
+  def _client_id(self, host: str, default: str) -> str:
+    row = self._db.execute("SELECT client_id FROM backends WHERE host = ?", (host,)).fetchone()
+    if row is not None:
+      return row["client_id"]
+    with self._db:
+      self._db.execute("INSERT INTO backends (host, client_id) VALUES (?, ?)", (host, default))
+    return default
+
+  def _write(self, record: dict, finished: bool):
+    try:
+      with self._db:
+        self._db.execute(
+          f"INSERT OR REPLACE INTO jobs ({', '.join(COLUMNS)}) VALUES ({', '.join('?' * len(COLUMNS))})",
+          [record[column] for column in COLUMNS])
+      if finished and time.time() - self._last_prune > PRUNE_INTERVAL:
+        self._prune()
+    except sqlite3.Error as e:
+      logger.error("Could not store job %s: %s", record["job_id"], e)
+
+  def _prune(self):
+    cutoff = time.time() - self.retention * 86400
+    with self._db:
+      deleted = self._db.execute("DELETE FROM jobs WHERE finished IS NOT NULL AND finished < ?", (cutoff,)).rowcount
+    self._last_prune = time.time()
+    if deleted:
+      logger.info("Pruned %d jobs finished more than %g days ago", deleted, self.retention)
+
+  def _close(self):
+    self._db.close()
+    self._db = None
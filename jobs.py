@@ -0,0 +1,305 @@
+# 🗺️ jobs.py - Comfynaut Quest Log
+# "Not all who wander are lost—some are just waiting in the ComfyUI queue."
+#
+# This file implements the background job tracker used by api_server.py.
+# A job is submitted, gets an id straight away, and runs as its own asyncio
+# task. Callers can poll it by id, await it, or walk away; a job only stops
+# early when it is cancelled (DELETE /jobs/{id}, or a blocking endpoint's
+# client disconnecting). With a job store (see job_store.py) jobs are saved as
+# they progress, and a server restart leaves their ComfyUI prompts running.
+#
+# Key features:
+# - Job objects with status, timestamps, ComfyUI prompt_id and result
+# - Per-job event fan-out (progress, current node, status) for live subscribers
+# - JobManager: submit/get/wait/cancel with bounded retention of finished jobs
+# - Optional persistence: jobs restored from the store are re-adopted on startup
+# - Admission control: per-type limits on unfinished jobs, with a Retry-After estimate
+
+import asyncio
+import logging
+import math
+import os
+import time
+import uuid
+from collections import OrderedDict
+import metrics
+
+logger = logging.getLogger("comfynaut.jobs")
+
+# Job kinds accepted by the job API
+JOB_KINDS = ("t2i", "i2i", "i2v")
+
+# How many finished jobs to keep around for GET /jobs/{id}
+MAX_FINISHED_JOBS = 500
+
+# Events buffered per subscriber before the oldest are dropped (slow readers)
+SUBSCRIBER_QUEUE_SIZE = 100
+
+# Admission control: most unfinished (queued + running) jobs per kind, 0 = unlimited
+JOB_LIMITS = {
+  "t2i": int(os.getenv("MAX_ACTIVE_T2I_JOBS", "32")),
+  "i2i": int(os.getenv("MAX_ACTIVE_I2I_JOBS", "16")),
+  "i2v": int(os.getenv("MAX_ACTIVE_I2V_JOBS", "4")),
+}
+
+# Expected GPU time per job kind (in seconds) until real durations have been measured
+DEFAULT_JOB_SECONDS = {"t2i": 20.0, "i2i": 20.0, "i2v": 300.0}
+DURATION_SMOOTHING = 0.2   # Weight of the newest sample in the moving average
+MAX_RETRY_AFTER = 3600     # Cap for the Retry-After hint (in seconds)
+
+class JobRejected(Exception):
+  """Raised by JobManager.submit when a job kind is at its limit."""
+
+  def __init__(self, kind: str, limit: int, retry_after: int):
+    super().__init__(f"Too many active {kind} jobs (limit {limit}), retry in {retry_after}s")
+    self.kind = kind
+    self.limit = limit
+    self.retry_after = retry_after
+
+class Job:
+  """A single generation request tracked by the JobManager."""
+
+  def __init__(self, kind: str, params: dict, user_id: str = None, priority: str = None, endpoint: str = None):
+    self.id = uuid.uuid4().hex
+    self.kind = kind
+    self.endpoint = endpoint   # API endpoint the job came in through (metrics label)
+    self.params = params
+    self.user_id = user_id     # Requesting user, for fair-share scheduling
+    self.priority = priority   # Scheduler priority class (see scheduler.PRIORITY_CLASSES)
+    self.status = "queued"     # queued -> running -> success / error / cancelled
+    self.prompt_id = None      # ComfyUI prompt id, once submitted
+    self.prompt_state = None   # comfy_client.PromptState, once submitted
+    self.backend = None        # comfy_client.ComfyUIClient the job runs on
+    self.workflow = None       # Submitted workflow graph, for node class lookups
+    self.workflow_file = None  # Workflow file name (metrics label)
+    self.model = None          # Models the workflow loads (see workflow_templates.model_signature)
+    self.result = None         # Response dict produced by the job runner
+    self.cache = None          # Result cache outcome: "hit", "coalesced" or "miss"
+    self.cancel_reason = None  # Why the job was cancelled (see JobManager.cancel)
+    self.runner = None         # Name of the runner function, to resume the job after a restart
+    self.stored_params = None  # JSON-safe inputs kept in the job store (params may hold live objects)
+    self.created = time.time()
+    self.started = None
+    self.finished = None
+    self.task = None
+    self._subscribers = []
+
+  def subscribe(self) -> asyncio.Queue:
+    """Return a queue that receives (event, data) tuples for this job."""
+    queue = asyncio.Queue(maxsize=SUBSCRIBER_QUEUE_SIZE)
+    self._subscribers.append(queue)
+    return queue
+
+  def unsubscribe(self, queue: asyncio.Queue):
+    """Stop delivering events to a subscriber queue."""
+    if queue in self._subscribers:
+      self._subscribers.remove(queue)
+
+  def publish(self, event: str, data: dict):
+    """Send an event to every subscriber, dropping the oldest one for slow readers."""
+    for queue in self._subscribers:
+      if queue.full():
+        queue.get_nowait()
+      queue.put_nowait((event, data))
+
+  def on_prompt_event(self, msg_type: str, data: dict):
+    """PromptState subscriber: relay ComfyUI progress events to job subscribers."""
+    if msg_type == "progress":
+      self.publish("progress", {"node": data.get("node"), "value": data.get("value"), "max": data.get("max")})
+    elif msg_type == "executing" and data.get("node") is not None:
+      node = data["node"]
+      class_type = (self.workflow or {}).get(node, {}).get("class_type")
+      self.publish("executing", {"node": node, "class_type": class_type})
+    elif msg_type == "execution_start":
+      self.publish("status", {"status": "running"})
+
+  @property
+  def done(self) -> bool:
+    return self.status in ("success", "error", "cancelled")
+
+  def to_dict(self) -> dict:
+    """Public, JSON-friendly view of the job (image data and other inputs omitted)."""
+    status = self.status
+    if status == "queued" and self.prompt_state is not None and self.prompt_state.status != "pending":
+      status = "running"
+    info = {
+      "job_id": self.id,
+      "type": self.kind,
+      "priority": self.priority,
+      "status": status,
+      "prompt_id": self.prompt_id,
+      "backend": self.backend.host if self.backend is not None else None,
+      "created": self.created,
+      "started": self.started,
+      "finished": self.finished,
+    }
+    if self.prompt_state is not None and not self.done:
+      info["current_node"] = self.prompt_state.current_node
+      info["progress"] = self.prompt_state.progress
+    if self.cache is not None:
+      info["cache"] = self.cache
+    if self.result is not None:
+      info["result"] = self.result
+    return info
+
+class JobManager:
+  """Runs jobs as background tasks and keeps them addressable by id."""
+
+  def __init__(self, max_finished: int = MAX_FINISHED_JOBS, limits: dict = None, workers=None, store=None):
+    """
+    Args:
+      max_finished: Finished jobs kept for status lookups
+      limits: Max unfinished jobs per kind (defaults to JOB_LIMITS; 0 or missing = unlimited)
+      workers: Callable returning how many jobs run in parallel (e.g. healthy backends)
+      store: Optional job_store.JobStore that every job state change is written to
+    """
+    self.max_finished = max_finished
+    self.limits = dict(JOB_LIMITS if limits is None else limits)
+    self.workers = workers or (lambda: 1)
+    self.store = store
+    self.durations = dict(DEFAULT_JOB_SECONDS)  # Moving average of GPU time per kind
+    self._jobs = OrderedDict()
+
+  def submit(self, kind: str, runner, user_id: str = None, priority: str = None, endpoint: str = None,
+             stored_params: dict = None, **params) -> Job:
+    """Create a job and start `runner(job)` in the background.
+    Args:
+      kind: One of JOB_KINDS
+      runner: Coroutine function taking the job and returning its result dict
+      user_id: Requesting user (fair-share scheduling)
+      priority: Scheduler priority class
+      endpoint: API endpoint the job came in through (metrics label)
+      stored_params: JSON-safe inputs saved in the job store (enough to resume the job)
+      params: Job inputs, available to the runner as job.params
+    Returns:
+      The new Job (already scheduled)
+    Raises:
+      JobRejected: if `kind` already has its limit of unfinished jobs
+    """
+    self.admit(kind)
+    job = Job(kind, params, user_id, priority, endpoint)
+    job.runner = runner.__name__
+    job.stored_params = stored_params
+    self._jobs[job.id] = job
+    self.save(job)
+    job.task = asyncio.get_running_loop().create_task(self._run(job, runner))
+    self._evict()
+    logger.info("Job %s (%s) submitted", job.id, kind)
+    return job
+
+  def adopt(self, job: Job, runner=None):
+    """Register a job restored from the job store.
+    Unfinished jobs get `runner(job)` started in the background; the runner
+    must pick up the job's existing ComfyUI prompt instead of queueing a new one.
+    """
+    self._jobs[job.id] = job
+    if runner is not None:
+      job.task = asyncio.get_running_loop().create_task(self._run(job, runner))
+    self._evict()
+
+  def save(self, job: Job):
+    """Write the job's current state to the store (no-op without one)."""
+    if self.store is not None:
+      self.store.save(job)
+
+  def get(self, job_id: str):
+    """Return the job with this id, or None."""
+    return self._jobs.get(job_id)
+
+  def active(self, kind: str = None) -> list:
+    """Unfinished jobs (optionally of one kind), oldest first."""
+    return [job for job in self._jobs.values() if not job.done and (kind is None or job.kind == kind)]
+
+  def admit(self, kind: str):
+    """Raise JobRejected if another job of this kind would exceed its limit."""
+    limit = self.limits.get(kind, 0)
+    active = len(self.active(kind))
+    if limit and active >= limit:
+      retry_after = self.estimate_retry_after(kind)
+      logger.warning("Rejecting %s job: %d active (limit %d), retry in %ss", kind, active, limit, retry_after)
+      metrics.jobs_rejected_total.inc(kind=kind)
+      raise JobRejected(kind, limit, retry_after)
+
+  def estimate_retry_after(self, kind: str) -> int:
+    """Estimate when the oldest unfinished job of `kind` finishes, freeing a slot.
+    Unfinished jobs are assumed to run in submission order, `workers()` at a
+    time, each taking the moving-average duration of its kind.
+    """
+    backlog = 0.0
+    workers = max(1, self.workers())
+    for job in self.active():
+      backlog += self.durations.get(job.kind, 0.0) / workers
+      if job.kind == kind:
+        break
+    return max(1, min(MAX_RETRY_AFTER, math.ceil(backlog)))
+
+  def _record_duration(self, job: Job):
+    """Fold a successful job's GPU time (execution start to finish) into the moving average."""
+    state = job.prompt_state
+    if state is None or state.started is None or state.finished is None:
+      return
+    previous = self.durations.get(job.kind, DEFAULT_JOB_SECONDS.get(job.kind, 0.0))
+    sample = state.finished - state.started
+    self.durations[job.kind] = previous + DURATION_SMOOTHING * (sample - previous)
+
+  async def wait(self, job: Job) -> dict:
+    """Wait for a job's result. Cancelling the waiter does not cancel the job."""
+    await asyncio.shield(job.task)
+    return job.result
+
+  def cancel(self, job: Job, reason: str) -> bool:
+    """Cancel an unfinished job's task; the runner stops its ComfyUI prompt on the way out.
+    Returns:
+      True if the job was cancelled, False if it had already finished
+    """
+    if job.done or job.task is None or job.task.done():
+      return False
+    job.cancel_reason = reason
+    job.task.cancel()
+    logger.info("Cancelling job %s (%s): %s", job.id, job.kind, reason)
+    return True
+
+  async def close(self):
+    """Detach from unfinished jobs at shutdown.
+    Their tasks are cancelled without a reason: runners leave the ComfyUI
+    prompts running and stored jobs stay unfinished, so the next start can
+    re-attach them.
+    """
+    tasks = [job.task for job in self.active() if job.task is not None and not job.task.done()]
+    for task in tasks:
+      task.cancel()
+    if tasks:
+      logger.info("Detaching from %d unfinished jobs", len(tasks))
+      await asyncio.gather(*tasks, return_exceptions=True)
+
+  async def _run(self, job: Job, runner):
+    """Run a job to completion, recording its status and result."""
+    if job.started is None:
+      job.started = time.time()
+    try:
+      job.result = await runner(job)
+      job.status = "success" if job.result.get("status") == "success" else "error"
+    except asyncio.CancelledError:
+      if job.cancel_reason is None:
+        # Server shutdown, not a request: keep the stored job unfinished for the next start
+        raise
+      job.result = {"status": "cancelled", "message": f"Job cancelled: {job.cancel_reason}"}
+      job.status = "cancelled"
+    except Exception as e:
+      logger.error("Job %s failed: %s", job.id, e)
+      job.result = {"status": "error", "message": f"Job failed: {e}"}
+      job.status = "error"
+    job.finished = time.time()
+    self.save(job)
+    if job.status == "success":
+      self._record_duration(job)
+    metrics.job_seconds.observe(job.finished - job.created, endpoint=job.endpoint or "",
+                                workflow=job.workflow_file or "", status=job.status)
+    job.publish("done", job.to_dict())
+    logger.info("Job %s finished with status %s (%.1fs)", job.id, job.status, job.finished - job.created)
+
+  def _evict(self):
+    """Forget the oldest finished jobs once we hold more than max_finished of them."""
+    finished = [job_id for job_id, job in self._jobs.items() if job.done]
+    for job_id in finished[:max(0, len(finished) - self.max_finished)]:
+      del self._jobs[job_id]
@@ -29,9 +29,9 @@ def run_api_server():
   This imports the FastAPI app from api_server.py and starts it using uvicorn.
   """
   import uvicorn
-  from api_server import app, COMFYUI_API, COMFYUI_WS_URL, logger as api_logger
+  from api_server import app, COMFYUI_HOSTS, logger as api_logger
   api_logger.info("🏰 Comfynaut API Server starting...")
-  api_logger.info("📡 ComfyUI connection: %s (WebSocket: %s)", COMFYUI_API, COMFYUI_WS_URL)
+  api_logger.info("📡 ComfyUI backends: %s", ", ".join(COMFYUI_HOSTS))
   api_logger.info("🌐 API server listening on http://0.0.0.0:8000/")
   uvicorn.run(app, host="0.0.0.0", port=8000, log_level="info")
 
@@ -0,0 +1,203 @@
+# 📈 metrics.py - Comfynaut Ship's Log
+# "What gets measured gets fixed—the rest just gets blamed on the GPU."
+#
+# This file implements the Prometheus-style metrics served at GET /metrics.
+# It is a small hand-rolled registry (counters, histograms, and values read at
+# scrape time) rendered in the Prometheus text exposition format, so no extra
+# dependency is needed. Stage timings are labelled with the endpoint and
+# workflow file of the job doing the work: job runners call set_job_labels()
+# once, and nested helpers simply wrap their work in stage("name").
+#
+# Key features:
+# - Counter and Histogram metrics with label sets
+# - Callback metrics computed at scrape time (queue depths, cache counters, ...)
+# - stage() timer labelled from the current job's context
+# - Prometheus text format rendering
+
+import bisect
+import contextvars
+import time
+from contextlib import contextmanager
+
+# Latency buckets (in seconds), from quick HTTP calls up to long video renders
+STAGE_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120, 300, 600, 1800, 3600)
+
+# Content type of the Prometheus text exposition format
+CONTENT_TYPE = "text/plain; version=0.0.4; charset=utf-8"
+
+# Utility: Escape a label value for the text format
+def _escape(value) -> str:
+  return str(value).replace("\\", "\\\\").replace("\"", "\\\"").replace("\n", "\\n")
+
+# Utility: Render a label set as {name="value",...}
+def _format_labels(names, values, extra: tuple = None) -> str:
+  pairs = list(zip(names, values))
+  if extra is not None:
+    pairs.append(extra)
+  if not pairs:
+    return ""
+  return "{" + ",".join(f'{name}="{_escape(value)}"' for name, value in pairs) + "}"
+
+# Utility: Render a sample value
+def _format_value(value) -> str:
+  if value == float("inf"):
+    return "+Inf"
+  if isinstance(value, int) or float(value).is_integer():
+    return str(int(value))
+  return repr(float(value))
+
+class Metric:
+  """Base class: a named metric with a fixed list of label names."""
+
+  type = "untyped"
+
+  def __init__(self, name: str, documentation: str, labelnames: tuple = ()):
+    self.name = name
+    self.documentation = documentation
+    self.labelnames = tuple(labelnames)
+
+  def _key(self, labels: dict) -> tuple:
+    """Label values in labelnames order.
+    Raises:
+      ValueError: if the labels don't match labelnames
+    """
+    if set(labels) != set(self.labelnames):
+      raise ValueError(f"{self.name} expects labels {self.labelnames}, got {tuple(labels)}")
+    return tuple(str(labels[name]) for name in self.labelnames)
+
+  def samples(self) -> list:
+    """Rendered sample lines (without HELP/TYPE headers)."""
+    raise NotImplementedError
+
+  def render(self) -> str:
+    lines = [f"# HELP {self.name} {self.documentation}", f"# TYPE {self.name} {self.type}"]
+    lines.extend(self.samples())
+    return "\n".join(lines)
+
+class Counter(Metric):
+  """Monotonically increasing value per label set."""
+
+  type = "counter"
+
+  def __init__(self, name: str, documentation: str, labelnames: tuple = ()):
+    super().__init__(name, documentation, labelnames)
+    self._values = {}
+
+  def inc(self, amount: float = 1, **labels):
+    key = self._key(labels)
+    self._values[key] = self._values.get(key, 0) + amount
+
+  def samples(self) -> list:
+    return [f"{self.name}{_format_labels(self.labelnames, key)} {_format_value(value)}"
+            for key, value in sorted(self._values.items())]
+
+class Histogram(Metric):
+  """Distribution of observed values per label set, in cumulative buckets."""
+
+  type = "histogram"
+
+  def __init__(self, name: str, documentation: str, labelnames: tuple = (), buckets: tuple = STAGE_BUCKETS):
+    super().__init__(name, documentation, labelnames)
+    self.buckets = tuple(sorted(buckets))
+    self._series = {}  # label values -> [per-bucket counts (+Inf last), sum, count]
+
+  def observe(self, value: float, **labels):
+    key = self._key(labels)
+    series = self._series.get(key)
+    if series is None:
+      series = self._series[key] = [[0] * (len(self.buckets) + 1), 0.0, 0]
+    series[0][bisect.bisect_left(self.buckets, value)] += 1
+    series[1] += value
+    series[2] += 1
+
+  def samples(self) -> list:
+    lines = []
+    for key, (counts, total, count) in sorted(self._series.items()):
+      cumulative = 0
+      for bound, bucket_count in zip(self.buckets + (float("inf"),), counts):
+        cumulative += bucket_count
+        le = _format_labels(self.labelnames, key, ("le", _format_value(bound)))
+        lines.append(f"{self.name}_bucket{le} {cumulative}")
+      labels = _format_labels(self.labelnames, key)
+      lines.append(f"{self.name}_sum{labels} {_format_value(total)}")
+      lines.append(f"{self.name}_count{labels} {count}")
+    return lines
+
+class CallbackMetric(Metric):
+  """Value(s) computed at scrape time, e.g. queue depths or counters kept elsewhere."""
+
+  def __init__(self, name: str, documentation: str, labelnames: tuple, callback, metric_type: str = "gauge"):
+    """
+    Args:
+      callback: Returns a number (no labels) or a dict of label-value tuples -> number
+      metric_type: "gauge" or "counter"
+    """
+    super().__init__(name, documentation, labelnames)
+    self.callback = callback
+    self.type = metric_type
+
+  def samples(self) -> list:
+    values = self.callback()
+    if not isinstance(values, dict):
+      values = {(): values}
+    return [f"{self.name}{_format_labels(self.labelnames, key)} {_format_value(value)}"
+            for key, value in sorted(values.items())]
+
+class MetricsRegistry:
+  """Collection of metrics rendered together."""
+
+  def __init__(self):
+    self._metrics = {}
+
+  def register(self, metric: Metric) -> Metric:
+    """Add a metric (replacing one of the same name) and return it."""
+    self._metrics[metric.name] = metric
+    return metric
+
+  def counter(self, name: str, documentation: str, labelnames: tuple = ()) -> Counter:
+    return self.register(Counter(name, documentation, labelnames))
+
+  def histogram(self, name: str, documentation: str, labelnames: tuple = (), buckets: tuple = STAGE_BUCKETS) -> Histogram:
+    return self.register(Histogram(name, documentation, labelnames, buckets))
+
+  def callback(self, name: str, documentation: str, labelnames: tuple, callback, metric_type: str = "gauge") -> CallbackMetric:
+    return self.register(CallbackMetric(name, documentation, labelnames, callback, metric_type))
+
+  def render(self) -> str:
+    """All metrics in the Prometheus text exposition format."""
+    return "\n".join(metric.render() for metric in self._metrics.values()) + "\n"
+
+# Shared registry and the metrics recorded across modules
+registry = MetricsRegistry()
+stage_seconds = registry.histogram(
+  "comfynaut_stage_seconds", "Time spent in each stage of a generation request",
+  ("stage", "endpoint", "workflow"))
+job_seconds = registry.histogram(
+  "comfynaut_job_seconds", "Time from job submission to result",
+  ("endpoint", "workflow", "status"))
+jobs_rejected_total = registry.counter(
+  "comfynaut_jobs_rejected_total", "Jobs rejected by admission control",
+  ("kind",))
+
+# Endpoint and workflow labels of the job running in the current task
+_job_labels = contextvars.ContextVar("comfynaut_job_labels", default=("", ""))
+
+# Utility: Set the labels for stage timings recorded by the current task
+def set_job_labels(endpoint: str, workflow: str):
+  """Label every stage recorded from now on in this task (e.g. a job runner)."""
+  _job_labels.set((endpoint or "", workflow or ""))
+
+# Utility: Record a stage duration with the current job's labels
+def observe_stage(stage: str, seconds: float):
+  endpoint, workflow = _job_labels.get()
+  stage_seconds.observe(seconds, stage=stage, endpoint=endpoint, workflow=workflow)
+
+# Utility: Time a block of code as a stage
+@contextmanager
+def stage(name: str):
+  """Context manager recording the block's wall time as stage `name` (also when it raises)."""
+  start = time.perf_counter()
+  try:
+    yield
+  finally:
+    observe_stage(name, time.perf_counter() - start)
@@ -0,0 +1,356 @@
+# 🗃️ output_cache.py - Comfynaut Treasure Hold
+# "Why row back to the GPU island for gold that is already in the hold?"
+#
+# This file implements the on-disk output cache used by api_server.py.
+# The first fetch of a generated file from GET /outputs streams it from
+# ComfyUI to the client and to local disk at the same time; every later fetch
+# (a Telegram upload retried, a last frame requested again) is served from
+# disk without touching the GPU host. The cache survives API server restarts,
+# is bounded in bytes with least-recently-used eviction, and comes with the
+# helpers to answer byte ranges and conditional requests.
+#
+# Key features:
+# - Files keyed by prompt_id and output (<dir>/<prompt_id>/<ref>_<filename>, ref from node id + filename)
+# - Derived files (delivery variants) kept next to their originals (<ref>.<variant>_<filename>)
+# - Size-bounded LRU eviction (OUTPUT_CACHE_MAX_BYTES); last use is kept in each file's atime
+# - Tee on miss: one upstream download feeds both the client and the cache
+# - Range / If-Range / If-None-Match / If-Modified-Since evaluation for serving
+
+import asyncio
+import hashlib
+import logging
+import os
+import re
+import time
+import uuid
+from collections import OrderedDict
+from email.utils import formatdate, parsedate_to_datetime
+
+logger = logging.getLogger("comfynaut.outputs")
+
+# Output cache settings (OUTPUT_CACHE_DIR="" disables the cache)
+OUTPUT_CACHE_DIR = os.getenv("OUTPUT_CACHE_DIR", os.path.join(os.path.dirname(os.path.abspath(__file__)), "cache", "outputs"))
+OUTPUT_CACHE_MAX_BYTES = int(os.getenv("OUTPUT_CACHE_MAX_BYTES", str(2 * 1024 ** 3)))  # Disk budget for cached outputs
+
+# Chunk size when serving cached files (in bytes)
+READ_CHUNK_SIZE = 256 * 1024
+
+# Prompt ids become directory names, so only plain ids are ever cached or looked up
+PROMPT_ID_PATTERN = re.compile(r"^[0-9A-Za-z_-]{1,64}$")
+CACHED_NAME_PATTERN = re.compile(r"^([0-9a-f]{16})(?:\.([a-z]+))?_(.+)$")
+UNSAFE_FILENAME_CHARS = re.compile(r"[^0-9A-Za-z._-]")
+
+class RangeNotSatisfiable(Exception):
+  """Raised by parse_range for a range that lies outside the file (HTTP 416)."""
+
+# Utility: Short stable id of one output of a prompt
+def output_ref(node_id: str, filename: str) -> str:
+  """Return 16 hex characters naming the output `filename` of node `node_id`.
+  Outputs are identified by what produced them, never by their position in
+  a list, which differs between `executed` events and /history.
+  """
+  return hashlib.sha256(f"{node_id}/{filename}".encode("utf-8")).hexdigest()[:16]
+
+# Utility: File name of an output inside the cache
+def cached_filename(ref: str, filename: str, variant: str = "") -> str:
+  """Return "<ref>_<filename>" ("<ref>.<variant>_<filename>" for a variant), with odd characters replaced."""
+  prefix = f"{ref}.{variant}" if variant else ref
+  return f"{prefix}_{UNSAFE_FILENAME_CHARS.sub('_', os.path.basename(filename))}"
+
+# Utility: Strong ETag of one output of a prompt
+def output_etag(prompt_id: str, ref: str, variant: str = "") -> str:
+  """ComfyUI never rewrites a finished prompt's outputs, so (prompt_id, ref) identifies the content.
+  The ETag is the same whether the file is served from either cache or from ComfyUI.
+  """
+  name = f"{prompt_id}/{ref}.{variant}" if variant else f"{prompt_id}/{ref}"
+  return '"' + hashlib.sha256(name.encode("utf-8")).hexdigest()[:32] + '"'
+
+# Utility: Format a timestamp as an HTTP date
+def http_date(timestamp: float) -> str:
+  return formatdate(timestamp, usegmt=True)
+
+# Utility: Evaluate If-None-Match / If-Modified-Since
+def is_not_modified(headers, etag: str, last_modified: float = None) -> bool:
+  """Return True if the client's copy is current (answer 304).
+  If-None-Match wins over If-Modified-Since, as in RFC 9110.
+  Args:
+    headers: Request headers (case-insensitive mapping)
+    etag: The resource's ETag
+    last_modified: The resource's modification time, if known
+  """
+  if_none_match = headers.get("if-none-match")
+  if if_none_match is not None:
+    tags = [tag.strip() for tag in if_none_match.split(",")]
+    return "*" in tags or etag in tags or f"W/{etag}" in tags
+  if_modified_since = headers.get("if-modified-since")
+  if if_modified_since and last_modified is not None:
+    try:
+      return int(last_modified) <= parsedate_to_datetime(if_modified_since).timestamp()
+    except (TypeError, ValueError):
+      return False
+  return False
+
+# Utility: Parse a Range header for a file of known size
+def parse_range(headers, size: int, etag: str, last_modified: float = None):
+  """Return the (start, end) byte range to send (end inclusive), or None for the whole file.
+  Only single ranges are honoured; multiple or malformed ranges, and a Range
+  whose If-Range no longer matches, get the whole file (which RFC 9110 allows).
+  Raises:
+    RangeNotSatisfiable: if the range starts beyond the end of the file
+  """
+  header = headers.get("range")
+  if not header or not header.startswith("bytes="):
+    return None
+  if_range = headers.get("if-range")
+  if if_range and if_range != etag and (last_modified is None or if_range != http_date(last_modified)):
+    return None
+  spec = header[len("bytes="):].strip()
+  if "," in spec:
+    return None
+  first, _, last = spec.partition("-")
+  try:
+    if first == "":
+      suffix = int(last)
+      if suffix <= 0:
+        raise RangeNotSatisfiable(spec)
+      start, end = max(0, size - suffix), size - 1
+    else:
+      start = int(first)
+      end = min(int(last), size - 1) if last else size - 1
+  except ValueError:
+    return None
+  if start >= size or start > end:
+    raise RangeNotSatisfiable(spec)
+  return start, end
+
+# Utility: Read a byte range of an open file in chunks
+def iter_file(f, start: int, end: int):
+  """Yield bytes start..end (inclusive) of `f`; run by Starlette in its thread pool."""
+  f.seek(start)
+  remaining = end - start + 1
+  while remaining > 0:
+    chunk = f.read(min(READ_CHUNK_SIZE, remaining))
+    if not chunk:
+      break
+    remaining -= len(chunk)
+    yield chunk
+
+class OutputCache:
+  """Size-bounded LRU of generated files on local disk, keyed by (prompt_id, output ref, variant).
+  Originals have the variant "".
+  """
+
+  def __init__(self, directory: str = OUTPUT_CACHE_DIR, max_bytes: int = OUTPUT_CACHE_MAX_BYTES):
+    """
+    Args:
+      directory: Where cached files live ("" disables the cache)
+      max_bytes: Disk budget; the least recently used files go first
+    """
+    self.directory = directory or None
+    self.max_bytes = max_bytes
+    self.total_bytes = 0
+    self.hits = 0
+    self.misses = 0
+    self._entries = OrderedDict()  # (prompt_id, ref, variant) -> {"path", "size", "mtime"}, oldest use first
+    self._filling = set()          # Keys being downloaded right now
+    self._deriving = {}            # Key -> task creating that variant
+
+  @property
+  def enabled(self) -> bool:
+    return self.directory is not None and self.max_bytes > 0
+
+  def open(self):
+    """Index the files left by earlier runs, oldest use first (blocking: run it off the event loop)."""
+    if not self.enabled:
+      return
+    os.makedirs(self.directory, exist_ok=True)
+    found = []
+    for prompt_id in os.listdir(self.directory):
+      prompt_dir = os.path.join(self.directory, prompt_id)
+      if not PROMPT_ID_PATTERN.match(prompt_id) or not os.path.isdir(prompt_dir):
+        continue
+      for name in os.listdir(prompt_dir):
+        path = os.path.join(prompt_dir, name)
+        match = CACHED_NAME_PATTERN.match(name)
+        if name.endswith(".part") or not match:
+          os.remove(path)  # Download interrupted by a shutdown, or a file named by an older layout
+          continue
+        stat = os.stat(path)
+        found.append((stat.st_atime, (prompt_id, match.group(1), match.group(2) or ""),
+                      {"path": path, "size": stat.st_size, "mtime": stat.st_mtime}))
+      try:
+        os.rmdir(prompt_dir)  # Only succeeds if nothing was left in it
+      except OSError:
+        pass
+    for _, key, entry in sorted(found, key=lambda item: item[0]):
+      self._entries[key] = entry
+      self.total_bytes += entry["size"]
+    self._evict()
+    logger.info("Output cache at %s: %d files, %.1f MB", self.directory, len(self._entries), self.total_bytes / 1024 ** 2)
+
+  def get(self, prompt_id: str, ref: str, variant: str = ""):
+    """Return the cache entry ({"path", "size", "mtime"}) of an output (or of one of its variants), or None."""
+    if not self.enabled:
+      return None
+    key = (prompt_id, ref, variant)
+    entry = self._entries.get(key)
+    if entry is None:
+      self.misses += 1
+      return None
+    try:
+      # Record the use in atime (mtime stays Last-Modified), so LRU order survives restarts
+      os.utime(entry["path"], (time.time(), entry["mtime"]))
+    except OSError:
+      self._remove(key)
+      self.misses += 1
+      return None
+    self._entries.move_to_end(key)
+    self.hits += 1
+    return entry
+
+  def wants(self, prompt_id: str, ref: str) -> bool:
+    """Return True if an output is neither cached nor being downloaded (and could be cached)."""
+    key = (prompt_id, ref, "")
+    return (self.enabled and key not in self._entries and key not in self._filling
+            and PROMPT_ID_PATTERN.match(prompt_id) is not None)
+
+  async def tee(self, prompt_id: str, ref: str, filename: str, chunks, expected_size: int = None):
+    """Pass `chunks` through unchanged while writing them to the cache.
+    The file is only added once the stream ended with every byte (a client
+    that disconnects halfway leaves nothing behind). Outputs already cached
+    or being downloaded by another request are passed through untouched.
+    Args:
+      prompt_id, ref: The output's key (see output_ref)
+      filename: ComfyUI file name (kept for the extension and debugging)
+      chunks: Async iterator of the file's bytes
+      expected_size: Content-Length, if known
+    """
+    key = (prompt_id, ref, "")
+    if not self.wants(prompt_id, ref):
+      async for chunk in chunks:
+        yield chunk
+      return
+    self._filling.add(key)
+    path = os.path.join(self.directory, prompt_id, cached_filename(ref, filename))
+    temp_path = f"{path}.{uuid.uuid4().hex[:8]}.part"
+    loop = asyncio.get_running_loop()
+    f = None
+    size = 0
+    complete = False
+    try:
+      try:
+        f = await loop.run_in_executor(None, self._create, temp_path)
+      except OSError as e:
+        logger.warning("Could not cache output %s/%s: %s", prompt_id, ref, e)
+      async for chunk in chunks:
+        if f is not None:
+          try:
+            await loop.run_in_executor(None, f.write, chunk)
+          except OSError as e:
+            logger.warning("Could not cache output %s/%s: %s", prompt_id, ref, e)
+            f.close()
+            os.remove(temp_path)
+            f = None
+        size += len(chunk)
+        yield chunk
+      complete = expected_size is None or size == expected_size
+    finally:
+      self._filling.discard(key)
+      if f is not None:
+        f.close()
+        try:
+          if complete:
+            os.replace(temp_path, path)
+            self._add(key, path, size)
+          else:
+            os.remove(temp_path)
+        except OSError as e:
+          logger.warning("Could not cache output %s/%s: %s", prompt_id, ref, e)
+
+  async def fill(self, prompt_id: str, ref: str, filename: str, chunks, expected_size: int = None):
+    """Download a whole output into the cache (e.g. after a Range request was answered upstream)."""
+    if not self.wants(prompt_id, ref):
+      return
+    try:
+      async for _ in self.tee(prompt_id, ref, filename, chunks, expected_size):
+        pass
+    except Exception as e:
+      logger.warning("Could not cache output %s/%s: %s", prompt_id, ref, e)
+
+  async def derive(self, prompt_id: str, ref: str, variant: str, filename: str, produce):
+    """Return the entry of a variant of an output, creating it with `await produce(temp_path)` first if needed.
+    Concurrent calls for the same variant share one run, which carries on if
+    its callers go away. A failed run leaves nothing behind.
+    Args:
+      prompt_id, ref: The original output's key
+      variant: Variant name (lowercase letters)
+      filename: File name of the variant (its extension is kept)
+      produce: Coroutine function writing the variant to the path it is given
+    Returns:
+      The entry ({"path", "size", "mtime"}), or None if it did not fit the cache
+    Raises:
+      Whatever `produce` raised
+    """
+    if not self.enabled or not PROMPT_ID_PATTERN.match(prompt_id):
+      return None
+    key = (prompt_id, ref, variant)
+    if key in self._entries:
+      return self.get(*key)
+    task = self._deriving.get(key)
+    if task is None:
+      task = asyncio.get_running_loop().create_task(self._derive(key, filename, produce))
+      self._deriving[key] = task
+      task.add_done_callback(lambda done: self._derived(key, done))
+    return await asyncio.shield(task)
+
+  def stats(self) -> dict:
+    """Hit/miss counters and size."""
+    return {"entries": len(self._entries), "bytes": self.total_bytes, "hits": self.hits, "misses": self.misses}
+
+  async def _derive(self, key: tuple, filename: str, produce):
+    path = os.path.join(self.directory, key[0], cached_filename(key[1], filename, key[2]))
+    temp_path = f"{path}.{uuid.uuid4().hex[:8]}.part"
+    await asyncio.get_running_loop().run_in_executor(None, lambda: os.makedirs(os.path.dirname(path), exist_ok=True))
+    try:
+      await produce(temp_path)
+      os.replace(temp_path, path)
+    except BaseException:
+      try:
+        os.remove(temp_path)
+      except OSError:
+        pass
+      raise
+    self._add(key, path, os.path.getsize(path))
+    return self._entries.get(key)
+
+  def _derived(self, key: tuple, task):
+    self._deriving.pop(key, None)
+    if not task.cancelled():
+      task.exception()  # Retrieved here too, in case every caller went away
+
+  def _create(self, path: str):
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    return open(path, "wb")
+
+  def _add(self, key: tuple, path: str, size: int):
+    if key in self._entries:
+      self.total_bytes -= self._entries[key]["size"]
+    self._entries[key] = {"path": path, "size": size, "mtime": os.stat(path).st_mtime}
+    self._entries.move_to_end(key)
+    self.total_bytes += size
+    logger.info("Cached output %s/%s%s (%.1f MB)", key[0], key[1], f" ({key[2]})" if key[2] else "", size / 1024 ** 2)
+    self._evict()
+
+  def _evict(self):
+    """Delete the least recently used files until the cache fits its byte budget."""
+    while self.total_bytes > self.max_bytes and self._entries:
+      self._remove(next(iter(self._entries)))
+
+  def _remove(self, key: tuple):
+    entry = self._entries.pop(key)
+    self.total_bytes -= entry["size"]
+    try:
+      os.remove(entry["path"])
+      os.rmdir(os.path.dirname(entry["path"]))  # Only succeeds once the prompt's last file is gone
+    except OSError:
+      pass
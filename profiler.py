@@ -0,0 +1,173 @@
+# 🔬 profiler.py - Comfynaut Alchemist's Stopwatch
+# "Which ingredient makes the potion so slow? Time every step and the culprit confesses."
+#
+# This file implements the per-node execution profiler used by api_server.py.
+# ComfyUI announces every node it starts with an `executing` event, so the gap
+# between two consecutive events is the earlier node's run time. Each prompt's
+# node timings are folded into rolling per-workflow samples (per node id and
+# per class_type), summarized as p50/p95 at GET /profile, and optionally
+# appended to a JSONL file for offline analysis.
+#
+# Key features:
+# - Node timings from the WebSocket events we already receive (no extra requests)
+# - Rolling p50/p95 per workflow, node id and class_type
+# - Optional JSONL dump of every profiled prompt (NODE_PROFILE_LOG)
+
+import asyncio
+import json
+import logging
+import math
+import os
+import time
+from collections import deque
+
+logger = logging.getLogger("comfynaut.profiler")
+
+# Samples kept per node (and per class_type) for each workflow
+NODE_PROFILE_SAMPLES = int(os.getenv("NODE_PROFILE_SAMPLES", "200"))
+
+# JSONL file receiving one line per profiled prompt ("" = no dump)
+NODE_PROFILE_LOG = os.getenv("NODE_PROFILE_LOG", "")
+
+# Utility: Nearest-rank percentile of a list of numbers
+def percentile(values, q: float) -> float:
+  """Return the q-th percentile (0 < q <= 1) of `values` by nearest rank."""
+  ordered = sorted(values)
+  return ordered[max(0, math.ceil(q * len(ordered)) - 1)]
+
+# Utility: Summarize a sample window
+def summarize(durations) -> dict:
+  return {
+    "count": len(durations),
+    "p50": round(percentile(durations, 0.5), 3),
+    "p95": round(percentile(durations, 0.95), 3),
+    "mean": round(sum(durations) / len(durations), 3),
+  }
+
+class PromptProfile:
+  """Node timings of one prompt, built from its ComfyUI events.
+  Used as a PromptState subscriber; a node that started before we subscribed
+  (rare: ComfyUI began executing before /prompt returned) goes unmeasured.
+  """
+
+  def __init__(self, profiler, prompt_id: str, workflow_name: str, workflow: dict):
+    self.profiler = profiler
+    self.prompt_id = prompt_id
+    self.workflow_name = workflow_name
+    self.workflow = workflow
+    self.nodes = []         # (node_id, class_type, seconds) in execution order
+    self.cached = []        # Node ids ComfyUI skipped because their outputs were cached
+    self.status = None
+    self.total = 0.0        # Seconds from the first node start to completion
+    self._current = None    # (node_id, start time) of the node running now
+    self._started = None
+
+  def __call__(self, msg_type: str, data: dict):
+    now = time.monotonic()
+    if msg_type == "executing":
+      self._close(now)
+      node = data.get("node")
+      if node is None:
+        self._finish("success", now)
+      else:
+        self._current = (node, now)
+        if self._started is None:
+          self._started = now
+    elif msg_type == "execution_cached":
+      self.cached = list(data.get("nodes") or [])
+    elif msg_type == "execution_success":
+      self._close(now)
+      self._finish("success", now)
+    elif msg_type in ("execution_error", "execution_interrupted"):
+      self._current = None  # The failing node never completed
+      self._finish("error" if msg_type == "execution_error" else "interrupted", now)
+
+  def class_type(self, node_id: str):
+    return self.workflow.get(node_id, {}).get("class_type")
+
+  def _close(self, now: float):
+    if self._current is not None:
+      node_id, start = self._current
+      self.nodes.append((node_id, self.class_type(node_id), now - start))
+      self._current = None
+
+  def _finish(self, status: str, now: float):
+    if self.status is not None:
+      return
+    self.status = status
+    self.total = now - self._started if self._started is not None else 0.0
+    self.profiler.record(self)
+
+  def to_dict(self) -> dict:
+    return {
+      "prompt_id": self.prompt_id,
+      "workflow": self.workflow_name,
+      "status": self.status,
+      "total": round(self.total, 3),
+      "cached": self.cached,
+      "nodes": [{"node": node_id, "class_type": class_type, "seconds": round(seconds, 3)}
+                for node_id, class_type, seconds in self.nodes],
+    }
+
+class NodeProfiler:
+  """Rolling per-workflow node timing statistics."""
+
+  def __init__(self, samples: int = NODE_PROFILE_SAMPLES, log_path: str = NODE_PROFILE_LOG):
+    """
+    Args:
+      samples: Durations kept per node id / class_type in each workflow
+      log_path: JSONL file to append every profiled prompt to ("" = none)
+    """
+    self.samples = samples
+    self.log_path = log_path or None
+    self._workflows = {}  # workflow name -> {"prompts": n, "nodes": {...}, "classes": {...}}
+
+  def track(self, state, workflow_name: str, workflow: dict) -> PromptProfile:
+    """Start profiling a submitted prompt from its PromptState events."""
+    profile = PromptProfile(self, state.prompt_id, workflow_name or "(inline)", workflow or {})
+    state.subscribe(profile)
+    return profile
+
+  def record(self, profile: PromptProfile):
+    """Fold a finished prompt's node timings into its workflow's samples."""
+    if not profile.nodes:
+      return
+    stats = self._workflows.setdefault(profile.workflow_name, {"prompts": 0, "nodes": {}, "classes": {}})
+    stats["prompts"] += 1
+    per_class = {}
+    for node_id, class_type, seconds in profile.nodes:
+      node = stats["nodes"].get(node_id)
+      if node is None:
+        node = stats["nodes"][node_id] = {"class_type": class_type, "durations": deque(maxlen=self.samples)}
+      node["durations"].append(seconds)
+      per_class[class_type] = per_class.get(class_type, 0.0) + seconds
+    # A class_type sample is its total time in one prompt (e.g. both KSamplerAdvanced passes)
+    for class_type, seconds in per_class.items():
+      stats["classes"].setdefault(class_type, deque(maxlen=self.samples)).append(seconds)
+    if self.log_path:
+      line = json.dumps(profile.to_dict(), ensure_ascii=False) + "\n"
+      asyncio.get_running_loop().run_in_executor(None, self._append, line)
+
+  def summary(self, workflow_name: str = None) -> dict:
+    """p50/p95/mean per node and per class_type, slowest first, for one or every workflow."""
+    result = {}
+    for name, stats in self._workflows.items():
+      if workflow_name is not None and name != workflow_name:
+        continue
+      nodes = [{"node": node_id, "class_type": node["class_type"], **summarize(node["durations"])}
+               for node_id, node in stats["nodes"].items()]
+      classes = [{"class_type": class_type, **summarize(durations)}
+                 for class_type, durations in stats["classes"].items()]
+      result[name] = {
+        "prompts": stats["prompts"],
+        "nodes": sorted(nodes, key=lambda item: item["p50"], reverse=True),
+        "classes": sorted(classes, key=lambda item: item["p50"], reverse=True),
+      }
+    return result
+
+  def _append(self, line: str):
+    try:
+      with open(self.log_path, "a", encoding="utf-8") as f:
+        f.write(line)
+    except OSError as e:
+      logger.warning("Could not write node profile to %s: %s", self.log_path, e)
@@ -0,0 +1,252 @@
+# 🧠 result_cache.py - Comfynaut Memory Palace
+# "Why cast the same spell twice? The wizard simply remembers what happened last time."
+#
+# This file implements the optional result cache used by api_server.py.
+# Results are keyed on a canonical hash of the final, patched workflow graph:
+# the same workflow, prompt, seed and input image always produce the same key.
+# A hit returns the earlier outputs without touching the GPU (after checking
+# that ComfyUI still has them, unless they are on local disk), identical requests
+# that arrive while one is still running share that single ComfyUI execution,
+# and output files can optionally be kept on local disk so cached results
+# survive ComfyUI restarts and history trimming.
+#
+# Key features:
+# - Canonical SHA-256 cache keys for workflow graphs
+# - In-memory LRU of result metadata (RESULT_CACHE_SIZE entries)
+# - Coalescing of in-flight identical requests into one execution
+# - Optional on-disk output bytes (RESULT_CACHE_DIR) with size-based LRU eviction
+
+import asyncio
+import functools
+import hashlib
+import json
+import logging
+import os
+import re
+import shutil
+from collections import OrderedDict
+from output_cache import output_ref
+
+logger = logging.getLogger("comfynaut.cache")
+
+# Result cache settings (RESULT_CACHE_SIZE=0 disables the cache)
+RESULT_CACHE_SIZE = int(os.getenv("RESULT_CACHE_SIZE", "256"))          # Cached results kept in memory
+RESULT_CACHE_DIR = os.getenv("RESULT_CACHE_DIR", "")                     # Where output bytes are kept ("" = metadata only)
+RESULT_CACHE_MAX_BYTES = int(os.getenv("RESULT_CACHE_MAX_BYTES", str(2 * 1024 ** 3)))  # Disk budget for output bytes
+
+# Cache entry directories are named after their key
+KEY_PATTERN = re.compile(r"^[0-9a-f]{64}$")
+
+# Utility: Hash a workflow graph into a cache key
+def workflow_cache_key(workflow: dict) -> str:
+  """Return the SHA-256 of a workflow graph in canonical JSON form (sorted keys, no whitespace)."""
+  canonical = json.dumps(workflow, sort_keys=True, separators=(",", ":"), ensure_ascii=False)
+  return hashlib.sha256(canonical.encode("utf-8")).hexdigest()
+
+class ResultCache:
+  """LRU of generation results keyed by workflow hash, with in-flight coalescing.
+  Entries hold the runner's result (output URLs), the prompt_id that produced
+  it and, when a directory is configured, the output files on disk.
+  """
+
+  def __init__(self, max_entries: int = RESULT_CACHE_SIZE, directory: str = RESULT_CACHE_DIR,
+               max_bytes: int = RESULT_CACHE_MAX_BYTES):
+    self.max_entries = max_entries
+    self.directory = directory or None
+    self.max_bytes = max_bytes
+    self.total_bytes = 0
+    self.hits = 0
+    self.misses = 0
+    self.coalesced = 0
+    self.stale = 0
+    self._entries = OrderedDict()
+    self._inflight = {}
+    self._by_prompt = {}
+
+  @property
+  def enabled(self) -> bool:
+    return self.max_entries > 0
+
+  async def get_or_run(self, key: str, run, validate=None):
+    """Return the cached result for `key`, or run `run()` once and cache it.
+    Concurrent callers with the same key wait for the first caller's run (and
+    take over if that run is cancelled).
+    Falsy results (failed generations) are shared with waiters but not cached.
+    Args:
+      key: Cache key (see workflow_cache_key)
+      run: Coroutine function producing the result
+      validate: Coroutine function (prompt_id) -> bool checking that ComfyUI still
+        has an entry's outputs; entries without files on disk are only reused if it
+        returns True (None trusts every entry)
+    Returns:
+      (result, source) where source is "hit", "coalesced" or "miss"
+    """
+    while True:
+      entry = self._entries.get(key)
+      if entry is not None:
+        if await self._still_available(entry, validate):
+          if key in self._entries:
+            self._entries.move_to_end(key)
+          self.hits += 1
+          return entry["result"], "hit"
+        if self._entries.get(key) is entry:
+          # ComfyUI restarted or trimmed its history: the cached URLs would 404
+          logger.info("Cached result %s is gone from ComfyUI, running the workflow again", key[:12])
+          self.stale += 1
+          self._remove(key)
+        continue
+      pending = self._inflight.get(key)
+      if pending is None:
+        break
+      self.coalesced += 1
+      try:
+        return await asyncio.shield(pending), "coalesced"
+      except asyncio.CancelledError:
+        if not pending.cancelled():
+          raise  # We were cancelled ourselves
+        # The run we joined was cancelled (its job was); run it ourselves instead
+    self.misses += 1
+    pending = asyncio.get_running_loop().create_future()
+    self._inflight[key] = pending
+    try:
+      result = await run()
+    except asyncio.CancelledError:
+      pending.cancel()
+      raise
+    except Exception as e:
+      pending.set_exception(e)
+      pending.exception()  # Mark as retrieved when nobody else is waiting
+      raise
+    finally:
+      del self._inflight[key]
+    if result:
+      self._store(key, result)
+    pending.set_result(result)
+    return result, "miss"
+
+  def link(self, key: str, prompt_id: str):
+    """Record which ComfyUI prompt produced a cached result."""
+    entry = self._entries.get(key)
+    if entry is not None:
+      entry["prompt_id"] = prompt_id
+      self._by_prompt[prompt_id] = key
+
+  async def store_files(self, key: str, outputs: list, fetch):
+    """Copy a result's output files to disk so they outlive ComfyUI's history.
+    Args:
+      key: Cache key of the entry
+      outputs: Output entries (see comfy_client.list_outputs)
+      fetch: Coroutine function (output) -> async iterator of byte chunks
+    """
+    if not self.directory or key not in self._entries:
+      return
+    entry_dir = os.path.join(self.directory, key)
+    loop = asyncio.get_running_loop()
+    remove_dir = functools.partial(shutil.rmtree, entry_dir, ignore_errors=True)
+    files = {}
+    size = 0
+    try:
+      await loop.run_in_executor(None, functools.partial(os.makedirs, entry_dir, exist_ok=True))
+      for output in outputs:
+        ref = output_ref(output["node_id"], output["filename"])
+        path = os.path.join(entry_dir, f"{ref}{os.path.splitext(output['filename'])[1]}")
+        f = await loop.run_in_executor(None, open, path, "wb")
+        try:
+          async for chunk in fetch(output):
+            await loop.run_in_executor(None, f.write, chunk)
+            size += len(chunk)
+        finally:
+          await loop.run_in_executor(None, f.close)
+        files[ref] = path
+    except Exception as e:
+      logger.warning("Could not cache output files for %s: %s", key[:12], e)
+      await loop.run_in_executor(None, remove_dir)
+      return
+    entry = self._entries.get(key)
+    if entry is None:
+      # Evicted while we were downloading
+      await loop.run_in_executor(None, remove_dir)
+      return
+    entry["files"] = files
+    entry["size"] = size
+    self.total_bytes += size
+    logger.info("Cached %d output file(s) for %s (%.1f MB)", len(files), key[:12], size / 1024 ** 2)
+    self._evict()
+
+  def file_for(self, prompt_id: str, ref: str):
+    """Return the on-disk path of a cached output (see output_cache.output_ref), or None."""
+    key = self._by_prompt.get(prompt_id)
+    entry = self._entries.get(key) if key else None
+    if entry is None:
+      return None
+    path = entry["files"].get(ref)
+    if path and os.path.isfile(path):
+      self._entries.move_to_end(key)
+      return path
+    return None
+
+  def stats(self) -> dict:
+    """Hit/miss counters and sizes."""
+    return {
+      "entries": len(self._entries),
+      "inflight": len(self._inflight),
+      "hits": self.hits,
+      "misses": self.misses,
+      "coalesced": self.coalesced,
+      "stale": self.stale,
+      "bytes": self.total_bytes,
+    }
+
+  async def _still_available(self, entry: dict, validate) -> bool:
+    """Return True if an entry's outputs can still be served (from disk, or from ComfyUI per `validate`)."""
+    if entry["files"] and all(os.path.isfile(path) for path in entry["files"].values()):
+      return True
+    if validate is None:
+      return True
+    if entry["prompt_id"] is None:
+      return False
+    try:
+      return await validate(entry["prompt_id"])
+    except Exception as e:
+      logger.warning("Could not check cached prompt %s: %s", entry["prompt_id"], e)
+      return False
+
+  def _remove(self, key: str):
+    entry = self._entries.pop(key)
+    if entry["prompt_id"] is not None:
+      self._by_prompt.pop(entry["prompt_id"], None)
+    self._drop_files(key, entry)
+
+  def _store(self, key: str, result):
+    self._entries[key] = {"result": result, "prompt_id": None, "files": {}, "size": 0}
+    self._evict()
+
+  def _evict(self):
+    """Enforce both budgets in LRU order.
+    Over the entry budget, whole entries are dropped; over the byte budget,
+    only their files are (the metadata still points at ComfyUI's copies).
+    """
+    while len(self._entries) > self.max_entries:
+      self._remove(next(iter(self._entries)))
+    for key, entry in self._entries.items():
+      if self.total_bytes <= self.max_bytes:
+        break
+      self._drop_files(key, entry)
+
+  def _drop_files(self, key: str, entry: dict):
+    if entry["files"]:
+      self.total_bytes -= entry["size"]
+      entry["files"] = {}
+      entry["size"] = 0
+      shutil.rmtree(os.path.join(self.directory, key), ignore_errors=True)
+
+  def open(self):
+    """Remove entry directories left by a previous run (blocking: run it off the event loop).
+    The index lives in memory, so files from an earlier process are unreachable.
+    """
+    if not self.enabled or not self.directory:
+      return
+    os.makedirs(self.directory, exist_ok=True)
+    for name in os.listdir(self.directory):
+      if KEY_PATTERN.match(name):
+        shutil.rmtree(os.path.join(self.directory, name), ignore_errors=True)
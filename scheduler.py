@@ -0,0 +1,252 @@
+# ⚖️ scheduler.py - Comfynaut Harbour Master
+# "Every ship gets a berth—the rowboats just don't wait behind the galleons."
+#
+# This file implements the job scheduler used by api_server.py.
+# Instead of dumping every job into ComfyUI's FIFO queue, jobs wait here and
+# each backend is fed a shallow queue (SCHEDULER_BACKEND_DEPTH prompts: one
+# running, the next ready to go). Whenever a slot frees up, the most deserving
+# waiting job gets it:
+#   1. Priority class: interactive > marathon > video
+#   2. Within a class, weighted fair share between users (start-time fair
+#      queueing: the user with the least GPU time per unit of weight goes next)
+#   3. Within a user, submission order
+# A job whose models are already loaded on a free backend may jump ahead of
+# its own priority class for up to SCHEDULER_AFFINITY_WINDOW seconds, so
+# ComfyUI doesn't swap multi-GB checkpoints between every prompt.
+#
+# Key features:
+# - Shallow per-backend queues keep the GPU saturated without long FIFO waits
+# - Priority classes and per-user weighted fair sharing
+# - Jobs pinned to a backend (e.g. their image was uploaded there) wait for that backend
+# - Checkpoint affinity: same-model jobs are grouped within a bounded wait window
+
+import asyncio
+import itertools
+import logging
+import os
+import time
+from contextlib import asynccontextmanager
+
+logger = logging.getLogger("comfynaut.scheduler")
+
+# Priority classes, most urgent first
+PRIORITY_CLASSES = ("interactive", "marathon", "video")
+
+# Priority class used when a request does not ask for one
+DEFAULT_PRIORITY = {"t2i": "interactive", "i2i": "interactive", "i2v": "video"}
+
+# Prompts handed to each ComfyUI backend at once (running + queued there)
+SCHEDULER_BACKEND_DEPTH = int(os.getenv("SCHEDULER_BACKEND_DEPTH", "2"))
+
+# Fair-share weights per user id, e.g. "12345:2,67890:0.5" (default weight 1)
+SCHEDULER_USER_WEIGHTS = os.getenv("SCHEDULER_USER_WEIGHTS", "")
+
+# Longest a job may be passed over by same-class jobs whose models are already loaded (0 = no affinity)
+SCHEDULER_AFFINITY_WINDOW = float(os.getenv("SCHEDULER_AFFINITY_WINDOW", "30"))
+
+# How often waiting jobs are re-checked against backend health (in seconds)
+SCHEDULER_TICK = 1.0
+
+# Fair-share bucket for jobs submitted without a user id
+ANONYMOUS_USER = "anonymous"
+
+# Utility: Parse "user:weight,user:weight" into a dict
+def parse_weights(spec: str) -> dict:
+  """Parse a SCHEDULER_USER_WEIGHTS string; malformed entries are logged and skipped."""
+  weights = {}
+  for item in spec.split(","):
+    if not item.strip():
+      continue
+    user, _, weight = item.rpartition(":")
+    try:
+      value = float(weight)
+    except ValueError:
+      value = 0.0
+    if value > 0:
+      weights[user.strip()] = value
+    else:
+      logger.warning("Ignoring malformed scheduler weight: %r", item)
+  return weights
+
+class Waiter:
+  """A job waiting for a backend slot."""
+
+  def __init__(self, job, seq: int):
+    self.job = job
+    self.seq = seq
+    self.user = job.user_id or ANONYMOUS_USER
+    self.rank = PRIORITY_CLASSES.index(job.priority)
+    self.model = job.model
+    self.enqueued = time.monotonic()
+    self.future = asyncio.get_running_loop().create_future()
+
+class Scheduler:
+  """Hands out ComfyUI backend slots by priority class and per-user fair share."""
+
+  def __init__(self, pool, cost=None, depth: int = SCHEDULER_BACKEND_DEPTH, weights: dict = None,
+               affinity_window: float = SCHEDULER_AFFINITY_WINDOW):
+    """
+    Args:
+      pool: comfy_client.ComfyBackendPool to schedule onto
+      cost: Callable (job) -> expected GPU seconds, used to charge fair-share time
+      depth: Prompts handed to each backend at once
+      weights: Fair-share weight per user id (default 1)
+      affinity_window: Seconds a job may be passed over in favour of same-model jobs
+    """
+    self.pool = pool
+    self.cost = cost or (lambda job: 1.0)
+    self.depth = max(1, depth)
+    self.weights = parse_weights(SCHEDULER_USER_WEIGHTS) if weights is None else weights
+    self.affinity_window = affinity_window
+    self.affinity_hits = 0    # Dispatches that reused the models already on a backend
+    self.model_swaps = 0      # Dispatches that made a backend load different models
+    self._waiting = []
+    self._slots = {}      # backend host -> granted slots
+    self._loaded = {}     # backend host -> model signature of the last job handed to it
+    self._finish = {}     # user -> virtual finish time of their last dispatched job
+    self._clock = 0.0     # Virtual start time of the last dispatched job
+    self._seq = itertools.count()
+    self._task = None
+
+  def start(self):
+    """Start the periodic dispatch loop (picks up backends that became healthy)."""
+    if self._task is None or self._task.done():
+      self._task = asyncio.get_running_loop().create_task(self._tick())
+
+  async def stop(self):
+    """Stop the dispatch loop."""
+    if self._task is not None:
+      self._task.cancel()
+      try:
+        await self._task
+      except asyncio.CancelledError:
+        pass
+      self._task = None
+
+  @asynccontextmanager
+  async def slot(self, job):
+    """Hold a backend slot for the duration of the block; yields the backend."""
+    backend = await self.acquire(job)
+    try:
+      yield backend
+    finally:
+      self.release(backend)
+
+  async def acquire(self, job):
+    """Wait for a backend slot. Sets job.backend unless the job is pinned already."""
+    waiter = Waiter(job, next(self._seq))
+    self._waiting.append(waiter)
+    self._dispatch()
+    try:
+      return await waiter.future
+    except asyncio.CancelledError:
+      if waiter in self._waiting:
+        self._waiting.remove(waiter)
+      elif waiter.future.done() and not waiter.future.cancelled():
+        self.release(waiter.future.result())  # Granted just before the cancel landed
+      raise
+
+  def release(self, backend):
+    """Return a backend slot and hand it to the next waiting job."""
+    self._slots[backend.host] = max(0, self._slots.get(backend.host, 0) - 1)
+    self._dispatch()
+
+  def position(self, job):
+    """Number of waiting jobs that go before `job`, or None if it is not waiting."""
+    order = sorted(self._waiting, key=self._priority_key)
+    for index, waiter in enumerate(order):
+      if waiter.job is job:
+        return index
+    return None
+
+  def inflight(self) -> int:
+    """Slots currently granted across all backends."""
+    return sum(self._slots.values())
+
+  def status(self) -> dict:
+    """JSON-friendly view of waiting jobs and granted slots."""
+    waiting = {name: 0 for name in PRIORITY_CLASSES}
+    for waiter in self._waiting:
+      waiting[waiter.job.priority] += 1
+    return {
+      "depth": self.depth,
+      "waiting": waiting,
+      "slots": dict(self._slots),
+      "models": dict(self._loaded),
+      "affinity_hits": self.affinity_hits,
+      "model_swaps": self.model_swaps,
+    }
+
+  def _start_tag(self, user: str) -> float:
+    """Virtual start time of the user's next job (idle users don't bank credit)."""
+    return max(self._finish.get(user, 0.0), self._clock)
+
+  def _priority_key(self, waiter: Waiter):
+    return (waiter.rank, self._start_tag(waiter.user), waiter.seq)
+
+  def _free_backends(self) -> list:
+    """Backends with a free slot, emptiest first (any backend if none is healthy)."""
+    backends = [backend for backend in self.pool.backends if backend.healthy] or self.pool.backends
+    free = [backend for backend in backends if self._slots.get(backend.host, 0) < self.depth]
+    return sorted(free, key=lambda backend: (self._slots.get(backend.host, 0), backend.load))
+
+  def _dispatch(self):
+    """Grant free slots to the best waiting jobs that can use them."""
+    while self._waiting:
+      free = self._free_backends()
+      if not free:
+        return
+      free_hosts = {backend.host for backend in free}
+      candidates = [
+        waiter for waiter in self._waiting
+        if not waiter.future.done() and (waiter.job.backend is None or waiter.job.backend.host in free_hosts)
+      ]
+      if not candidates:
+        return
+      waiter, backend = self._choose(candidates, free)
+      self._waiting.remove(waiter)
+      waiter.job.backend = backend
+      self._slots[backend.host] = self._slots.get(backend.host, 0) + 1
+      if waiter.model is not None:
+        loaded = self._loaded.get(backend.host)
+        if loaded == waiter.model:
+          self.affinity_hits += 1
+        elif loaded is not None:
+          self.model_swaps += 1
+        self._loaded[backend.host] = waiter.model
+      # Charge the user's fair share with the job's expected GPU time
+      start = self._start_tag(waiter.user)
+      self._clock = start
+      self._finish[waiter.user] = start + self.cost(waiter.job) / self.weights.get(waiter.user, 1.0)
+      logger.info("Scheduled %s job %s (%s, user %s) on %s", waiter.job.kind, waiter.job.id,
+                  waiter.job.priority, waiter.user, backend.host)
+      waiter.future.set_result(backend)
+
+  def _choose(self, candidates: list, free: list):
+    """Pick the next (waiter, backend) pair, preferring backends that already hold the job's models.
+    The best job by priority goes first unless it would force a model swap;
+    then, until it has waited affinity_window seconds, a job of the same
+    priority class whose models are loaded on a free backend goes instead.
+    """
+    head = min(candidates, key=self._priority_key)
+    head_backends = [head.job.backend] if head.job.backend is not None else free
+    if head.model is None:
+      return head, head_backends[0]  # Unknown models: nothing to group by
+    for wanted in (head.model, None):  # Models already loaded, else a backend with nothing loaded yet
+      for backend in head_backends:
+        if self._loaded.get(backend.host) == wanted:
+          return head, backend
+    if time.monotonic() - head.enqueued < self.affinity_window:
+      for waiter in sorted(candidates, key=self._priority_key):
+        if waiter.rank != head.rank or waiter.model is None:
+          continue
+        backends = [waiter.job.backend] if waiter.job.backend is not None else free
+        for backend in backends:
+          if self._loaded.get(backend.host) == waiter.model:
+            return waiter, backend
+    return head, head_backends[0]
+
+  async def _tick(self):
+    while True:
+      await asyncio.sleep(SCHEDULER_TICK)
+      self._dispatch()
@@ -12,13 +12,12 @@ import os
 import logging
 import httpx
 import glob
-import base64
 import asyncio
 from dotenv import load_dotenv
 from telegram import Update, InlineKeyboardButton, InlineKeyboardMarkup, constants
 from telegram.ext import ApplicationBuilder, CommandHandler, CallbackQueryHandler, ContextTypes, MessageHandler, filters
 from io import BytesIO
-from urllib.parse import urlparse
+from urllib.parse import urljoin
 
 # Load environment variables from .env file
 load_dotenv()
@@ -27,7 +26,21 @@ API_SERVER = os.getenv("COMFY_API_HOST")
 
 # Timeout constants for API requests (in seconds)
 IMG2IMG_TIMEOUT = 120.0  # 2 minutes for image-to-image generation
-IMG2VID_TIMEOUT = 900.0  # 15 minutes for video generation
+IMG2VID_TIMEOUT = 900.0  # 15 minutes max wait for a video job to finish
+
+# Job API polling settings (in seconds)
+JOB_POLL_INTERVAL = 5.0      # Delay between GET /jobs/{id} status checks
+JOB_REQUEST_TIMEOUT = 30.0   # Timeout for each individual job API request
+MARATHON_POLL_INTERVAL = 1.0 # Status check delay for marathon images (they finish in seconds)
+MARATHON_JOB_TIMEOUT = 600.0 # Max wait for one marathon image (it queues behind interactive requests)
+
+# Backoff when the API server is at capacity (HTTP 429 with Retry-After)
+BUSY_RETRIES = 3             # Retries before giving up
+BUSY_RETRY_MAX_WAIT = 60.0   # Longest single wait between retries (in seconds)
+
+# Delivery variant requested for generated files: JPEG images and size-capped MP4 videos made
+# for Telegram by the API server (it sends the original when it cannot make one)
+OUTPUT_VARIANT = "telegram"
 
 # Telegram caption length limit
 # The Telegram Bot API enforces a maximum of 1024 characters for photo and video captions
@@ -64,13 +77,107 @@ def truncate_caption(caption: str, max_length: int = MAX_CAPTION_LENGTH) -> str:
   
   return caption[:truncated_length] + ellipsis
 
-# Utility: Replace localhost with actual API server hostname for Telegram delivery
-def make_url_visible(url: str) -> str:
-  """Replace localhost in URL with actual API server hostname for Telegram delivery."""
-  parsed_api = urlparse(API_SERVER)
-  if parsed_api.hostname:
-    return url.replace("127.0.0.1", parsed_api.hostname)
-  return url
+# Utility: Resolve an output URL returned by the API server
+def resolve_output_url(url: str, variant: str = OUTPUT_VARIANT) -> str:
+  """Resolve an output URL (e.g. /outputs/<prompt_id>/9/ComfyUI_00001_.png) against the API server.
+  Outputs are streamed by the API server, so ComfyUI never needs to be reachable from here.
+  Paths are appended to API_SERVER like every other API call, so a path prefix
+  (e.g. http://host/comfynaut behind a reverse proxy) is kept.
+  Args:
+    url: Output URL returned by the API server
+    variant: Delivery variant to ask for ("" for the original file)
+  """
+  if url.startswith("/"):
+    resolved = f"{API_SERVER.rstrip('/')}{url}"
+  else:
+    resolved = urljoin(API_SERVER.rstrip("/") + "/", url)
+  if variant:
+    resolved += ("&" if "?" in resolved else "?") + f"variant={variant}"
+  return resolved
+
+# Utility: POST to the API server, backing off while it reports being at capacity
+async def post_with_backoff(client: httpx.AsyncClient, url: str, rewind=None, **kwargs) -> httpx.Response:
+  """POST a request, retrying after the server's Retry-After hint on HTTP 429.
+  
+  Args:
+    client: The httpx client to use
+    url: Target URL
+    rewind: Optional file object sent in the request, rewound before each retry
+    kwargs: Passed through to client.post (json=, data=, files=, ...)
+    
+  Returns:
+    The last response (still 429 if the server stayed busy)
+  """
+  for attempt in range(BUSY_RETRIES + 1):
+    resp = await client.post(url, **kwargs)
+    if resp.status_code != 429 or attempt == BUSY_RETRIES:
+      return resp
+    try:
+      delay = min(float(resp.headers.get("Retry-After", BUSY_RETRY_MAX_WAIT)), BUSY_RETRY_MAX_WAIT)
+    except ValueError:
+      delay = BUSY_RETRY_MAX_WAIT
+    logging.info("API server busy, retrying %s in %.0fs", url, delay)
+    await asyncio.sleep(delay)
+    if rewind is not None:
+      rewind.seek(0)
+  return resp
+
+# Utility: Run a job through the API server's job queue and wait for its result
+async def run_api_job(client: httpx.AsyncClient, payload: dict, max_wait: float = IMG2VID_TIMEOUT, image=None,
+                      on_submit=None, poll_interval: float = JOB_POLL_INTERVAL) -> dict:
+  """Submit a job via POST /jobs and poll GET /jobs/{id} until it finishes.
+  
+  Short requests replace one long-held connection, so a slow video never
+  ties up a socket for its whole runtime.
+  
+  Args:
+    client: The httpx client to use for API requests
+    payload: Job request body ("type", "prompt", ...)
+    max_wait: Maximum time to wait for the job to finish
+    image: Optional image file object, sent as a multipart upload to POST /jobs/upload
+    on_submit: Optional callback receiving the job id as soon as the job is queued
+    poll_interval: Delay between status checks
+    
+  Returns:
+    The job's result dict (same shape as the blocking endpoints' responses;
+    status "cancelled" if the job was cancelled with DELETE /jobs/{id})
+  """
+  if image is not None:
+    resp = await post_with_backoff(client, f"{API_SERVER}/jobs/upload", rewind=image,
+                                   data=payload, files={"image": ("image.jpg", image, "image/jpeg")})
+  else:
+    resp = await post_with_backoff(client, f"{API_SERVER}/jobs", json=payload)
+  resp.raise_for_status()
+  job_id = resp.json()["job_id"]
+  logging.info("Job %s submitted to API server", job_id)
+  if on_submit is not None:
+    on_submit(job_id)
+  loop = asyncio.get_running_loop()
+  deadline = loop.time() + max_wait
+  while loop.time() < deadline:
+    await asyncio.sleep(poll_interval)
+    try:
+      resp = await client.get(f"{API_SERVER}/jobs/{job_id}")
+    except httpx.TransportError as e:
+      # The API server may be restarting; it re-attaches the job when it is back
+      logging.warning("Could not poll job %s (%s), retrying", job_id, e)
+      continue
+    resp.raise_for_status()
+    job = resp.json()
+    if job.get("status") in ("success", "error", "cancelled"):
+      return job.get("result") or {}
+  return {"status": "error", "message": f"Job {job_id} did not finish within {max_wait:.0f}s"}
+
+# Utility: Cancel a job on the API server (stops its ComfyUI prompt)
+async def cancel_api_job(job_id: str):
+  """Cancel a job via DELETE /jobs/{id}; failures are logged, not raised."""
+  try:
+    async with httpx.AsyncClient(timeout=JOB_REQUEST_TIMEOUT) as client:
+      resp = await client.delete(f"{API_SERVER}/jobs/{job_id}")
+      resp.raise_for_status()
+    logging.info("Job %s cancelled (status: %s)", job_id, resp.json().get("status"))
+  except httpx.HTTPError as e:
+    logging.warning("Could not cancel job %s: %s", job_id, e)
 
 # Dynamically load available workflows from the workflows directory
 def load_workflows():
@@ -164,11 +271,11 @@ async def dream(update: Update, context: ContextTypes.DEFAULT_TYPE):
 
   try:
     # Send both prompt and workflow to backend API server
-    payload = {"prompt": prompt, "workflow": workflow_file}
+    payload = {"prompt": prompt, "workflow": workflow_file, "user_id": str(update.effective_user.id)}
     logging.info("Sending payload to API server: %s", payload)
     
     async with httpx.AsyncClient(timeout=60.0) as client:
-      resp = await client.post(f"{API_SERVER}/dream", json=payload)
+      resp = await post_with_backoff(client, f"{API_SERVER}/dream", json=payload)
       resp.raise_for_status()
       data = resp.json()
       
@@ -179,8 +286,8 @@ async def dream(update: Update, context: ContextTypes.DEFAULT_TYPE):
 
       if status == "success" and image_url:
         try:
-          # Replace localhost in image URL with actual API server hostname for Telegram delivery
-          image_url_visible = make_url_visible(image_url)
+          # Resolve the output URL against the API server, which streams it from ComfyUI
+          image_url_visible = resolve_output_url(image_url)
           
           # Download the generated image
           img_resp = await client.get(image_url_visible)
@@ -212,7 +319,8 @@ async def dream(update: Update, context: ContextTypes.DEFAULT_TYPE):
     await update.message.reply_text(f"⚠️ An unexpected error occurred: {e}")
 
 # Utility: Generate a single image (used by both /dream and /marathon)
-async def generate_single_image(chat_id, bot, prompt: str, workflow_file: str, username: str = None, send_caption: bool = True):
+async def generate_single_image(chat_id, bot, prompt: str, workflow_file: str, username: str = None, send_caption: bool = True,
+                                user_id: str = None, priority: str = None, job_slot: dict = None):
   """Generate a single image and send it to the chat.
   
   Args:
@@ -222,19 +330,34 @@ async def generate_single_image(chat_id, bot, prompt: str, workflow_file: str, u
     workflow_file: The workflow file to use
     username: Username for logging purposes
     send_caption: Whether to send caption with the image (default: True)
+    user_id: Telegram user id, for the API server's fair-share scheduling
+    priority: Scheduler priority class (default: the server's default for t2i)
+    job_slot: If given, the image is generated through the job API and
+      job_slot["job_id"] holds the job id while it runs, so /stop can cancel it
     
   Returns:
-    True if successful, False otherwise
+    True if successful, False otherwise, None if the job was cancelled
   """
   try:
     # Send both prompt and workflow to backend API server
-    payload = {"prompt": prompt, "workflow": workflow_file}
+    payload = {"prompt": prompt, "workflow": workflow_file, "user_id": user_id, "priority": priority}
     logging.info("Sending payload to API server: %s", payload)
     
     async with httpx.AsyncClient(timeout=60.0) as client:
-      resp = await client.post(f"{API_SERVER}/dream", json=payload)
-      resp.raise_for_status()
-      data = resp.json()
+      if job_slot is not None:
+        try:
+          data = await run_api_job(client, {"type": "t2i", **payload}, max_wait=MARATHON_JOB_TIMEOUT,
+                                   on_submit=lambda job_id: job_slot.update(job_id=job_id),
+                                   poll_interval=MARATHON_POLL_INTERVAL)
+        finally:
+          job_slot.pop("job_id", None)
+        if data.get("status") == "cancelled":
+          logging.info("Image job for user %s was cancelled", username)
+          return None
+      else:
+        resp = await post_with_backoff(client, f"{API_SERVER}/dream", json=payload)
+        resp.raise_for_status()
+        data = resp.json()
       
       msg = data.get("message", "Hmmm, the castle gate is silent...")
       image_url = data.get("image_url")
@@ -243,8 +366,8 @@ async def generate_single_image(chat_id, bot, prompt: str, workflow_file: str, u
 
       if status == "success" and image_url:
         try:
-          # Replace localhost in image URL with actual API server hostname for Telegram delivery
-          image_url_visible = make_url_visible(image_url)
+          # Resolve the output URL against the API server, which streams it from ComfyUI
+          image_url_visible = resolve_output_url(image_url)
           
           # Download the generated image
           img_resp = await client.get(image_url_visible)
@@ -303,9 +426,12 @@ async def marathon(update: Update, context: ContextTypes.DEFAULT_TYPE):
     )
     return
 
-  # Stop any existing marathon for this user
+  # Stop any existing marathon for this user, cancelling the image it is generating
   if context.user_data.get("marathon_active"):
     context.user_data["marathon_active"] = False
+    job_id = context.user_data.get("marathon_job", {}).get("job_id")
+    if job_id:
+      await cancel_api_job(job_id)
     await asyncio.sleep(1)  # Give time for the previous marathon to stop
 
   # Retrieve the user's selected workflow or use default (t2i - SDXL.json for text-to-image)
@@ -322,6 +448,8 @@ async def marathon(update: Update, context: ContextTypes.DEFAULT_TYPE):
   context.user_data["marathon_prompt"] = prompt
   context.user_data["marathon_workflow"] = workflow_file
   context.user_data["marathon_count"] = 0
+  # Id of the marathon's in-flight image job, for /stop to cancel
+  job_slot = context.user_data["marathon_job"] = {}
 
   await update.message.reply_text(
     f"🎠 **MARATHON MODE ACTIVATED!** 🎠\n\n"
@@ -336,14 +464,17 @@ async def marathon(update: Update, context: ContextTypes.DEFAULT_TYPE):
   # Start the generation loop in a background task so /stop can interrupt
   chat_id = update.effective_chat.id
   username = update.effective_user.username
+  user_id = str(update.effective_user.id)
   
   # Create background task for the marathon loop
-  asyncio.create_task(_run_marathon_loop(context, chat_id, username, prompt, workflow_file))
+  asyncio.create_task(_run_marathon_loop(context, chat_id, username, prompt, workflow_file, user_id, job_slot))
 
 
 # Background task that runs the marathon loop
-async def _run_marathon_loop(context: ContextTypes.DEFAULT_TYPE, chat_id: int, username: str, prompt: str, workflow_file: str):
+async def _run_marathon_loop(context: ContextTypes.DEFAULT_TYPE, chat_id: int, username: str, prompt: str, workflow_file: str,
+                             user_id: str = None, job_slot: dict = None):
   """Run the marathon generation loop in the background."""
+  cancelled = False
   while context.user_data.get("marathon_active", False):
     # Increment counter
     context.user_data["marathon_count"] = context.user_data.get("marathon_count", 0) + 1
@@ -373,9 +504,18 @@ async def _run_marathon_loop(context: ContextTypes.DEFAULT_TYPE, chat_id: int, u
       prompt=prompt,
       workflow_file=workflow_file,
       username=username,
-      send_caption=False  # No caption in marathon mode
+      send_caption=False,  # No caption in marathon mode
+      user_id=user_id,
+      priority="marathon",  # Interactive requests go first
+      job_slot=job_slot if job_slot is not None else {}
     )
     
+    if success is None:
+      # The image was cancelled (/stop, or a new /marathon replacing this one)
+      logging.info("Marathon generation #%d cancelled for user %s", count, username)
+      cancelled = True
+      break
+    
     if not success:
       # If generation failed, stop the marathon
       logging.warning("Marathon generation failed for user %s, stopping marathon", username)
@@ -395,8 +535,10 @@ async def _run_marathon_loop(context: ContextTypes.DEFAULT_TYPE, chat_id: int, u
   
   # Marathon stopped
   final_count = context.user_data.get("marathon_count", 0)
-  # Only send completion message if the marathon wasn't stopped by command or error
+  # Only send completion message if the marathon wasn't stopped by command, error or cancellation
   # (those send their own messages)
+  if cancelled:
+    return
   if not context.user_data.get("marathon_stopped_by_command", False) and not context.user_data.get("marathon_stopped_by_error", False):
     logging.info("Marathon naturally ended for user %s after %d images", username, final_count)
     await context.bot.send_message(
@@ -419,6 +561,10 @@ async def stop(update: Update, context: ContextTypes.DEFAULT_TYPE):
     context.user_data["marathon_active"] = False
     context.user_data["marathon_stopped_by_command"] = True
     count = context.user_data.get("marathon_count", 0)
+    # Don't let the image in progress keep the GPU busy for a result nobody wants
+    job_id = context.user_data.get("marathon_job", {}).get("job_id")
+    if job_id:
+      await cancel_api_job(job_id)
     await update.message.reply_text(
       f"🛑 **STOP!** You shall not pass... any further! 🧙‍♂️\n\n"
       f"Marathon stopped after {count} images.\n"
@@ -473,9 +619,6 @@ async def img2vid(update: Update, context: ContextTypes.DEFAULT_TYPE):
     await photo_file.download_to_memory(photo_bytes)
     photo_bytes.seek(0)
     
-    # Encode the image as base64
-    image_data = base64.b64encode(photo_bytes.read()).decode('utf-8')
-    
     prompt_info = f"\nPrompt: {prompt}" if prompt else ""
     await update.message.reply_text(
       f"🦜 Taking yer image to the GPU wizard's castle for video magic...{prompt_info}\n"
@@ -485,14 +628,13 @@ async def img2vid(update: Update, context: ContextTypes.DEFAULT_TYPE):
     # Show typing action to indicate video is being prepared
     await context.bot.send_chat_action(chat_id=update.effective_chat.id, action=constants.ChatAction.UPLOAD_VIDEO)
     
-    # Send to backend API server with extended timeout for video generation
-    payload = {"image_data": image_data, "prompt": prompt}
-    logging.info("Sending img2vid request to API server with prompt: '%s'", prompt)
+    # Submit as a background job and poll it instead of holding one long request open
+    # The image goes up as a multipart file (no base64 inflation)
+    payload = {"type": "i2v", "prompt": prompt, "user_id": str(update.effective_user.id)}
+    logging.info("Sending img2vid job to API server with prompt: '%s'", prompt)
     
-    async with httpx.AsyncClient(timeout=IMG2VID_TIMEOUT) as client:
-      resp = await client.post(f"{API_SERVER}/img2vid", json=payload)
-      resp.raise_for_status()
-      data = resp.json()
+    async with httpx.AsyncClient(timeout=JOB_REQUEST_TIMEOUT) as client:
+      data = await run_api_job(client, payload, max_wait=IMG2VID_TIMEOUT, image=photo_bytes)
       
       msg = data.get("message", "Hmmm, the castle gate is silent...")
       video_url = data.get("video_url")
@@ -501,8 +643,8 @@ async def img2vid(update: Update, context: ContextTypes.DEFAULT_TYPE):
 
       if status == "success" and video_url:
         try:
-          # Replace localhost in video URL with actual API server hostname for Telegram delivery
-          video_url_visible = make_url_visible(video_url)
+          # Resolve the output URL against the API server, which streams it from ComfyUI
+          video_url_visible = resolve_output_url(video_url)
           
           # Download the generated video
           vid_resp = await client.get(video_url_visible)
@@ -517,13 +659,14 @@ async def img2vid(update: Update, context: ContextTypes.DEFAULT_TYPE):
           # Truncate caption to fit Telegram's 1024 character limit
           caption = truncate_caption(caption)
           # Send the video to the user
-          await update.message.reply_video(video=vid_bytes, caption=caption)
+          # Delivery variants keep the MP4 index up front, so Telegram can stream the video
+          await update.message.reply_video(video=vid_bytes, caption=caption, supports_streaming=True)
           logging.info("Sent video to user %s!", update.effective_user.username)
           
           # Send the last frame image if available (allows continuing with the video)
           if last_frame_url:
             try:
-              last_frame_url_visible = make_url_visible(last_frame_url)
+              last_frame_url_visible = resolve_output_url(last_frame_url)
               
               # Download the last frame image
               frame_resp = await client.get(last_frame_url_visible)
@@ -607,9 +750,6 @@ async def img2img(update: Update, context: ContextTypes.DEFAULT_TYPE):
     await photo_file.download_to_memory(photo_bytes)
     photo_bytes.seek(0)
     
-    # Encode the image as base64
-    image_data = base64.b64encode(photo_bytes.read()).decode('utf-8')
-    
     await update.message.reply_text(
       f"🦜 Taking yer image to the GPU wizard's castle...\n"
       f"Transformation prompt: {prompt}"
@@ -618,12 +758,17 @@ async def img2img(update: Update, context: ContextTypes.DEFAULT_TYPE):
     # Show typing action to indicate image is being prepared
     await context.bot.send_chat_action(chat_id=update.effective_chat.id, action=constants.ChatAction.UPLOAD_PHOTO)
     
-    # Send to backend API server
-    payload = {"prompt": prompt, "image_data": image_data}
+    # Send to backend API server as a multipart upload (no base64 inflation)
     logging.info("Sending img2img request to API server with prompt: '%s'", prompt)
     
     async with httpx.AsyncClient(timeout=IMG2IMG_TIMEOUT) as client:
-      resp = await client.post(f"{API_SERVER}/img2img", json=payload)
+      resp = await post_with_backoff(
+        client,
+        f"{API_SERVER}/img2img/upload",
+        rewind=photo_bytes,
+        data={"prompt": prompt, "user_id": str(update.effective_user.id)},
+        files={"image": ("image.jpg", photo_bytes, "image/jpeg")},
+      )
       resp.raise_for_status()
       data = resp.json()
       
@@ -633,8 +778,8 @@ async def img2img(update: Update, context: ContextTypes.DEFAULT_TYPE):
 
       if status == "success" and image_url:
         try:
-          # Replace localhost in image URL with actual API server hostname for Telegram delivery
-          image_url_visible = make_url_visible(image_url)
+          # Resolve the output URL against the API server, which streams it from ComfyUI
+          image_url_visible = resolve_output_url(image_url)
           
           # Download the generated image
           img_resp = await client.get(image_url_visible)
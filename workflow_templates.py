@@ -0,0 +1,290 @@
+# 📜 workflow_templates.py - Comfynaut Spellbook Library
+# "A wise wizard reads the spellbook once—then only changes the words that matter."
+#
+# This file implements the workflow template cache used by api_server.py.
+# Each workflow JSON in workflows/ is parsed once, its injection points (prompt,
+# seed, input image, video output) are resolved up front, and per-request
+# workflows are built by patching only the touched nodes instead of
+# deep-copying the whole graph. Templates are reloaded when a file's mtime changes.
+#
+# Key features:
+# - Robust workflow loading (multiple encodings)
+# - Node detection helpers (prompt, seed, image, latent, video nodes)
+# - Input resize detection (the size the workflow scales its input image to)
+# - Model signatures (which checkpoints, UNETs and LoRAs a workflow loads)
+# - WorkflowTemplate: precomputed node index + copy-on-write patching
+# - WorkflowRegistry: mtime-invalidated template cache
+
+import os
+import json
+import logging
+
+logger = logging.getLogger("comfynaut.workflows")
+
+# Loader node types and the inputs naming the model files they load
+MODEL_LOADER_INPUTS = {
+  "CheckpointLoaderSimple": ("ckpt_name",),
+  "UNETLoader": ("unet_name",),
+  "CLIPLoader": ("clip_name",),
+  "VAELoader": ("vae_name",),
+  "LoraLoader": ("lora_name",),
+}
+
+# Resize nodes a workflow may apply to its input image, and their (width, height, mode) inputs
+RESIZE_NODE_INPUTS = {
+  "ImageResizeKJv2": ("width", "height", "keep_proportion"),
+  "ImageResizeKJ": ("width", "height", "keep_proportion"),
+  "ImageScale": ("width", "height", "crop"),
+}
+
+# Nodes that only hold numbers, and the input holding each of their outputs
+NUMBER_NODE_OUTPUTS = {
+  "mxSlider2D": ("Xi", "Yi"),
+  "mxSlider": ("Xi",),
+  "PrimitiveInt": ("value",),
+  "INTConstant": ("value",),
+  "PrimitiveNode": ("value",),
+}
+
+# rgthree's Power Lora Loader keeps each LoRA in a lora_N dict ({"on", "lora", "strength"})
+POWER_LORA_LOADER = "Power Lora Loader (rgthree)"
+
+# Utility: Load a workflow JSON file with robust decoding and error handling
+def load_workflow(path):
+  """Load a ComfyUI workflow JSON with robust decoding & logging."""
+  if not os.path.isfile(path):
+    raise FileNotFoundError(f"Workflow file not found: {path}")
+  encodings = ("utf-8", "utf-8-sig", "latin-1")
+  last_error = None
+  for enc in encodings:
+    try:
+      with open(path, "r", encoding=enc) as f:
+        return json.load(f)
+    except UnicodeDecodeError as e:
+      logger.warning("Unicode decode error using %s for %s: %s", enc, path, e)
+      last_error = e
+      continue
+    except json.JSONDecodeError as e:
+      raise ValueError(f"Invalid JSON in workflow file {path}: {e}") from e
+  raise UnicodeDecodeError("<multi>", b"", 0, 0, f"Failed to decode workflow file {path} with tried encodings: {encodings}. Last error: {last_error}")
+
+# Utility: Find the 'Positive Prompt' CLIPTextEncode node dynamically
+def find_positive_prompt_node(workflow):
+  """Find the 'Positive Prompt' CLIPTextEncode node dynamically."""
+  clip_text_encode_nodes = []
+  for node_id, node_data in workflow.items():
+    if isinstance(node_data, dict) and node_data.get("class_type") == "CLIPTextEncode":
+      title = node_data.get("_meta", {}).get("title", "").lower()
+      clip_text_encode_nodes.append((node_id, title))
+  if not clip_text_encode_nodes:
+    raise ValueError("No CLIPTextEncode nodes found in workflow!")
+  for node_id, title in clip_text_encode_nodes:
+    if "positive" in title:
+      return node_id
+  return clip_text_encode_nodes[0][0]
+
+# Utility: Find the node for loading the input image
+def find_image_load_node(workflow):
+  """Find the node for loading the input image (usually `LoadImage`)."""
+  for node_id, node_data in workflow.items():
+    if node_data.get("class_type") == "LoadImage":
+      return node_id
+  raise ValueError("Could not find LoadImage node in workflow!")
+
+# Utility: Find the KSampler node dynamically
+def find_ksampler_node(workflow):
+  """Find the KSampler node dynamically."""
+  for node_id, node_data in workflow.items():
+    if node_data.get("class_type") == "KSampler":
+      return node_id
+  raise ValueError("Could not find KSampler node in workflow!")
+
+# Utility: Find the Seed (rgthree) node for video generation workflows
+def find_seed_node(workflow):
+  """Find the Seed (rgthree) node for video generation workflows."""
+  for node_id, node_data in workflow.items():
+    if node_data.get("class_type") == "Seed (rgthree)":
+      return node_id
+  raise ValueError("Could not find Seed (rgthree) node in workflow!")
+
+# Utility: Find the PrimitiveStringMultiline node for positive prompt in video workflows
+def find_primitive_prompt_node(workflow):
+  """Find the PrimitiveStringMultiline node used for positive prompt input.
+  This is used in video generation workflows where the prompt is stored in a
+  PrimitiveStringMultiline node with title 'Positive'.
+  """
+  for node_id, node_data in workflow.items():
+    if isinstance(node_data, dict) and node_data.get("class_type") == "PrimitiveStringMultiline":
+      title = node_data.get("_meta", {}).get("title", "").lower()
+      if "positive" in title:
+        return node_id
+  return None
+
+# Utility: Find the empty latent image node that sets resolution and batch size
+def find_latent_image_node(workflow):
+  """Find the EmptyLatentImage / EmptySD3LatentImage node (holds width, height, batch_size)."""
+  for node_id, node_data in workflow.items():
+    if node_data.get("class_type") in ("EmptyLatentImage", "EmptySD3LatentImage"):
+      return node_id
+  raise ValueError("Could not find EmptyLatentImage node in workflow!")
+
+# Utility: Find the VHS_VideoCombine node for video output
+def find_video_combine_node(workflow, require_save_output=False):
+  """Find the VHS_VideoCombine node for video output.
+  If require_save_output is True, only return nodes with save_output=True.
+  """
+  for node_id, node_data in workflow.items():
+    if node_data.get("class_type") == "VHS_VideoCombine":
+      if require_save_output:
+        if node_data.get("inputs", {}).get("save_output", False):
+          return node_id
+      else:
+        return node_id
+  raise ValueError("Could not find VHS_VideoCombine node in workflow!")
+
+# Utility: Summarize which model files a workflow loads
+def model_signature(workflow):
+  """Return a signature of the models a workflow loads, or None if it has no known loaders.
+  Workflows with the same signature can run back to back without ComfyUI
+  swapping models in and out of VRAM.
+  """
+  models = set()
+  for node_data in workflow.values():
+    class_type = node_data.get("class_type")
+    inputs = node_data.get("inputs", {})
+    if class_type == POWER_LORA_LOADER:
+      for name, value in inputs.items():
+        if name.startswith("lora_") and isinstance(value, dict) and value.get("on") and value.get("lora"):
+          models.add(value["lora"])
+      continue
+    for input_name in MODEL_LOADER_INPUTS.get(class_type, ()):
+      value = inputs.get(input_name)
+      if isinstance(value, str):  # Linked inputs ([node_id, slot]) are not file names
+        models.add(value)
+  return "+".join(sorted(models)) or None
+
+# Utility: Resolve a node input to a number, following links into slider/constant nodes
+def resolve_number(workflow, value):
+  """Return the number an input holds (directly or through a number node), or None."""
+  if isinstance(value, list) and len(value) == 2:
+    node_data = workflow.get(str(value[0]), {})
+    names = NUMBER_NODE_OUTPUTS.get(node_data.get("class_type"), ())
+    if not isinstance(value[1], int) or value[1] >= len(names):
+      return None
+    value = node_data.get("inputs", {}).get(names[value[1]])
+  if isinstance(value, (int, float)) and not isinstance(value, bool):
+    return value
+  return None
+
+# Utility: Find the resize the workflow applies to its input image
+def find_input_resize(workflow, image_node):
+  """Return how the workflow resizes the output of `image_node`, or None if it doesn't.
+  Returns:
+    {"width", "height", "mode", "divisible_by"}, where mode is "fit" (keep the
+    aspect ratio inside the box), "crop" (fill the box, center crop) or
+    "stretch" (exactly width x height)
+  """
+  for node_data in workflow.values():
+    class_type = node_data.get("class_type")
+    inputs = node_data.get("inputs", {})
+    if class_type not in RESIZE_NODE_INPUTS or inputs.get("image") != [image_node, 0]:
+      continue
+    width_input, height_input, mode_input = RESIZE_NODE_INPUTS[class_type]
+    width = resolve_number(workflow, inputs.get(width_input))
+    height = resolve_number(workflow, inputs.get(height_input))
+    if not width or not height:
+      return None
+    mode = inputs.get(mode_input)
+    if class_type == "ImageScale":
+      mode = "crop" if mode == "center" else "stretch"
+    elif mode not in ("stretch", "crop"):
+      mode = "fit"  # "resize", and the pad modes (padding stays on the GPU side)
+    return {"width": int(width), "height": int(height), "mode": mode,
+            "divisible_by": int(inputs.get("divisible_by") or 1) if class_type != "ImageScale" else 1}
+  return None
+
+def _find_or_none(finder, workflow, *args):
+  """Run a node finder, returning None instead of raising when the node is missing."""
+  try:
+    return finder(workflow, *args)
+  except ValueError:
+    return None
+
+class WorkflowTemplate:
+  """A parsed workflow plus the node ids requests need to patch.
+  The graph is shared between requests and must be treated as read-only;
+  use patch() to get a per-request copy with only the touched nodes copied.
+  """
+
+  def __init__(self, graph: dict, path: str = None, mtime: float = None):
+    self.graph = graph
+    self.path = path
+    self.name = os.path.basename(path) if path else None
+    self.mtime = mtime
+    # Injection points, resolved once per template (None when the node is absent)
+    self.prompt_node = _find_or_none(find_positive_prompt_node, graph)
+    self.primitive_prompt_node = find_primitive_prompt_node(graph)
+    self.ksampler_node = _find_or_none(find_ksampler_node, graph)
+    self.seed_node = _find_or_none(find_seed_node, graph)
+    self.image_node = _find_or_none(find_image_load_node, graph)
+    self.latent_node = _find_or_none(find_latent_image_node, graph)
+    self.video_node = _find_or_none(find_video_combine_node, graph, True)
+    self.input_resize = find_input_resize(graph, self.image_node) if self.image_node is not None else None
+
+  @classmethod
+  def from_file(cls, path: str) -> "WorkflowTemplate":
+    """Parse a workflow file into a template."""
+    mtime = os.stat(path).st_mtime
+    return cls(load_workflow(path), path, mtime)
+
+  @classmethod
+  def coerce(cls, workflow) -> "WorkflowTemplate":
+    """Accept either a template or a raw workflow dict (compiled on the fly)."""
+    if isinstance(workflow, WorkflowTemplate):
+      return workflow
+    return cls(workflow)
+
+  def patch(self, changes: dict) -> dict:
+    """Build a request graph with `changes` applied.
+    Args:
+      changes: Mapping of node_id -> {input_name: value}
+    Returns:
+      A new graph dict sharing every untouched node with the template
+    """
+    workflow = dict(self.graph)
+    for node_id, inputs in changes.items():
+      node = dict(workflow[node_id])
+      node["inputs"] = {**node.get("inputs", {}), **inputs}
+      workflow[node_id] = node
+    return workflow
+
+class WorkflowRegistry:
+  """Cache of compiled WorkflowTemplates, invalidated when a file's mtime changes."""
+
+  def __init__(self, directory: str):
+    self.directory = directory
+    self._templates = {}
+
+  def get(self, path: str) -> WorkflowTemplate:
+    """Return the template for `path`, (re)loading it if the file changed on disk."""
+    path = os.path.abspath(path)
+    try:
+      mtime = os.stat(path).st_mtime
+    except FileNotFoundError:
+      self._templates.pop(path, None)
+      raise FileNotFoundError(f"Workflow file not found: {path}") from None
+    template = self._templates.get(path)
+    if template is None or template.mtime != mtime:
+      template = WorkflowTemplate.from_file(path)
+      self._templates[path] = template
+      logger.info("Compiled workflow template: %s", template.name)
+    return template
+
+  def preload(self):
+    """Compile every workflow in the directory up front (errors are logged, not raised)."""
+    for name in sorted(os.listdir(self.directory)):
+      if name.endswith(".json"):
+        try:
+          self.get(os.path.join(self.directory, name))
+        except (OSError, ValueError) as e:
+          logger.warning("Could not compile workflow %s: %s", name, e)